@@ -5,6 +5,7 @@ from __future__ import print_function
 
 import logging
 
+import click
 from flask import Flask
 from flask.logging import default_handler
 from flask_cors import CORS
@@ -14,7 +15,7 @@ from flask_dropzone import Dropzone
 
 import config
 from blueprints import bp
-from models import db
+from models import db, migrate_frames, migrate_frame_mementos, upgrade_schema
 
 
 compress = Compress()  # pylint: disable=C0103
@@ -76,13 +77,27 @@ def create_app(**config_overrides):
     db.app = app  # setting context
     db.init_app(app)
 
-    db.create_all()
+    # Creates the database, or adds the tables and columns of newer versions
+    upgrade_schema()
+    db.session.remove()
 
     app.register_blueprint(bp)
 
     compress.init_app(app)
     dropzone.init_app(app)
 
+    @app.cli.command('migrate-frames')
+    def migrate_frames_command():
+        """Re-encode pickled frames in the database."""
+        count = migrate_frames()
+        click.echo('Re-encoded {} frames.'.format(count))
+
+    @app.cli.command('migrate-frame-mementos')
+    def migrate_frame_mementos_command():
+        """Convert undo history stored as whole frames to the changed regions."""
+        count = migrate_frame_mementos()
+        click.echo('Converted {} frame mementos.'.format(count))
+
     # For flask monitoring dashboard
     if config.DASHBOARD_CONFIG:
         dashboard.config.init_from(config.DASHBOARD_CONFIG)
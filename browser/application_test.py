@@ -0,0 +1,166 @@
+"""Tests for creating DeepCell Label on the databases of older versions"""
+
+import pickle
+import sqlite3
+
+import numpy as np
+
+import imgutils
+import models
+from application import create_app
+from conftest import decode_array
+
+
+TOKEN = 'baselinetkn1'
+
+
+def insert_baseline_project(path, num_frames=2, height=4, width=4):
+    """
+    Inserts a project like the first release created it, with pickled arrays.
+
+    Returns:
+        numpy.array: the labels of the project
+    """
+    raw = np.arange(num_frames * height * width, dtype=np.uint16)
+    raw = raw.reshape((num_frames, height, width, 1))
+    labels = np.zeros((num_frames, height, width, 1), dtype=np.int32)
+    labels[:, :2, :2, 0] = 1
+    labels[1, 2:, 2:, 0] = 2
+    cell_ids = {0: np.array([1, 2])}
+    cell_info = {0: {
+        1: {'label': '1', 'frames': [0, 1], 'slices': ''},
+        2: {'label': '2', 'frames': [1], 'slices': ''},
+    }}
+    with sqlite3.connect(path) as connection:
+        connection.execute(
+            'INSERT INTO actions (project_id, action_id, action_name, done) '
+            'VALUES (1, 0, "create_project", 1)')
+        connection.execute(
+            'INSERT INTO projects (id, token, "createdAt", path, source, height, width, '
+            'num_frames, num_channels, num_features, rgb, frame, channel, feature, '
+            'scale_factor, action_id, num_actions) '
+            'VALUES (1, ?, "2020-01-01 00:00:00", "test.npz", "s3", ?, ?, ?, 1, 1, '
+            '0, 0, 0, 0, 1, 0, 1)',
+            (TOKEN, height, width, num_frames))
+        for frame_id in range(num_frames):
+            for table, frame in (('rawframes', raw[frame_id]),
+                                 ('rgbframes', raw[frame_id]),
+                                 ('labelframes', labels[frame_id])):
+                connection.execute(
+                    'INSERT INTO {} (project_id, frame_id, frame) VALUES (1, ?, ?)'.format(table),
+                    (frame_id, pickle.dumps(frame)))
+            connection.execute(
+                'INSERT INTO framemementos (project_id, action_id, frame_id, frame_array) '
+                'VALUES (1, 0, ?, ?)',
+                (frame_id, pickle.dumps(labels[frame_id])))
+        connection.execute(
+            'INSERT INTO labels (project_id, cell_ids, cell_info) VALUES (1, ?, ?)',
+            (pickle.dumps(cell_ids), pickle.dumps(cell_info)))
+    return labels
+
+
+def create_baseline_app(path):
+    return create_app(
+        TESTING=True,
+        SQLALCHEMY_DATABASE_URI='sqlite:///{}'.format(path),
+        PREFETCH_FRAMES=0,
+    )
+
+
+def test_create_app_upgrades_baseline_schema(baseline_db):
+    insert_baseline_project(baseline_db)
+
+    app = create_baseline_app(baseline_db)
+
+    with app.app_context():
+        inspector = models.db.inspect(models.db.engine)
+        project_columns = {c['name'] for c in inspector.get_columns('projects')}
+        frame_columns = {c['name'] for c in inspector.get_columns('labelframes')}
+        assert {'version', 'rgb_percentiles'} <= project_columns
+        assert 'version' in frame_columns
+        assert 'cells' in inspector.get_table_names()
+
+        project = models.Project.get(TOKEN)
+        assert project.version == 0
+        assert project.rgb_percentiles is None
+        assert [frame.version for frame in project.label_frames] == [0, 0]
+
+    # Adds nothing once the schema is up to date
+    with app.app_context():
+        assert models.upgrade_schema() == []
+
+    response = app.test_client().get('/api/project/{}'.format(TOKEN))
+    assert response.status_code == 200
+
+
+def test_migrate_baseline_project(baseline_db):
+    labels = insert_baseline_project(baseline_db)
+    app = create_baseline_app(baseline_db)
+    runner = app.test_cli_runner()
+
+    result = runner.invoke(args=['migrate-frames'])
+    assert result.exit_code == 0
+    assert 'Re-encoded 6 frames.' in result.output
+    result = runner.invoke(args=['migrate-frame-mementos'])
+    assert result.exit_code == 0
+    assert 'Converted 2 frame mementos.' in result.output
+
+    with sqlite3.connect(baseline_db) as connection:
+        for table in ('rawframes', 'rgbframes', 'labelframes'):
+            rows = connection.execute('SELECT frame FROM {}'.format(table)).fetchall()
+            assert all(row[0].startswith(models.NdarrayType.MAGIC) for row in rows)
+
+    response = app.test_client().get('/api/project/{}'.format(TOKEN))
+    assert response.status_code == 200
+    payload = response.json
+    assert payload['numFrames'] == 2
+    assert payload['dimensions'] == [4, 4]
+    np.testing.assert_array_equal(decode_array(payload['imgs']['seg_arr']),
+                                  imgutils.add_outlines(labels[0, ..., 0]))
+    assert sorted(payload['tracks']['0']) == ['1', '2']
+
+    with app.app_context():
+        project = models.Project.get(TOKEN)
+        np.testing.assert_array_equal(project.label_array, labels)
+
+
+def test_edit_baseline_project_labels(baseline_db):
+    """Editing a project with pickled labels moves them to the cells tables."""
+    insert_baseline_project(baseline_db)
+    app = create_baseline_app(baseline_db)
+    client = app.test_client()
+
+    def saved_cells():
+        with sqlite3.connect(baseline_db) as connection:
+            cells = connection.execute(
+                'SELECT feature, label FROM cells ORDER BY feature, label').fetchall()
+            frames = connection.execute(
+                'SELECT feature, label, frame_id FROM cellframes '
+                'ORDER BY feature, label, frame_id').fetchall()
+            legacy = connection.execute('SELECT cell_ids, cell_info FROM labels').fetchone()
+        return cells, frames, legacy
+
+    response = client.get('/api/project/{}'.format(TOKEN))
+    assert response.status_code == 200
+    cells, frames, legacy = saved_cells()
+    assert cells == []
+    assert legacy[0] is not None and legacy[1] is not None
+
+    # Delete label 1 in the first frame
+    response = client.post('/api/edit/{}/delete_mask'.format(TOKEN), data={'label': 1})
+    assert response.status_code == 200
+    cells, frames, legacy = saved_cells()
+    assert cells == [(0, 1), (0, 2)]
+    assert frames == [(0, 1, 1), (0, 2, 1)]
+    assert legacy == (None, None)
+
+    response = client.post('/api/undo/{}'.format(TOKEN))
+    assert response.status_code == 200
+    cells, frames, legacy = saved_cells()
+    assert cells == [(0, 1), (0, 2)]
+    assert frames == [(0, 1, 0), (0, 1, 1), (0, 2, 1)]
+
+    with app.app_context():
+        project = models.Project.get(TOKEN)
+        assert project.labels.cell_info[0][1]['frames'] == [0, 1]
+        assert project.labels.cell_info[0][2]['frames'] == [1]
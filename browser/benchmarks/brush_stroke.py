@@ -0,0 +1,59 @@
+"""
+Benchmark drawing a long brush stroke on a large label frame:
+one skimage.draw.circle per point over full-frame arrays
+against rasterizing the stroke once in its bounding box.
+
+Run from the browser folder with
+    python -m benchmarks.brush_stroke
+"""
+import timeit
+
+import numpy as np
+from skimage.draw import circle
+
+from imgutils import rasterize_stroke
+
+
+def legacy_draw(img, trace, target_value, brush_value, radius):
+    """Previous BaseEdit.action_handle_draw, without the label metadata."""
+    img = np.copy(img)
+    in_original = np.any(np.isin(img, brush_value))
+    img_draw = np.where(img == target_value, brush_value, img)
+    for y, x in trace:
+        brush_area = circle(y, x, radius, img.shape)
+        img[brush_area] = img_draw[brush_area]
+    in_modified = np.any(np.isin(img, brush_value))
+    return img, in_original, in_modified
+
+
+def box_draw(img, trace, target_value, brush_value, radius):
+    """Drawing in BaseEdit.action_handle_draw, without the label metadata."""
+    (y1, x1, y2, x2), brush_area = rasterize_stroke(trace, radius, img.shape)
+    box = np.copy(img[y1:y2, x1:x2])
+    in_box_original = np.any(box == brush_value)
+    box[brush_area & (box == target_value)] = brush_value
+    in_box_modified = np.any(box == brush_value)
+    changed = np.any(box != img[y1:y2, x1:x2])
+    return box, in_box_original, in_box_modified, changed
+
+
+def make_stroke(num_points=500, seed=0):
+    """Make a wiggly stroke of integer points like the ones the front-end sends."""
+    rng = np.random.RandomState(seed)
+    steps = rng.randint(-1, 3, size=(num_points, 2))
+    return (np.cumsum(steps, axis=0) + 200).tolist()
+
+
+def main(size=2048, radius=10):
+    img = np.zeros((size, size), dtype='int32')
+    img[::64, :] = 5
+    trace = make_stroke()
+    print('frame with shape {}, stroke with {} points and radius {}'.format(
+        img.shape, len(trace), radius))
+    for name, draw in [('circle per point', legacy_draw), ('stroke box', box_draw)]:
+        seconds = min(timeit.repeat(lambda: draw(img, trace, 0, 1, radius), repeat=5, number=1))
+        print('  {:<20} {:>8.1f} ms'.format(name, seconds * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Benchmark coloring frames with colormap lookup tables
+against calling the matplotlib colormap on normalized frames.
+
+Run from the browser folder with
+    python -m benchmarks.colormap_render
+"""
+import copy
+import timeit
+
+import matplotlib.pyplot as plt
+from matplotlib.colors import Normalize
+import numpy as np
+
+from imgutils import apply_colormap
+
+
+def legacy_apply_colormap(imgarr, vmin, vmax, cmap, bad=None):
+    """Previous pngify coloring, with Normalize and the colormap on float arrays."""
+    cmap = copy.copy(plt.get_cmap(cmap))
+    if bad is not None:
+        cmap.set_bad(bad)
+    return cmap(Normalize(vmin=vmin, vmax=vmax)(imgarr), bytes=True)
+
+
+def make_frames(height=1024, width=1024, num_cells=500, seed=0):
+    """Make a uint16 raw frame and an int32 label frame with rectangular cells."""
+    rng = np.random.RandomState(seed)
+    raw = rng.poisson(lam=200, size=(height, width)).astype('uint16')
+    labels = np.zeros((height, width), dtype='int32')
+    for label in range(1, num_cells + 1):
+        y, x = rng.randint(0, height - 20), rng.randint(0, width - 20)
+        labels[y:y + 20, x:x + 20] = label
+    return raw, labels
+
+
+def benchmark(name, legacy, lut, number=10):
+    legacy_time = timeit.timeit(legacy, number=number) / number
+    lut_time = timeit.timeit(lut, number=number) / number
+    mismatches = int(np.count_nonzero((legacy() != lut()).any(axis=-1)))
+    print('{:<8} legacy {:>7.1f} ms  lut {:>7.1f} ms  {:>5.1f}x  pixels different: {}'.format(
+        name, legacy_time * 1000, lut_time * 1000, legacy_time / lut_time, mismatches))
+
+
+def main():
+    raw, labels = make_frames()
+    print('frames with shape {}'.format(raw.shape))
+    masked = np.ma.masked_equal(labels, 0)
+    benchmark('raw',
+              lambda: legacy_apply_colormap(raw, 0, None, 'cubehelix'),
+              lambda: apply_colormap(raw, 0, None, 'cubehelix'))
+    benchmark('labels',
+              lambda: legacy_apply_colormap(masked, 0, labels.max(), 'viridis', 'black'),
+              lambda: apply_colormap(masked, 0, labels.max(), 'viridis'))
+
+
+if __name__ == '__main__':
+    main()
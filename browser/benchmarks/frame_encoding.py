@@ -0,0 +1,61 @@
+"""
+Benchmark storing frames with NdarrayType against PickleType.
+
+Run from the browser folder with
+    python -m benchmarks.frame_encoding
+"""
+import pickle
+import timeit
+
+import numpy as np
+
+from models import NdarrayType
+
+
+def make_stacks(num_frames=40, height=512, width=512, num_cells=200, seed=0):
+    """
+    Make a raw and a label stack that look like our microscopy data:
+    smooth uint16 raw images and int32 labels with rectangular cells.
+    """
+    rng = np.random.RandomState(seed)
+    raw = rng.poisson(lam=200, size=(num_frames, height, width, 1)).astype('uint16')
+    labels = np.zeros((num_frames, height, width, 1), dtype='int32')
+    for label in range(1, num_cells + 1):
+        y, x = rng.randint(0, height - 20), rng.randint(0, width - 20)
+        first, last = sorted(rng.randint(0, num_frames, size=2))
+        labels[first:last + 1, y:y + 20, x:x + 20] = label
+    return raw, labels
+
+
+def benchmark(name, encode, decode, stack, number=3):
+    stored = [encode(frame) for frame in stack]
+    size = sum(len(blob) for blob in stored)
+    encode_time = timeit.timeit(lambda: [encode(frame) for frame in stack],
+                                number=number) / number
+    decode_time = timeit.timeit(lambda: [decode(blob) for blob in stored],
+                                number=number) / number
+    print('{:<24} {:>10.1f} MB {:>10.1f} ms {:>10.1f} ms'.format(
+        name, size / 1e6, encode_time * 1000, decode_time * 1000))
+
+
+def main():
+    raw, labels = make_stacks()
+    encodings = [
+        ('pickle', pickle.dumps, pickle.loads),
+    ]
+    for codec in NdarrayType.CODECS:
+        for writable in (False, True):
+            ndarray_type = NdarrayType(codec=codec, writable=writable)
+            name = '{} ({})'.format(codec, 'writable' if writable else 'read-only')
+            encodings.append((name, ndarray_type.encode, ndarray_type.decode))
+
+    for stack_name, stack in (('raw', raw), ('labels', labels)):
+        print('{} stack with shape {} and dtype {}'.format(stack_name, stack.shape, stack.dtype))
+        print('{:<24} {:>13} {:>13} {:>13}'.format('encoding', 'size', 'encode', 'decode'))
+        for name, encode, decode in encodings:
+            benchmark(name, encode, decode, stack)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Benchmark encoding rendered label and raw images in each image format.
+
+Run from the browser folder with
+    python -m benchmarks.image_encoding
+"""
+import io
+import timeit
+
+import numpy as np
+from PIL import Image
+
+from imgutils import apply_colormap, encode_png, encode_rgba, encode_webp
+
+
+def make_images(height=1024, width=1024, num_cells=500, seed=0):
+    """
+    Render a label image and a raw image like the ones sent to the front-end:
+    an int32 label frame with rectangular cells colored with viridis,
+    and a uint16 raw frame with bright cells on a noisy background colored with cubehelix.
+    """
+    rng = np.random.RandomState(seed)
+    labels = np.zeros((height, width), dtype='int32')
+    for label in range(1, num_cells + 1):
+        y, x = rng.randint(0, height - 20), rng.randint(0, width - 20)
+        labels[y:y + 20, x:x + 20] = label
+    raw = rng.poisson(lam=100, size=(height, width)) + 400 * (labels > 0)
+    label_image = apply_colormap(np.ma.masked_equal(labels, 0), 0, labels.max(), 'viridis')
+    raw_image = apply_colormap(raw.astype('uint16'), 0, None, 'cubehelix')
+    return {'labels': label_image, 'raw': raw_image}
+
+
+def legacy_encode(imgarr, out):
+    """Previous pngify encoding, with PIL's default PNG settings."""
+    Image.fromarray(imgarr).save(out, format='png')
+
+
+def main():
+    images = make_images()
+    encoders = [
+        ('png (PIL default)', legacy_encode),
+        ('png level 6', lambda imgarr, out: encode_png(imgarr, out, 6, 'default')),
+        ('png level 1', lambda imgarr, out: encode_png(imgarr, out, 1, 'default')),
+        ('png level 1 rle', lambda imgarr, out: encode_png(imgarr, out, 1, 'rle')),
+        ('png level 0', lambda imgarr, out: encode_png(imgarr, out, 0, 'default')),
+        ('webp method 0', lambda imgarr, out: encode_webp(imgarr, out, 0, 0)),
+        ('webp method 4', lambda imgarr, out: encode_webp(imgarr, out, 4, 80)),
+        ('rgba', encode_rgba),
+    ]
+    for name, imgarr in images.items():
+        print('{} image with shape {}'.format(name, imgarr.shape))
+        for encoder_name, encoder in encoders:
+            number = 5
+            timer = timeit.Timer(lambda: encoder(imgarr, io.BytesIO()))
+            seconds = min(timer.repeat(repeat=number, number=1))
+            out = io.BytesIO()
+            encoder(imgarr, out)
+            print('  {:<20} {:>8.1f} ms {:>10.1f} KB'.format(
+                encoder_name, seconds * 1000, len(out.getvalue()) / 1024))
+
+
+if __name__ == '__main__':
+    main()
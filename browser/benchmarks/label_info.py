@@ -0,0 +1,68 @@
+"""
+Benchmark computing the label metadata of a tracking stack
+in a single pass over the frames against checking every label in every frame.
+
+Run from the browser folder with
+    python -m benchmarks.label_info
+"""
+import timeit
+
+import numpy as np
+
+from labelmaker import LabelInfoMaker
+
+
+class LegacyLabelInfoMaker(LabelInfoMaker):
+    """Previous LabelInfoMaker, which searched each frame for each label."""
+
+    def compute_tracks(self):
+        cells = np.unique(self.labels)[np.nonzero(np.unique(self.labels))]
+        tracks = {}
+        for cell in cells:
+            cell = int(cell)
+            tracks[cell] = {'label': str(cell),
+                            'frames': [],
+                            'frame_div': None,
+                            'daughters': [],
+                            'capped': False,
+                            'parent': None}
+            for frame in range(self.labels.shape[0]):
+                if cell in self.labels[frame, ...]:
+                    tracks[cell]['frames'].append(int(frame))
+        self._cell_ids = {0: cells}
+        self._cell_info = {0: tracks}
+
+
+def make_tracks(num_frames=200, height=256, width=256, num_cells=1000, seed=0):
+    """
+    Make a label stack with num_cells tracked cells that each
+    live for a random span of frames and drift between frames.
+    """
+    rng = np.random.RandomState(seed)
+    labels = np.zeros((num_frames, height, width, 1), dtype='int32')
+    starts = rng.randint(0, num_frames, num_cells)
+    lengths = rng.randint(1, num_frames // 2, num_cells)
+    ys = rng.randint(0, height - 4, num_cells)
+    xs = rng.randint(0, width - 4, num_cells)
+    for cell in range(num_cells):
+        for frame in range(starts[cell], min(starts[cell] + lengths[cell], num_frames)):
+            y = int(np.clip(ys[cell] + rng.randint(-1, 2), 0, height - 4))
+            x = int(np.clip(xs[cell] + rng.randint(-1, 2), 0, width - 4))
+            labels[frame, y:y + 4, x:x + 4, 0] = cell + 1
+    return labels
+
+
+def main():
+    labels = make_tracks()
+    print('tracking stack with shape {} and {} cells'.format(labels.shape, labels.max()))
+    makers = [('legacy', LegacyLabelInfoMaker), ('single pass', LabelInfoMaker)]
+    results = {}
+    for name, maker in makers:
+        seconds = timeit.timeit(
+            lambda: results.__setitem__(name, maker(labels, tracking=True).cell_info), number=1)
+        print('  {:<12} {:>8.2f} s'.format(name, seconds))
+    print('  same tracks: {}'.format(results['legacy'] == results['single pass']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Benchmark computing the label metadata, stack-wide RGB percentiles and stored frames
+of a new project serially and with pools of threads and processes.
+
+Run from the browser folder with
+    python -m benchmarks.parallel_frames [workers]
+"""
+import os
+import sys
+import timeit
+from unittest import mock
+
+import numpy as np
+
+from labelmaker import LabelInfoMaker
+from models import LabelFrame, RawFrame, RGBFrame
+from parallel import map_frames
+
+
+def make_stack(num_frames=200, height=512, width=512, num_cells=1000, seed=0):
+    """Make a uint16 raw stack with two channels and an int32 label stack with square cells."""
+    rng = np.random.RandomState(seed)
+    raw = rng.poisson(lam=100, size=(num_frames, height, width, 2)).astype('uint16')
+    labels = np.zeros((num_frames, height, width, 1), dtype='int32')
+    for frame in labels:
+        ys = rng.randint(0, height - 8, num_cells)
+        xs = rng.randint(0, width - 8, num_cells)
+        for cell, (y, x) in enumerate(zip(ys, xs)):
+            frame[y:y + 8, x:x + 8] = cell + 1
+    return raw, labels
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+    raw, labels = make_stack()
+    print('raw stack with shape {} and label stack with shape {}, {} CPUs'.format(
+        raw.shape, labels.shape, os.cpu_count()))
+    tasks = [
+        ('label metadata', lambda: LabelInfoMaker(labels, tracking=True).cell_info),
+        ('rgb percentiles', lambda: RGBFrame.get_percentiles(raw)),
+        ('encode raw frames', lambda: list(map_frames(RawFrame.__table__.c.frame.type.encode,
+                                                      raw))),
+        ('encode label frames', lambda: list(map_frames(LabelFrame.__table__.c.frame.type.encode,
+                                                        labels))),
+    ]
+    for pool, pool_workers in [('serial', 1), ('thread', workers), ('process', workers)]:
+        print('{} with {} workers'.format(pool, pool_workers))
+        with mock.patch('parallel.FRAME_WORKERS', pool_workers), \
+                mock.patch('parallel.FRAME_POOL', 'thread' if pool == 'serial' else pool), \
+                mock.patch('parallel.FRAME_POOL_MIN_SIZE', 0):
+            for name, task in tasks:
+                seconds = timeit.timeit(task, number=1)
+                print('  {:<20} {:>8.2f} s'.format(name, seconds))
+
+
+if __name__ == '__main__':
+    main()
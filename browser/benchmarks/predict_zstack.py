@@ -0,0 +1,197 @@
+"""
+Benchmark predicting the labels of the next z-slice with the sparse IoU matcher
+against the previous pairwise IoU loop.
+
+Run from the browser folder with
+    python -m benchmarks.predict_zstack
+"""
+import timeit
+
+import numpy as np
+
+from benchmarks.relabel_stack import legacy_relabel_frame
+from label import predict_zstack_cell_ids
+
+
+def make_slices(height, width, num_cells, seed=0):
+    """
+    Make two label slices with square nuclei on a grid, where the nuclei
+    of the second slice are shifted, differently numbered and sometimes missing.
+    """
+    rng = np.random.RandomState(seed)
+    img = np.zeros((height, width), dtype='int32')
+    next_img = np.zeros((height, width), dtype='int32')
+    side = int(np.ceil(np.sqrt(num_cells)))
+    step_y, step_x = height // side, width // side
+    size = min(step_y, step_x) * 2 // 3
+    next_labels = rng.permutation(num_cells) + 1
+    for cell in range(num_cells):
+        y, x = (cell // side) * step_y, (cell % side) * step_x
+        img[y:y + size, x:x + size] = cell + 1
+        if rng.rand() < 0.95:
+            dy, dx = rng.randint(-2, 3, size=2)
+            y, x = max(y + dy, 0), max(x + dx, 0)
+            next_img[y:y + size, x:x + size] = next_labels[cell]
+    return img, next_img
+
+
+def legacy_predict_zstack_cell_ids(img, next_img, threshold=0.1):
+    """
+    Previous predict_zstack_cell_ids, with a full-frame IoU for every pair of cells.
+
+    Predict labels for next_img based on intersection over union (iou)
+    with img. If cells don't meet threshold for iou, they don't count as
+    matching enough to share label with "matching" cell in img. Cells
+    that don't have a match in img (new cells) get a new label so that
+    output relabeled_next does not skip label values (unless label values
+    present in prior image need to be skipped to avoid conflating labels).
+    """
+
+    # relabel to remove skipped values, keeps subsequent predictions cleaner
+    next_img = legacy_relabel_frame(next_img)
+
+    # create np array that can hold all pairings between cells in one
+    # image and cells in next image
+    iou = np.zeros((np.max(img) + 1, np.max(next_img) + 1))
+
+    vals = np.unique(img)
+    cells = vals[np.nonzero(vals)]
+
+    # nothing to predict off of
+    if len(cells) == 0:
+        return next_img
+
+    next_vals = np.unique(next_img)
+    next_cells = next_vals[np.nonzero(next_vals)]
+
+    # no values to reassign
+    if len(next_cells) == 0:
+        return next_img
+
+    # calculate IOUs
+    for i in cells:
+        for j in next_cells:
+            intersection = np.logical_and(img == i, next_img == j)
+            union = np.logical_or(img == i, next_img == j)
+            iou[i, j] = intersection.sum(axis=(0, 1)) / union.sum(axis=(0, 1))
+
+    # relabel cells appropriately
+
+    # relabeled_next holds cells as they get relabeled appropriately
+    relabeled_next = np.zeros(next_img.shape, dtype=np.uint16)
+
+    # max_indices[cell_from_next_img] -> cell from first image that matches it best
+    max_indices = np.argmax(iou, axis=0)
+
+    # put cells that into new image if they've been matched with another cell
+
+    # keep track of which (next_img)cells don't have matches
+    # this can be if (next_img)cell matched background, or if (next_img)cell matched
+    # a cell already used
+    unmatched_cells = []
+    # don't reuse cells (if multiple cells in next_img match one particular cell)
+    used_cells_src = []
+
+    # next_cell ranges between 0 and max(next_img)
+    # matched_cell is which cell in img matched next_cell the best
+
+    # this for loop does the matching between cells
+    for next_cell, matched_cell in enumerate(max_indices):
+        # if more than one match, look for best match
+        # otherwise the first match gets linked together, not necessarily reproducible
+
+        # matched_cell != 0 prevents adding the background to used_cells_src
+        if matched_cell != 0 and matched_cell not in used_cells_src:
+            bool_matches = np.where(max_indices == matched_cell)
+            count_matches = np.count_nonzero(bool_matches)
+            if count_matches > 1:
+                # for a given cell in img, which next_cell has highest iou
+                matching_next_options = np.argmax(iou, axis=1)
+                best_matched_next = matching_next_options[matched_cell]
+
+                # ignore if best_matched_next is the background
+                if best_matched_next != 0:
+                    if next_cell != best_matched_next:
+                        unmatched_cells = np.append(unmatched_cells, next_cell)
+                        continue
+                    else:
+                        # don't add if bad match
+                        if iou[matched_cell][best_matched_next] > threshold:
+                            relabeled_next = np.where(next_img == best_matched_next,
+                                                      matched_cell, relabeled_next)
+
+                        # if it's a bad match, we still need to add next_cell back
+                        # into relabeled next later
+                        elif iou[matched_cell][best_matched_next] <= threshold:
+                            unmatched_cells = np.append(unmatched_cells, best_matched_next)
+
+                        # in either case, we want to be done with the "matched_cell" from img
+                        used_cells_src = np.append(used_cells_src, matched_cell)
+
+            # matched_cell != 0 is still true
+            elif count_matches == 1:
+                # add the matched cell to the relabeled image
+                if iou[matched_cell][next_cell] > threshold:
+                    relabeled_next = np.where(next_img == next_cell, matched_cell, relabeled_next)
+                else:
+                    unmatched_cells = np.append(unmatched_cells, next_cell)
+
+                used_cells_src = np.append(used_cells_src, matched_cell)
+
+        elif matched_cell in used_cells_src and next_cell != 0:
+            # skip that pairing, add next_cell to unmatched_cells
+            unmatched_cells = np.append(unmatched_cells, next_cell)
+
+        # if the cell in next_img didn't match anything (and is not the background):
+        if matched_cell == 0 and next_cell != 0:
+            unmatched_cells = np.append(unmatched_cells, next_cell)
+            # note: this also puts skipped (nonexistent) labels into unmatched cells,
+            # main reason to relabel first
+
+    # figure out which labels we should use to label remaining, unmatched cells
+
+    # these are the values that have already been used in relabeled_next
+    relabeled_values = np.unique(relabeled_next)[np.nonzero(np.unique(relabeled_next))]
+
+    # to account for any new cells that appear, create labels by adding to the max number of cells
+    # assumes that these are new cells and that all prev labels have been assigned
+    # only make as many new labels as needed
+
+    current_max = max(np.max(cells), np.max(relabeled_values)) + 1
+
+    stringent_allowed = []
+    for additional_needed in range(len(unmatched_cells)):
+        stringent_allowed.append(current_max)
+        current_max += 1
+
+    # replace each unmatched cell with a value from the stringent_allowed list,
+    # add that relabeled cell to relabeled_next
+    if len(unmatched_cells) > 0:
+        for reassigned_cell in range(len(unmatched_cells)):
+            relabeled_next = np.where(next_img == unmatched_cells[reassigned_cell],
+                                      stringent_allowed[reassigned_cell], relabeled_next)
+
+    return relabeled_next
+
+
+def benchmark(name, predict, img, next_img, repeat=3):
+    result = []
+    seconds = min(timeit.repeat(lambda: result.append(predict(img, next_img)),
+                                repeat=repeat, number=1))
+    print('  {:<10} {:>10.1f} ms'.format(name, seconds * 1000))
+    return result[-1]
+
+
+def main():
+    for height, width, num_cells, legacy in [(256, 256, 64, True), (512, 512, 150, True),
+                                             (1024, 1024, 500, False)]:
+        img, next_img = make_slices(height, width, num_cells)
+        print('slices with shape {} and {} cells'.format(img.shape, num_cells))
+        predicted = benchmark('sparse', predict_zstack_cell_ids, img, next_img)
+        if legacy:
+            expected = benchmark('legacy', legacy_predict_zstack_cell_ids, img, next_img, repeat=1)
+            print('  pixels different: {}'.format(np.count_nonzero(predicted != expected)))
+
+
+if __name__ == '__main__':
+    main()
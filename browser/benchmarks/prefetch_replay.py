@@ -0,0 +1,81 @@
+"""
+Benchmark scrubbing through a project frame by frame,
+with and without rendering the neighbouring frames in the background.
+
+Replays the requests the front-end makes for each frame:
+the frame change, then the raw and label images it links to.
+
+Run from the browser folder with
+    python -m benchmarks.prefetch_replay
+"""
+import os
+import tempfile
+import time
+import timeit
+
+import numpy as np
+
+from application import create_app
+from benchmarks.frame_encoding import make_stacks
+from loaders import Loader
+import models
+import prefetch
+
+
+class StackLoader(Loader):
+    """Loads a project from arrays in memory."""
+
+    def __init__(self, raw, labels):
+        super().__init__()
+        self._raw_array = raw
+        self._label_array = labels
+        self.path = 'benchmark.npz'
+        self.source = 'lfs'
+
+
+def replay(app, token, num_frames, think_time):
+    """
+    Changes to each frame in order like an annotator scrubbing through the project.
+
+    Returns:
+        list: seconds to load each frame
+    """
+    client = app.test_client()
+    latencies = []
+    for frame in range(1, num_frames):
+        start = timeit.default_timer()
+        payload = client.post(f'/api/changedisplay/{token}/frame/{frame}').json
+        client.get(payload['imgs']['raw'])
+        client.get(payload['imgs']['segmented'])
+        latencies.append(timeit.default_timer() - start)
+        # Time the annotator spends looking at the frame
+        time.sleep(think_time)
+    return latencies
+
+
+def main(num_frames=30, think_time=0.2):
+    raw, labels = make_stacks(num_frames=num_frames)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        uri = 'sqlite:///{}'.format(os.path.join(tmpdir, 'benchmark.db'))
+        print('replaying {} frames with shape {}, {} ms between frames'.format(
+            num_frames, raw.shape[1:], int(think_time * 1000)))
+        print('{:<24} {:>12} {:>12}'.format('prefetch', 'median', '90th pct'))
+        for distance in (0, 1, 2):
+            app = create_app(SQLALCHEMY_DATABASE_URI=uri, PREFETCH_FRAMES=distance)
+            with app.app_context():
+                project = models.Project.create(StackLoader(raw, labels))
+                token = project.token
+                # Start every run from a new worker with empty caches
+                models.project_cache.clear()
+                models.render_cache.clear()
+                latencies = replay(app, token, num_frames, think_time)
+                prefetch.executor.shutdown(wait=True)
+                prefetch.executor = prefetch.ThreadPoolExecutor(
+                    max_workers=prefetch.PREFETCH_WORKERS)
+            name = '{} frames'.format(distance) if distance else 'disabled'
+            print('{:<24} {:>9.1f} ms {:>9.1f} ms'.format(
+                name, np.median(latencies) * 1000, np.percentile(latencies, 90) * 1000))
+
+
+if __name__ == '__main__':
+    main()
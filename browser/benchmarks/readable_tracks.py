@@ -0,0 +1,68 @@
+"""
+Benchmark making and serializing the label tracks sent after an action
+in a large tracking project: all the tracks as before, all the tracks
+without a deep copy, and only the tracks changed by the action.
+
+Run from the browser folder with
+    python -m benchmarks.readable_tracks
+"""
+import copy
+import json
+import timeit
+
+import numpy as np
+
+from models import Labels
+
+
+def consecutive(data, stepsize=1):
+    """Previous helper that split the frames of a label into runs."""
+    return np.split(data, np.where(np.diff(data) != stepsize)[0] + 1)
+
+
+def legacy_readable_tracks(cell_info):
+    """Previous Labels.readable_tracks, with a deep copy and np.split for each label."""
+    cell_info = copy.deepcopy(cell_info)
+    for _, feature in cell_info.items():
+        for _, label in feature.items():
+            slices = list(map(list, consecutive(label['frames'])))
+            slices = '[' + ', '.join(["{}".format(a[0])
+                                      if len(a) == 1 else "{}-{}".format(a[0], a[-1])
+                                      for a in slices]) + ']'
+            label['slices'] = str(slices)
+    return cell_info
+
+
+def make_labels(num_cells=3000, num_frames=100, seed=0):
+    """Make the labels of a tracking project with cells that each appear in a run of frames."""
+    rng = np.random.RandomState(seed)
+    tracks = {}
+    for label in range(1, num_cells + 1):
+        start = int(rng.randint(0, num_frames - 10))
+        stop = int(rng.randint(start + 1, num_frames))
+        tracks[label] = {'label': label, 'frames': list(range(start, stop)),
+                         'frame_div': None, 'daughters': [], 'capped': False, 'parent': None}
+    labels = Labels()
+    labels.cell_info = {0: tracks}
+    labels.cell_ids = {0: np.array(sorted(tracks))}
+    labels._saved = labels._get_cell_states()
+    return labels
+
+
+def main():
+    labels = make_labels()
+    # An action that removes one cell from a frame
+    labels.cell_info[0][1]['frames'] = labels.cell_info[0][1]['frames'][1:]
+    number = 5
+    print('tracking project with {} cells'.format(len(labels.cell_info[0])))
+    for name, make in [
+            ('deep copy (legacy)', lambda: legacy_readable_tracks(labels.cell_info)),
+            ('readable_tracks', lambda: labels.readable_tracks),
+            ('readable_changes', lambda: labels.readable_changes)]:
+        seconds = min(timeit.repeat(lambda: json.dumps(make()), repeat=number, number=1))
+        size = len(json.dumps(make()))
+        print('  {:<20} {:>8.1f} ms {:>10.1f} KB'.format(name, seconds * 1000, size / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Benchmark relabeling frames and stacks with a lookup table
+against the previous loop over every label.
+
+Run from the browser folder with
+    python -m benchmarks.relabel_stack
+"""
+import timeit
+
+import numpy as np
+
+from label import relabel_frame
+
+
+def legacy_relabel_frame(img, start_val=1):
+    """Previous relabel_frame, with a full-frame np.where for every label."""
+    cell_list = np.unique(img)
+    cell_list = cell_list[np.nonzero(cell_list)]
+
+    relabeled_cell_list = range(start_val, len(cell_list) + start_val)
+
+    relabeled_img = np.zeros(img.shape, dtype=np.uint16)
+    for i, cell in enumerate(cell_list):
+        relabeled_img = np.where(img == cell, relabeled_cell_list[i], relabeled_img)
+
+    return relabeled_img
+
+
+def make_stack(num_frames, height, width, num_cells, seed=0):
+    """Make an int32 label stack with square cells and sparse labels in every frame."""
+    rng = np.random.RandomState(seed)
+    stack = np.zeros((num_frames, height, width), dtype='int32')
+    for frame in stack:
+        labels = rng.choice(100 * num_cells, num_cells, replace=False) + 1
+        ys = rng.randint(0, height - 10, num_cells)
+        xs = rng.randint(0, width - 10, num_cells)
+        for label, y, x in zip(labels, ys, xs):
+            frame[y:y + 10, x:x + 10] = label
+    return stack
+
+
+def main():
+    num_frames, num_cells = 100, 2000
+    stack = make_stack(num_frames, 512, 512, num_cells)
+    print('stack with shape {} and {} cells per frame'.format(stack.shape, num_cells))
+
+    legacy_seconds = timeit.timeit(lambda: legacy_relabel_frame(stack[0]), number=1)
+    seconds = min(timeit.repeat(lambda: relabel_frame(stack[0]), repeat=5, number=1))
+    mismatches = np.count_nonzero(legacy_relabel_frame(stack[0]) != relabel_frame(stack[0]))
+    print('  one frame    legacy {:>8.1f} ms  lookup {:>6.1f} ms  pixels different: {}'.format(
+        legacy_seconds * 1000, seconds * 1000, mismatches))
+
+    seconds = timeit.timeit(lambda: [relabel_frame(frame) for frame in stack], number=1)
+    print('  each frame   legacy {:>8.1f} s (estimated)  lookup {:>6.2f} s'.format(
+        legacy_seconds * num_frames, seconds))
+    seconds = timeit.timeit(lambda: relabel_frame(stack), number=1)
+    print('  whole stack  lookup {:>6.2f} s'.format(seconds))
+
+
+if __name__ == '__main__':
+    main()
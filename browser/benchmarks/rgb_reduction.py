@@ -0,0 +1,85 @@
+"""
+Benchmark reducing multi-channel raw frames to RGB frames
+against the per-channel implementation it replaced.
+
+Run from the browser folder with
+    python -m benchmarks.rgb_reduction
+"""
+import timeit
+
+import numpy as np
+from skimage.exposure import rescale_intensity
+
+from models import RGBFrame
+
+
+def legacy_reduce_to_RGB(frame):
+    """Previous RGBFrame.reduce_to_RGB, with np.percentile on each channel."""
+    rescaled = np.zeros(frame.shape, dtype='uint8')
+    for channel in range(min(6, frame.shape[-1])):
+        raw_channel = frame[..., channel]
+        if np.sum(raw_channel) != 0:
+            percentiles = np.percentile(raw_channel[raw_channel > 0], [5, 95])
+            rescaled_channel = rescale_intensity(raw_channel,
+                                                 in_range=(percentiles[0], percentiles[1]),
+                                                 out_range='uint8')
+            rescaled[..., channel] = rescaled_channel.astype('uint8')
+    rgb_img = np.zeros((frame.shape[0], frame.shape[1], 3), dtype='uint16')
+    for c in range(min(6, frame.shape[-1])):
+        new_channel = (rescaled[..., c]).astype('uint16')
+        if c < 3:
+            rgb_img[..., c] = new_channel
+        if c == 3:
+            rgb_img[..., 1] += new_channel
+            rgb_img[..., 2] += new_channel
+        if c == 4:
+            rgb_img[..., 0] += new_channel
+            rgb_img[..., 2] += new_channel
+        if c == 5:
+            rgb_img[..., 0] += new_channel
+            rgb_img[..., 1] += new_channel
+        rgb_img[..., 0:3] = np.clip(rgb_img[..., 0:3], a_min=0, a_max=255)
+    return rgb_img.astype('uint8')
+
+
+def make_stack(num_frames=50, height=1024, width=1024, num_channels=6, seed=0):
+    """Make a uint16 raw stack with a different brightness in each channel."""
+    rng = np.random.RandomState(seed)
+    lam = rng.randint(50, 2000, size=num_channels)
+    return rng.poisson(lam=lam, size=(num_frames, height, width, num_channels)).astype('uint16')
+
+
+def main():
+    stack = make_stack()
+    print('raw stack with shape {} and dtype {}'.format(stack.shape, stack.dtype))
+    rgb_frame = RGBFrame.__new__(RGBFrame)
+
+    start = timeit.default_timer()
+    legacy = [legacy_reduce_to_RGB(frame) for frame in stack]
+    legacy_time = timeit.default_timer() - start
+
+    start = timeit.default_timer()
+    vectorized = [rgb_frame.reduce_to_RGB(frame) for frame in stack]
+    vectorized_time = timeit.default_timer() - start
+
+    start = timeit.default_timer()
+    percentiles = RGBFrame.get_percentiles(stack)
+    percentiles_time = timeit.default_timer() - start
+
+    start = timeit.default_timer()
+    stack_wide = [rgb_frame.reduce_to_RGB(frame, percentiles) for frame in stack]
+    stack_time = timeit.default_timer() - start
+
+    mismatches = sum(int(np.count_nonzero(a != b)) for a, b in zip(legacy, vectorized))
+    print('{:<28} {:>10.1f} ms/frame'.format('legacy', legacy_time * 1000 / len(stack)))
+    print('{:<28} {:>10.1f} ms/frame'.format('vectorized', vectorized_time * 1000 / len(stack)))
+    print('{:<28} {:>10.1f} ms/frame'.format('vectorized (stack-wide)',
+                                             stack_time * 1000 / len(stack)))
+    print('{:<28} {:>10.1f} ms'.format('stack-wide percentiles', percentiles_time * 1000))
+    print('pixels different from legacy: {}'.format(mismatches))
+    print('pixels changed by stack-wide percentiles: {}'.format(
+        sum(int(np.count_nonzero(a != b)) for a, b in zip(vectorized, stack_wide))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Benchmark showing a large frame from a tile pyramid
+against rendering the whole frame at full resolution.
+
+Run from the browser folder with
+    python -m benchmarks.tile_pyramid
+"""
+import timeit
+
+import numpy as np
+
+from imgutils import count_pyramid_levels, downsample, render_image
+
+
+def make_frame(size=8192, seed=0):
+    """Make a uint16 raw frame with bright square cells on a noisy background."""
+    rng = np.random.RandomState(seed)
+    raw = rng.poisson(lam=100, size=(size, size)).astype('uint16')
+    for _ in range(2000):
+        y, x = rng.randint(0, size - 40, size=2)
+        raw[y:y + 40, x:x + 40] += 400
+    return raw
+
+
+def build_pyramid(raw, tile_size):
+    """Downsample the frame into every level of its pyramid."""
+    levels = [raw]
+    for _ in range(1, count_pyramid_levels(*raw.shape, tile_size)):
+        levels.append(downsample(levels[-1]))
+    return levels
+
+
+def render_tiles(image, tile_size, vmax, rows, cols):
+    """Render the tiles of a level in a range of rows and columns."""
+    for row in rows:
+        for col in cols:
+            tile = image[row * tile_size:(row + 1) * tile_size,
+                         col * tile_size:(col + 1) * tile_size]
+            render_image(tile, vmin=0, vmax=vmax, cmap='cubehelix')
+
+
+def main(tile_size=256):
+    raw = make_frame()
+    vmax = int(raw.max())
+    print('frame with shape {} and {}px tiles'.format(raw.shape, tile_size))
+
+    seconds = min(timeit.repeat(lambda: render_image(raw, vmin=0, vmax=vmax, cmap='cubehelix'),
+                                repeat=3, number=1))
+    print('{:<40} {:>8.1f} ms'.format('whole frame at full resolution', seconds * 1000))
+
+    seconds = min(timeit.repeat(lambda: build_pyramid(raw, tile_size), repeat=3, number=1))
+    levels = build_pyramid(raw, tile_size)
+    print('{:<40} {:>8.1f} ms'.format('build {} levels'.format(len(levels)), seconds * 1000))
+
+    # A 1024x1024 screen showing the whole frame, then zoomed in to full resolution
+    top = levels[-3]
+    seconds = min(timeit.repeat(
+        lambda: render_tiles(top, tile_size, vmax, range(4), range(4)), repeat=3, number=1))
+    print('{:<40} {:>8.1f} ms'.format('zoomed out viewport (16 tiles)', seconds * 1000))
+    seconds = min(timeit.repeat(
+        lambda: render_tiles(raw, tile_size, vmax, range(10, 14), range(10, 14)),
+        repeat=3, number=1))
+    print('{:<40} {:>8.1f} ms'.format('full resolution viewport (16 tiles)', seconds * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -21,14 +21,19 @@ from flask import current_app
 from flask import send_file
 from werkzeug.exceptions import HTTPException
 
+from imgutils import IMAGE_MIMETYPES
 from label import TrackEdit, ZStackEdit, BaseEdit, ChangeDisplay
-from models import Project
+from models import Project, project_cache, render_cache
+from prefetch import prefetch_frames
 import loaders
 import exporters
 from config import S3_INPUT_BUCKET, S3_OUTPUT_BUCKET
 
 bp = Blueprint('label', __name__)  # pylint: disable=C0103
 
+# Raw images never change, so browsers can keep them for a day without asking again
+RAW_IMAGE_MAX_AGE = 24 * 60 * 60
+
 
 @bp.route('/health')
 def health():
@@ -36,6 +41,15 @@ def health():
     return jsonify({'message': 'success'}), 200
 
 
+@bp.route('/api/caches')
+def cache_stats():
+    """Returns the memory use and hit counts of the caches in this worker process."""
+    return jsonify({
+        'project_cache': project_cache.stats(),
+        'render_cache': render_cache.stats(),
+    })
+
+
 @bp.errorhandler(404)
 def handle_404(error):
     return render_template('404.html'), 404
@@ -77,14 +91,17 @@ def edit(token, action_type):
     # Frame is instead tracked by the frame column in the State column
     if 'frame' in info:
         del info['frame']
+    # Project version of the tracks that the front-end has
+    known_version = info.pop('version', None)
 
     project = Project.get(token)
     if not project:
         return abort(404, description=f'project {token} not found')
     edit = get_edit(project)
-    payload = edit.dispatch_action(action_type, info)
+    payload = edit.dispatch_action(action_type, info, known_version)
     project.create_memento(action_type)
     project.update()
+    payload['version'] = project.version
 
     current_app.logger.debug('Finished action %s for project %s in %s s.',
                              action_type, token,
@@ -115,6 +132,7 @@ def change_display(token, display_attribute, value):
     change = ChangeDisplay(project)
     payload = change.change(display_attribute, value)
     project.update()
+    prefetch_frames(project)
 
     current_app.logger.debug('Changed to %s %s for project %s in %s s.',
                              display_attribute, value, token,
@@ -129,7 +147,7 @@ def undo(token):
     project = Project.get(token)
     if not project:
         return abort(404, description=f'project {token} not found')
-    payload = project.undo()
+    payload = project.undo(request.values.get('version', type=int))
 
     current_app.logger.debug('Undid action for project %s finished in %s s.',
                              token, timeit.default_timer() - start)
@@ -143,13 +161,140 @@ def redo(token):
     project = Project.get(token)
     if not project:
         return abort(404, description=f'project {token} not found')
-    payload = project.redo()
+    payload = project.redo(request.values.get('version', type=int))
 
     current_app.logger.debug('Redid action for project %s finished in %s s.',
                              token, timeit.default_timer() - start)
     return jsonify(payload)
 
 
+@bp.route('/api/image/<token>/raw/<int:frame>/<int:channel>.png')
+def raw_image(token, frame, channel):
+    """
+    Send a channel of a raw frame as an image.
+    Raw frames never change, so browsers reuse the image for the whole project.
+    """
+    start = timeit.default_timer()
+    image_format = get_image_format()
+    etag = f'{token}-raw-{frame}-{channel}-{image_format}'
+    if request.if_none_match.contains(etag):
+        return make_image_response(etag, None, image_format, max_age=RAW_IMAGE_MAX_AGE)
+
+    project = Project.get(token)
+    if not project:
+        return abort(404, description=f'project {token} not found')
+    if not 0 <= frame < project.num_frames or not 0 <= channel < project.num_channels:
+        return abort(404, description=f'frame {frame} channel {channel} not found')
+    response = make_image_response(etag, project.get_raw_image(frame, channel, image_format),
+                                   image_format, max_age=RAW_IMAGE_MAX_AGE)
+
+    current_app.logger.debug('Sent raw image %s %s for project %s in %s s.',
+                             frame, channel, token, timeit.default_timer() - start)
+    return response
+
+
+@bp.route('/api/image/<token>/rgb/<int:frame>.png')
+def rgb_image(token, frame):
+    """
+    Send a raw frame with its channels mixed into RGB as an image.
+    """
+    start = timeit.default_timer()
+    image_format = get_image_format()
+    etag = f'{token}-rgb-{frame}-{image_format}'
+    if request.if_none_match.contains(etag):
+        return make_image_response(etag, None, image_format, max_age=RAW_IMAGE_MAX_AGE)
+
+    project = Project.get(token)
+    if not project:
+        return abort(404, description=f'project {token} not found')
+    if not 0 <= frame < project.num_frames:
+        return abort(404, description=f'frame {frame} not found')
+    response = make_image_response(etag, project.get_rgb_image(frame, image_format),
+                                   image_format, max_age=RAW_IMAGE_MAX_AGE)
+    # Save the RGB frame if it was created for this image
+    project.commit_rgb_frames()
+
+    current_app.logger.debug('Sent RGB image %s for project %s in %s s.',
+                             frame, token, timeit.default_timer() - start)
+    return response
+
+
+@bp.route('/api/image/<token>/labels/<int:frame>/<int:feature>.png')
+def label_image(token, frame, feature):
+    """
+    Send a feature of a label frame as an image.
+    The ETag changes when the image changes, so browsers revalidate the image
+    and only download it again after an edit.
+    """
+    start = timeit.default_timer()
+    image_format = get_image_format()
+    project = Project.get(token)
+    if not project:
+        return abort(404, description=f'project {token} not found')
+    if not 0 <= feature < project.num_features:
+        return abort(404, description=f'feature {feature} not found')
+    version = project.get_label_image_version(frame, feature)
+    if version is None:
+        return abort(404, description=f'frame {frame} not found')
+    etag = f'{token}-labels-{frame}-{feature}-{version}-{image_format}'
+    if request.if_none_match.contains(etag):
+        return make_image_response(etag, None, image_format)
+    response = make_image_response(etag, project.get_label_image(frame, feature, image_format),
+                                   image_format)
+
+    current_app.logger.debug('Sent label image %s %s for project %s in %s s.',
+                             frame, feature, token, timeit.default_timer() - start)
+    return response
+
+
+@bp.route('/api/tiles/<token>/raw/<int:frame>/<int:channel>/<int:level>/<int:row>/<int:col>.png')
+def raw_tile(token, frame, channel, level, row, col):
+    """
+    Send a tile of the image pyramid of a channel of a raw frame.
+    Raw frames never change, so browsers reuse the tile for the whole project.
+    """
+    return make_tile_response(token, 'raw', frame, channel, level, row, col)
+
+
+@bp.route('/api/tiles/<token>/rgb/<int:frame>/<int:level>/<int:row>/<int:col>.png')
+def rgb_tile(token, frame, level, row, col):
+    """
+    Send a tile of the image pyramid of a raw frame with its channels mixed into RGB.
+    """
+    return make_tile_response(token, 'rgb', frame, 0, level, row, col)
+
+
+@bp.route('/api/tiles/<token>/labels/<int:frame>/<int:feature>/<int:level>/<int:row>/<int:col>.png')
+def label_tile(token, frame, feature, level, row, col):
+    """
+    Send a tile of the image pyramid of a feature of a label frame.
+    The ETag changes when the label image changes, like the ETag of the whole image.
+    """
+    return make_tile_response(token, 'labels', frame, feature, level, row, col)
+
+
+@bp.route('/api/tiles/<token>/<int:frame>')
+def viewport_tiles(token, frame):
+    """
+    List the tiles of the displayed raw and label images that cover a viewport.
+    The viewport is given in full resolution pixels by the x, y, width and height arguments,
+    and the scale argument is the number of screen pixels for each full resolution pixel.
+    """
+    project = Project.get(token)
+    if not project:
+        return abort(404, description=f'project {token} not found')
+    if not 0 <= frame < project.num_frames:
+        return abort(404, description=f'frame {frame} not found')
+    x = request.args.get('x', default=0, type=int)
+    y = request.args.get('y', default=0, type=int)
+    width = request.args.get('width', default=project.width, type=int)
+    height = request.args.get('height', default=project.height, type=int)
+    scale = request.args.get('scale', default=1, type=float)
+    if scale <= 0 or width < 0 or height < 0:
+        return abort(400, description='viewport must have a positive scale and size')
+    return jsonify(project.get_viewport_tiles(frame, x, y, width, height, scale))
+
+
 @bp.route('/', methods=['GET', 'POST'])
 def form():
     """Request HTML landing page to be rendered."""
@@ -215,10 +360,11 @@ def get_project(token):
     rgb = request.args.get('rgb', default='false', type=str)
     rgb = bool(distutils.util.strtobool(rgb))
     project.rgb = rgb
-    project.update()
     payload = project.make_first_payload()
+    project.update()
+    prefetch_frames(project)
     current_app.logger.debug('Loaded project %s in %s s.',
-                             project.token, timeit.default_timer() - start)
+                             token, timeit.default_timer() - start)
     return jsonify(payload)
 
 
@@ -298,6 +444,110 @@ def upload_project_to_s3(bucket, token):
     return redirect('/')
 
 
+def get_image_format():
+    """
+    Chooses the format of an image from the IMAGE_FORMATS setting and the Accept header.
+    Formats other than PNG are only sent when the client lists their mimetype,
+    as browsers accept any type with */* even if they cannot show it.
+
+    Returns:
+        str: the first format in IMAGE_FORMATS the client accepts, or 'png'
+    """
+    accepted = {mimetype for mimetype, quality in request.accept_mimetypes if quality > 0}
+    for image_format in current_app.config['IMAGE_FORMATS']:
+        if image_format == 'png' or IMAGE_MIMETYPES[image_format] in accepted:
+            return image_format
+    return 'png'
+
+
+def make_image_response(etag, image, image_format='png', max_age=None):
+    """
+    Makes a response for a cacheable image.
+
+    Args:
+        etag (str): identifies the image; changes whenever the image changes
+        image (BytesIO): the image, or None when the client already has it
+        image_format (str): format of the image in IMAGE_MIMETYPES
+        max_age (int): seconds that browsers can use the image without revalidating it;
+                       browsers revalidate the image every time when None
+
+    Returns:
+        Response: the image, or an empty 304 response when image is None
+    """
+    if image is None:
+        response = current_app.response_class(status=304)
+    else:
+        response = current_app.response_class(image.getvalue(),
+                                              mimetype=IMAGE_MIMETYPES[image_format])
+    response.set_etag(etag)
+    # The format depends on the Accept header
+    response.vary.add('Accept')
+    response.cache_control.private = True
+    if max_age is None:
+        response.cache_control.no_cache = True
+    else:
+        response.cache_control.max_age = max_age
+    return response
+
+
+def make_tile_response(token, layer, frame, index, level, row, col):
+    """
+    Makes a response for a tile of the image pyramid of a frame.
+
+    Args:
+        token (str): token of the project
+        layer (str): 'raw', 'rgb' or 'labels'
+        frame (int): index of the frame
+        index (int): channel of raw frames or feature of label frames; 0 for RGB
+        level (int): level of the image pyramid, 0 for full resolution
+        row (int): row of the tile in the level
+        col (int): column of the tile in the level
+
+    Returns:
+        Response: the tile, an empty 304 response when the client already has it,
+                  or a 404 response when the project or the tile does not exist
+    """
+    start = timeit.default_timer()
+    image_format = get_image_format()
+    name = f'{token}-{layer}-tile-{frame}-{index}-{level}-{row}-{col}'
+    # Raw tiles never change, so they are checked before loading the project
+    if layer != 'labels' and request.if_none_match.contains(f'{name}-{image_format}'):
+        return make_image_response(f'{name}-{image_format}', None, image_format,
+                                   max_age=RAW_IMAGE_MAX_AGE)
+
+    project = Project.get(token)
+    if not project:
+        return abort(404, description=f'project {token} not found')
+    num_indices = project.num_features if layer == 'labels' else project.num_channels
+    if not 0 <= frame < project.num_frames or not 0 <= index < num_indices:
+        return abort(404, description=f'frame {frame} {layer} {index} not found')
+    grid = project.get_tile_grid(level)
+    if grid is None or not 0 <= row < grid[0] or not 0 <= col < grid[1]:
+        return abort(404, description=f'tile {row} {col} of level {level} not found')
+
+    if layer == 'labels':
+        version = project.get_label_image_version(frame, index)
+        etag = f'{name}-{version}-{image_format}'
+        if request.if_none_match.contains(etag):
+            return make_image_response(etag, None, image_format)
+        response = make_image_response(
+            etag, project.get_tile_image(layer, frame, index, level, row, col, image_format),
+            image_format)
+    else:
+        etag = f'{name}-{image_format}'
+        response = make_image_response(
+            etag, project.get_tile_image(layer, frame, index, level, row, col, image_format),
+            image_format, max_age=RAW_IMAGE_MAX_AGE)
+    if layer == 'rgb':
+        # Save the RGB frame if it was created for this tile
+        project.commit_rgb_frames()
+
+    current_app.logger.debug('Sent %s tile %s %s %s of frame %s for project %s in %s s.',
+                             layer, level, row, col, frame, token,
+                             timeit.default_timer() - start)
+    return response
+
+
 def get_edit(project):
     """Factory for Edit objects"""
     if project.is_track:
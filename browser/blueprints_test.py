@@ -29,6 +29,18 @@ def test_health(client):
     assert response.json.get('message') == 'success'
 
 
+def test_cache_stats(client):
+    project = models.Project.create(DummyLoader())
+    client.get(f'/api/image/{project.token}/raw/0/0.png')
+
+    response = client.get('/api/caches')
+
+    assert response.status_code == 200
+    assert response.json['render_cache']['size'] == 1
+    assert response.json['render_cache']['misses'] >= 1
+    assert 'hits' in response.json['project_cache']
+
+
 def test_change_display(client):
 
     response = client.post('/api/changedisplay/0/frame/999999')
@@ -62,6 +74,80 @@ def test_edit(client):
     pass
 
 
+def test_edit_track_changes(client):
+    project = models.Project.create(DummyLoader(labels=np.ones((2, 4, 4, 1))))
+    token = project.token
+    version = client.get(f'/api/project/{token}').json['version']
+
+    response = client.post(f'/api/edit/{token}/delete_mask', data={'label': 1, 'version': version})
+
+    assert response.status_code == 200
+    payload = response.json
+    assert payload['version'] == version + 1
+    assert payload['tracks'] is False
+    assert payload['trackChanges'] == {'0': {'1': {'label': '1', 'frames': [1], 'slices': '[1]'}}}
+
+    # Editing from an older version sends all the tracks
+    response = client.post(f'/api/edit/{token}/delete_mask', data={'label': 1, 'version': version})
+    payload = response.json
+    assert payload['version'] == version + 2
+    assert 'trackChanges' not in payload
+    assert payload['tracks'] == {'0': {'1': {'label': '1', 'frames': [1], 'slices': '[1]'}}}
+
+
+def test_undo_redo_predict_zstack(client, db_session):
+    """Undo and redo restore both the frames and the labels edited across the stack."""
+    labels = np.array([1, 4, 9]).reshape((3, 1, 1, 1)) * np.ones((3, 2, 2, 1), dtype='int32')
+    project = models.Project.create(DummyLoader(labels=labels))
+    token = project.token
+
+    def saved_state():
+        db_session.expire_all()
+        project = models.Project.get(token)
+        # Read the labels again like a new request
+        project.labels.init_on_load()
+        return project.label_array[:, 0, 0, 0].tolist(), sorted(project.labels.cell_info[0])
+
+    response = client.post(f'/api/edit/{token}/predict_zstack', data={})
+    assert response.status_code == 200
+    assert saved_state() == ([1, 1, 1], [1])
+
+    response = client.post(f'/api/undo/{token}')
+    assert response.status_code == 200
+    assert saved_state() == ([1, 4, 9], [1, 4, 9])
+
+    response = client.post(f'/api/redo/{token}')
+    assert response.status_code == 200
+    assert saved_state() == ([1, 1, 1], [1])
+
+
+def test_edit_reads_only_current_frame(client, db_session, query_counter, frame_reads):
+    # Label i + 1 in frame i
+    labels = np.arange(1, 5).reshape((4, 1, 1, 1)) * np.ones((4, 8, 8, 1), dtype='int32')
+    project = models.Project.create(DummyLoader(labels=labels))
+    project.frame = 2
+    project.update()
+    token = project.token
+    # Read frames from the database like a new worker
+    models.project_cache.clear()
+    db_session.expire_all()
+
+    with query_counter() as counter:
+        response = client.post(f'/api/edit/{token}/delete_mask', data={'label': 3})
+
+    assert response.status_code == 200
+    assert len(frame_reads.arrays) == 1
+    np.testing.assert_array_equal(frame_reads.arrays[0], labels[2])
+    assert frame_reads.nbytes == len(models.NdarrayType().encode(labels[2]))
+    assert not any('FROM rawframes' in select or 'FROM rgbframes' in select
+                   for select in counter.selects)
+    label_selects = [select for select in counter.selects if 'FROM labelframes' in select]
+    # The frame, then its version increased by the edit
+    assert len(label_selects) == 2
+    assert all('labelframes.frame_id = ?' in select for select in label_selects)
+    assert 'SELECT labelframes.version' in label_selects[1]
+
+
 def test_tool(client):
     # test no form redirect
     response = client.get('/tool')
@@ -136,6 +222,114 @@ def test_redo(client):
     assert response.status_code == 200
 
 
+def test_raw_image(client):
+    project = models.Project.create(DummyLoader(raw=np.ones((2, 4, 4, 2))))
+    url = f'/api/image/{project.token}/raw/1/1.png'
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+    etag, _ = response.get_etag()
+    assert response.cache_control.max_age > 0
+
+    response = client.get(url, headers={'If-None-Match': f'"{etag}"'})
+    assert response.status_code == 304
+    assert response.data == b''
+
+    response = client.get(f'/api/image/{project.token}/raw/2/0.png')
+    assert response.status_code == 404
+    response = client.get(f'/api/image/{project.token}/rgb/0.png')
+    assert response.status_code == 200
+
+
+def test_label_image(client):
+    project = models.Project.create(DummyLoader(labels=np.ones((2, 4, 4, 1))))
+    token = project.token
+    url = f'/api/image/{token}/labels/0/0.png'
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+    assert response.cache_control.no_cache
+    etag, _ = response.get_etag()
+    response = client.get(url, headers={'If-None-Match': f'"{etag}"'})
+    assert response.status_code == 304
+
+    # Editing the frame changes the image
+    client.post(f'/api/edit/{token}/delete_mask', data={'label': 1})
+    response = client.get(url, headers={'If-None-Match': f'"{etag}"'})
+    assert response.status_code == 200
+    assert response.get_etag()[0] != etag
+    assert client.get(f'/api/image/{token}/labels/2/0.png').status_code == 404
+
+
+@pytest.mark.parametrize('formats,accept,expected', [
+    (['png'], 'image/webp,*/*', 'image/png'),
+    (['webp', 'png'], 'image/webp,*/*', 'image/webp'),
+    (['webp', 'png'], '*/*', 'image/png'),
+    (['rgba', 'webp'], 'image/webp,image/*', 'image/webp'),
+    (['rgba', 'png'], 'application/x-rgba', 'application/x-rgba'),
+])
+def test_image_format(app, client, mocker, formats, accept, expected):
+    mocker.patch.dict(app.config, {'IMAGE_FORMATS': formats})
+    project = models.Project.create(DummyLoader(labels=np.ones((1, 4, 4, 1))))
+
+    response = client.get(f'/api/image/{project.token}/labels/0/0.png',
+                          headers={'Accept': accept})
+
+    assert response.status_code == 200
+    assert response.mimetype == expected
+    assert 'Accept' in response.vary
+
+
+def test_tiles(client, mocker):
+    mocker.patch('models.PYRAMID_TILE_SIZE', 4)
+    project = models.Project.create(DummyLoader(raw=np.zeros((2, 8, 8, 1)),
+                                                labels=np.ones((2, 8, 8, 1))))
+    token = project.token
+
+    response = client.get(f'/api/tiles/{token}/0?x=0&y=0&width=8&height=8&scale=0.5')
+    assert response.status_code == 200
+    viewport = response.json
+    assert viewport['level'] == 1
+    assert len(viewport['tiles']) == 1
+
+    tile = viewport['tiles'][0]
+    response = client.get(tile['raw'])
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+    assert response.cache_control.max_age
+    response = client.get(tile['segmented'])
+    assert response.status_code == 200
+    assert response.cache_control.no_cache
+    etag, _ = response.get_etag()
+    response = client.get(tile['segmented'], headers={'If-None-Match': f'"{etag}"'})
+    assert response.status_code == 304
+
+    # Editing the frame changes the label tiles
+    client.post(f'/api/edit/{token}/delete_mask', data={'label': 1})
+    response = client.get(tile['segmented'], headers={'If-None-Match': f'"{etag}"'})
+    assert response.status_code == 200
+
+    assert client.get(f'/api/tiles/{token}/rgb/1/0/1/1.png').status_code == 200
+    assert client.get(f'/api/tiles/{token}/raw/0/0/2/0/0.png').status_code == 404
+    assert client.get(f'/api/tiles/{token}/labels/0/0/0/2/0.png').status_code == 404
+    assert client.get(f'/api/tiles/{token}/labels/2/0/0/0/0.png').status_code == 404
+    assert client.get(f'/api/tiles/{token}/0?scale=0').status_code == 400
+
+
+def test_payload_image_urls(client):
+    project = models.Project.create(DummyLoader())
+    token = project.token
+
+    response = client.post(f'/api/changedisplay/{token}/frame/0')
+
+    imgs = response.json['imgs']
+    assert imgs['raw'] == f'/api/image/{token}/raw/0/0.png'
+    assert imgs['segmented'].startswith(f'/api/image/{token}/labels/0/0.png?version=')
+    assert imgs['viewport'] == f'/api/tiles/{token}/0'
+
+
 def test_create_project(client, mocker):
     mocker.patch('blueprints.loaders.get_loader', lambda *args: DummyLoader())
     response = client.post(f'/api/project')
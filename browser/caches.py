@@ -0,0 +1,233 @@
+"""In-process caches of DeepCell Label project data."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import threading
+
+
+class LRUCache(object):
+    """
+    Least-recently-used cache with a memory budget.
+    Counts hits and misses so the budget can be sized from real usage.
+
+    Args:
+        max_bytes (int): memory budget for cached values; 0 disables the cache
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Maps keys to (value, nbytes), least recently used first
+        self._items = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key):
+        """
+        Args:
+            key (tuple): key of the value
+
+        Returns:
+            cached value, or None if the key is not cached
+        """
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, nbytes):
+        """
+        Caches a value, evicting least recently used values to stay in budget.
+
+        Args:
+            key (tuple): key of the value
+            value: value to cache; None removes the key from the cache
+            nbytes (int): memory used by the value
+        """
+        with self._lock:
+            old_item = self._items.pop(key, None)
+            if old_item is not None:
+                self.nbytes -= old_item[1]
+            if value is None or nbytes > self.max_bytes:
+                return
+            self._items[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_nbytes) = self._items.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+
+    def remove(self, predicate):
+        """Removes the keys that match a predicate."""
+        with self._lock:
+            for key in [key for key in self._items if predicate(key)]:
+                self.nbytes -= self._items.pop(key)[1]
+
+    def clear(self):
+        """Removes all cached values."""
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """
+        Returns:
+            dict: number of cached values, memory used, and hit and miss counts
+        """
+        return {
+            'size': len(self),
+            'nbytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class ProjectCache(LRUCache):
+    """
+    Least-recently-used cache of decoded frames for each worker process.
+    Also caches the label metadata of projects, with None as the frame ID.
+
+    Frames are cached with the token and version of their project.
+    The version is stored in the projects table and increases whenever
+    the project data changes, so frames changed by another worker are dropped
+    when the project is validated at the start of a request.
+
+    Args:
+        max_bytes (int): memory budget for cached arrays; 0 disables the cache
+    """
+
+    def __init__(self, max_bytes):
+        super().__init__(max_bytes)
+        # Maps project IDs to the (token, version) the frames were cached at
+        self._projects = {}
+
+    def validate(self, project_id, token, version):
+        """
+        Drops the cached frames of a project if they are from a different version
+        and records the version of the project that frames are cached for.
+
+        Args:
+            project_id (int): primary key of the project
+            token (str): unique token of the project
+            version (int): current version of the project in the database
+        """
+        with self._lock:
+            cached = self._projects.get(project_id)
+            if cached is not None and cached != (token, version):
+                self.invalidate(project_id)
+            self._projects[project_id] = (token, version)
+
+    def advance(self, project_id, token, version, new_version):
+        """
+        Moves the cached frames of a project to a new version
+        after this process commits changes to the project.
+        Frames from any other version are dropped, and all frames of the project
+        are dropped when another process changed it in between.
+
+        Args:
+            project_id (int): primary key of the project
+            token (str): unique token of the project
+            version (int): version of the project before the changes
+            new_version (int): version of the project after the changes
+        """
+        with self._lock:
+            if new_version > version + 1:
+                self.invalidate(project_id)
+            else:
+                self.validate(project_id, token, version)
+            self._projects[project_id] = (token, new_version)
+
+    def get(self, project_id, table, frame_id):  # pylint: disable=W0221
+        """
+        Args:
+            project_id (int): primary key of the project
+            table (str): name of the frame table (e.g. 'labelframes')
+            frame_id (int): index of the frame
+
+        Returns:
+            ndarray: cached frame, or None if the frame is not cached
+        """
+        return super().get((project_id, table, frame_id))
+
+    def put(self, project_id, table, frame_id, array, version,  # pylint: disable=W0221
+            nbytes=None):
+        """
+        Caches a frame of a validated project,
+        evicting least recently used frames to stay in budget.
+        Frames read at another version of the project are not cached,
+        so sessions that read the project before a commit do not overwrite newer frames.
+
+        Args:
+            project_id (int): primary key of the project
+            table (str): name of the frame table (e.g. 'labelframes')
+            frame_id (int): index of the frame
+            array (ndarray): frame to cache; None removes the frame from the cache
+            version (int): version of the project the frame was read at
+            nbytes (int): memory used by the cached value; defaults to array.nbytes
+        """
+        with self._lock:
+            cached = self._projects.get(project_id)
+            if cached is None or cached[1] != version:
+                return
+            if nbytes is None:
+                nbytes = 0 if array is None else array.nbytes
+            super().put((project_id, table, frame_id), array, nbytes)
+
+    def invalidate(self, project_id):
+        """Drops all cached frames of a project."""
+        with self._lock:
+            self._projects.pop(project_id, None)
+            self.remove(lambda key: key[0] == project_id)
+
+    def clear(self):
+        """Drops all cached frames."""
+        with self._lock:
+            self._projects.clear()
+            super().clear()
+
+
+class RenderCache(LRUCache):
+    """
+    Least-recently-used cache of images and label arrays rendered for the front-end.
+
+    Keys start with the kind of rendering, the project ID and the frame ID.
+    Keys of renderings of labels continue with the feature and the version of the label frame,
+    so editing a frame changes the keys of its renderings.
+    Renderings of other versions are dropped when the frame is committed.
+
+    Args:
+        max_bytes (int): memory budget for cached renderings; 0 disables the cache
+    """
+
+    # Kinds of renderings made from label frames
+    LABEL_KINDS = ('labels', 'outlines', 'outlined', 'labels_level', 'labels_tile')
+
+    def invalidate(self, project_id):
+        """Drops all renderings of a project."""
+        self.remove(lambda key: key[1] == project_id)
+
+    def invalidate_labels(self, project_id, frame_id, keep_version=None):
+        """
+        Drops the renderings of a label frame.
+
+        Args:
+            project_id (int): primary key of the project
+            frame_id (int): index of the frame
+            keep_version (int): version of the frame whose renderings are kept, if any
+        """
+        self.remove(lambda key: (key[0] in self.LABEL_KINDS and
+                                 key[1] == project_id and key[2] == frame_id and
+                                 key[4] != keep_version))
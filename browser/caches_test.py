@@ -0,0 +1,163 @@
+"""Tests for caches.py"""
+
+import numpy as np
+
+import caches
+
+
+def test_lru_cache():
+    cache = caches.LRUCache(max_bytes=10)
+    cache.put(('a',), b'1234', 4)
+    cache.put(('b',), b'1234', 4)
+    assert cache.get(('a',)) == b'1234'
+
+    cache.put(('c',), b'1234', 4)
+
+    assert ('b',) not in cache
+    assert cache.get(('b',)) is None
+    assert cache.stats() == {'size': 2, 'nbytes': 8, 'max_bytes': 10, 'hits': 1, 'misses': 1}
+
+
+def test_render_cache_invalidate_labels():
+    cache = caches.RenderCache(max_bytes=1024)
+    for kind in ('raw', 'labels', 'outlines'):
+        cache.put((kind, 1, 0, 0, 0), b'png', 3)
+        cache.put((kind, 1, 1, 0, 0), b'png', 3)
+    cache.put(('labels', 2, 0, 0, 0), b'png', 3)
+
+    cache.invalidate_labels(1, 0)
+
+    assert ('raw', 1, 0, 0, 0) in cache
+    assert ('labels', 1, 0, 0, 0) not in cache
+    assert ('outlines', 1, 0, 0, 0) not in cache
+    assert ('labels', 1, 1, 0, 0) in cache
+    assert ('labels', 2, 0, 0, 0) in cache
+
+    cache.invalidate(1)
+    assert len(cache) == 1
+
+
+def test_render_cache_invalidate_labels_keep_version():
+    cache = caches.RenderCache(max_bytes=1024)
+    for version in (0, 1):
+        cache.put(('labels', 1, 0, 0, version, 5, 'png'), b'png', 3)
+        cache.put(('outlined', 1, 0, 0, version), b'arr', 3)
+
+    cache.invalidate_labels(1, 0, keep_version=1)
+
+    assert ('labels', 1, 0, 0, 0, 5, 'png') not in cache
+    assert ('outlined', 1, 0, 0, 0) not in cache
+    assert ('labels', 1, 0, 0, 1, 5, 'png') in cache
+    assert ('outlined', 1, 0, 0, 1) in cache
+
+
+def test_project_cache_get_put():
+    cache = caches.ProjectCache(max_bytes=1024)
+    cache.validate(1, 'token', 0)
+    array = np.ones((4, 4), dtype='uint8')
+
+    assert cache.get(1, 'labelframes', 0) is None
+    cache.put(1, 'labelframes', 0, array, 0)
+
+    assert cache.get(1, 'labelframes', 0) is array
+    assert cache.get(1, 'rawframes', 0) is None
+    assert cache.hits == 1
+    assert cache.misses == 2
+    assert cache.nbytes == array.nbytes
+
+
+def test_project_cache_put_unvalidated_project():
+    cache = caches.ProjectCache(max_bytes=1024)
+
+    cache.put(1, 'labelframes', 0, np.ones((4, 4)), 0)
+
+    assert len(cache) == 0
+
+
+def test_project_cache_put_other_version():
+    cache = caches.ProjectCache(max_bytes=1024)
+    cache.validate(1, 'token', 0)
+    cache.advance(1, 'token', 0, 1)
+
+    # Read by a session that loaded the project before the commit
+    cache.put(1, 'labelframes', 0, np.ones((4, 4)), 0)
+
+    assert len(cache) == 0
+
+
+def test_project_cache_put_none():
+    cache = caches.ProjectCache(max_bytes=1024)
+    cache.validate(1, 'token', 0)
+    cache.put(1, 'labelframes', 0, np.ones((4, 4), dtype='uint8'), 0)
+
+    cache.put(1, 'labelframes', 0, None, 0)
+
+    assert len(cache) == 0
+    assert cache.nbytes == 0
+
+
+def test_project_cache_evicts_least_recently_used():
+    cache = caches.ProjectCache(max_bytes=32)
+    cache.validate(1, 'token', 0)
+    for frame_id in range(2):
+        cache.put(1, 'labelframes', frame_id, np.zeros(16, dtype='uint8'), 0)
+    # Use the first frame so the second one is evicted
+    cache.get(1, 'labelframes', 0)
+
+    cache.put(1, 'labelframes', 2, np.zeros(16, dtype='uint8'), 0)
+
+    assert (1, 'labelframes', 0) in cache
+    assert (1, 'labelframes', 1) not in cache
+    assert (1, 'labelframes', 2) in cache
+    assert cache.nbytes == 32
+
+
+def test_project_cache_skips_arrays_over_budget():
+    cache = caches.ProjectCache(max_bytes=8)
+    cache.validate(1, 'token', 0)
+
+    cache.put(1, 'labelframes', 0, np.zeros(16, dtype='uint8'), 0)
+
+    assert len(cache) == 0
+
+
+def test_project_cache_validate():
+    cache = caches.ProjectCache(max_bytes=1024)
+    cache.validate(1, 'token', 0)
+    cache.validate(2, 'other', 0)
+    cache.put(1, 'labelframes', 0, np.zeros(4), 0)
+    cache.put(2, 'labelframes', 0, np.zeros(4), 0)
+
+    cache.validate(1, 'token', 0)
+    assert (1, 'labelframes', 0) in cache
+
+    # New version of project 1
+    cache.validate(1, 'token', 1)
+    assert (1, 'labelframes', 0) not in cache
+    assert (2, 'labelframes', 0) in cache
+
+    # Project ID reused by a new project
+    cache.validate(2, 'new', 0)
+    assert len(cache) == 0
+    assert cache.nbytes == 0
+
+
+def test_project_cache_advance():
+    cache = caches.ProjectCache(max_bytes=1024)
+    cache.validate(1, 'token', 0)
+    cache.put(1, 'labelframes', 0, np.zeros(4), 0)
+
+    cache.advance(1, 'token', 0, 1)
+    assert (1, 'labelframes', 0) in cache
+    cache.validate(1, 'token', 1)
+    assert (1, 'labelframes', 0) in cache
+
+    # Frames from a version this worker did not see are dropped
+    cache.advance(1, 'token', 3, 4)
+    assert len(cache) == 0
+
+    # Frames are dropped when another worker committed between the versions
+    cache.put(1, 'labelframes', 0, np.zeros(4), 4)
+    cache.advance(1, 'token', 4, 6)
+    assert len(cache) == 0
+    assert cache._projects[1] == ('token', 6)  # pylint: disable=W0212
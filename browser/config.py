@@ -3,7 +3,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from decouple import config
+from decouple import config, Csv
 
 
 DEBUG = config('DEBUG', cast=bool, default=True)
@@ -23,6 +23,48 @@ SQLALCHEMY_TRACK_MODIFICATIONS = config('SQLALCHEMY_TRACK_MODIFICATIONS',
 SQLALCHEMY_DATABASE_URI = config('SQLALCHEMY_DATABASE_URI',
                                  default='sqlite:////tmp/deepcell_label.db')
 
+# Frame storage settings
+# Codec for numpy arrays stored in the database: 'raw' or 'zlib'
+FRAME_CODEC = config('FRAME_CODEC', default='zlib')
+FRAME_COMPRESSION_LEVEL = config('FRAME_COMPRESSION_LEVEL', cast=int, default=1)
+
+# Percentiles to rescale RGB channels with: 'frame' for each frame, or 'stack'
+# to compute them once for the whole stack so display is consistent between frames
+RGB_PERCENTILES = config('RGB_PERCENTILES', default='frame')
+
+# Memory budget for the decoded frames cached by each worker process
+PROJECT_CACHE_SIZE = config('PROJECT_CACHE_SIZE', cast=int, default=256)  # measured in MB
+# Memory budget for the images and label arrays rendered by each worker process
+RENDER_CACHE_SIZE = config('RENDER_CACHE_SIZE', cast=int, default=64)  # measured in MB
+
+# Image formats to send in order of preference: 'png', 'webp' or 'rgba'
+# Formats other than PNG are only sent to clients that list them in the Accept header
+IMAGE_FORMATS = config('IMAGE_FORMATS', cast=Csv(), default='png')
+# Lower PNG compression levels and WebP methods and qualities encode faster but make larger images
+PNG_COMPRESS_LEVEL = config('PNG_COMPRESS_LEVEL', cast=int, default=1)
+# zlib strategy for PNGs: 'default', 'filtered', 'huffman', 'rle' or 'fixed'
+PNG_STRATEGY = config('PNG_STRATEGY', default='rle')
+WEBP_METHOD = config('WEBP_METHOD', cast=int, default=0)
+WEBP_QUALITY = config('WEBP_QUALITY', cast=int, default=0)
+
+# Size of the square tiles of the label image and array sent after an edit
+LABEL_TILE_SIZE = config('LABEL_TILE_SIZE', cast=int, default=64)  # measured in pixels
+
+# Size of the square tiles of the downsampled image pyramids for large frames
+PYRAMID_TILE_SIZE = config('PYRAMID_TILE_SIZE', cast=int, default=256)  # measured in pixels
+
+# Frames before and after the displayed frame to render in the background; 0 disables prefetching
+PREFETCH_FRAMES = config('PREFETCH_FRAMES', cast=int, default=2)
+PREFETCH_WORKERS = config('PREFETCH_WORKERS', cast=int, default=2)
+
+# Workers to compute the label metadata, stack-wide RGB percentiles and stored frames
+# of new projects frame by frame; 1 computes them serially
+FRAME_WORKERS = config('FRAME_WORKERS', cast=int, default=1)
+# 'thread' or 'process'; processes read the stack from a memory-mapped file instead of a copy
+FRAME_POOL = config('FRAME_POOL', default='thread')
+# Stacks smaller than this are computed serially, as starting the pool would take longer
+FRAME_POOL_MIN_SIZE = config('FRAME_POOL_MIN_SIZE', cast=int, default=64)  # measured in MB
+
 # Flask monitoring dashboard
 # When empty, disables the dashboard
 DASHBOARD_CONFIG = config('DASHBOARD_CONFIG', default='')
@@ -1,14 +1,17 @@
 """Tests for the DeepCell Label Flask App."""
 
+import base64
 import os
+import sqlite3
 
 from flask_sqlalchemy import SQLAlchemy
 import numpy as np
 import pytest
 from pytest_lazyfixture import lazy_fixture
+from sqlalchemy import event
 
 from application import create_app  # pylint: disable=C0413
-from models import Project, Action
+from models import db, Project, Action, NdarrayType, project_cache, render_cache
 from loaders import Loader
 from labelmaker import LabelInfoMaker
 
@@ -20,6 +23,88 @@ TESTDB_PATH = '/tmp/test_project.db'
 TEST_DATABASE_URI = 'sqlite:///{}'.format(TESTDB_PATH)
 
 
+# Tables created by the first release, before the tables and columns of later versions
+BASELINE_SCHEMA = """
+CREATE TABLE actions (
+    project_id INTEGER NOT NULL,
+    action_id INTEGER NOT NULL,
+    action_time TIMESTAMP,
+    action_name VARCHAR(64),
+    prev_action_id INTEGER,
+    next_action_id INTEGER,
+    done BOOLEAN,
+    labels BLOB,
+    PRIMARY KEY (project_id, action_id),
+    FOREIGN KEY(project_id) REFERENCES projects (id),
+    FOREIGN KEY(prev_action_id) REFERENCES actions (action_id),
+    FOREIGN KEY(next_action_id) REFERENCES actions (action_id),
+    CHECK (done IN (0, 1))
+);
+CREATE TABLE projects (
+    id INTEGER NOT NULL,
+    token VARCHAR(12) NOT NULL,
+    "createdAt" TIMESTAMP NOT NULL,
+    finished TIMESTAMP,
+    path TEXT NOT NULL,
+    source VARCHAR(7) NOT NULL,
+    height INTEGER NOT NULL,
+    width INTEGER NOT NULL,
+    num_frames INTEGER NOT NULL,
+    num_channels INTEGER NOT NULL,
+    num_features INTEGER NOT NULL,
+    rgb BOOLEAN,
+    frame INTEGER,
+    channel INTEGER,
+    feature INTEGER,
+    scale_factor FLOAT,
+    colormap BLOB,
+    action_id INTEGER,
+    num_actions INTEGER,
+    PRIMARY KEY (id),
+    CONSTRAINT sourceenum CHECK (source IN ('s3', 'dropped', 'lfs')),
+    CHECK (rgb IN (0, 1)),
+    FOREIGN KEY(action_id) REFERENCES actions (action_id)
+);
+CREATE TABLE labelframes (
+    project_id INTEGER NOT NULL,
+    frame_id INTEGER NOT NULL,
+    frame BLOB,
+    PRIMARY KEY (project_id, frame_id),
+    FOREIGN KEY(project_id) REFERENCES projects (id)
+);
+CREATE TABLE labels (
+    project_id INTEGER NOT NULL,
+    cell_ids BLOB,
+    cell_info BLOB,
+    PRIMARY KEY (project_id),
+    FOREIGN KEY(project_id) REFERENCES projects (id)
+);
+CREATE TABLE rawframes (
+    project_id INTEGER NOT NULL,
+    frame_id INTEGER NOT NULL,
+    frame BLOB,
+    PRIMARY KEY (project_id, frame_id),
+    FOREIGN KEY(project_id) REFERENCES projects (id)
+);
+CREATE TABLE rgbframes (
+    project_id INTEGER NOT NULL,
+    frame_id INTEGER NOT NULL,
+    frame BLOB,
+    PRIMARY KEY (project_id, frame_id),
+    FOREIGN KEY(project_id) REFERENCES projects (id)
+);
+CREATE TABLE framemementos (
+    project_id INTEGER NOT NULL,
+    action_id INTEGER NOT NULL,
+    frame_id INTEGER NOT NULL,
+    frame_array BLOB,
+    PRIMARY KEY (project_id, action_id, frame_id),
+    FOREIGN KEY(project_id, action_id) REFERENCES actions (project_id, action_id),
+    FOREIGN KEY(project_id, frame_id) REFERENCES labelframes (project_id, frame_id)
+);
+"""
+
+
 # TODO: Could this become a fixture?
 class DummyLoader(Loader):
     def __init__(self, raw=None, labels=None, path='test.npz', source='s3'):
@@ -38,6 +123,102 @@ class DummyLoader(Loader):
         self.source = source
 
 
+def decode_array(encoded):
+    """Decodes an array run-length encoded by imgutils.encode_array."""
+    dtype = np.dtype(encoded['dtype']).newbyteorder('<')
+    values = np.frombuffer(base64.b64decode(encoded['values']), dtype=dtype)
+    lengths = np.frombuffer(base64.b64decode(encoded['lengths']), dtype='<u4')
+    return np.repeat(values, lengths).reshape(encoded['shape'])
+
+
+class QueryCounter(object):
+    """
+    Context manager that records the queries sent to a database engine.
+    Ignores the savepoints used by the transactional test fixtures.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self.record)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(self.engine, 'before_cursor_execute', self.record)
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        if not statement.startswith(('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')):
+            self.statements.append(statement)
+
+    @property
+    def selects(self):
+        return [s for s in self.statements if s.startswith('SELECT')]
+
+
+@pytest.fixture
+def query_counter(_db):
+    """Returns a factory for QueryCounters on the test database."""
+    return lambda: QueryCounter(_db.engine)
+
+
+class FrameReads(object):
+    """Records the arrays decoded from the database and the bytes they were stored in."""
+
+    def __init__(self):
+        self.arrays = []
+        self.nbytes = 0
+
+    def record(self, array, value):
+        self.arrays.append(np.array(array))
+        self.nbytes += len(value)
+
+
+@pytest.fixture
+def frame_reads(monkeypatch):
+    """Returns a FrameReads that records every array decoded by NdarrayType."""
+    reads = FrameReads()
+    decode = NdarrayType.decode
+
+    def record_decode(self, value):
+        array = decode(self, value)
+        reads.record(array, value)
+        return array
+
+    monkeypatch.setattr(NdarrayType, 'decode', record_decode)
+    return reads
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    """
+    Drops the frames and renderings cached by a test,
+    as project IDs are reused after rollbacks.
+    """
+    yield
+    project_cache.clear()
+    render_cache.clear()
+
+
+@pytest.fixture
+def baseline_db(tmp_path):
+    """
+    Returns the path of a SQLite database with the tables of the first release,
+    like the databases of existing deployments.
+    Applications created on it replace the test application,
+    so the test application is restored afterwards.
+    """
+    path = str(tmp_path / 'baseline.db')
+    with sqlite3.connect(path) as connection:
+        connection.executescript(BASELINE_SCHEMA)
+    test_app = db.app
+    db.session.remove()
+    yield path
+    db.session.remove()
+    db.app = test_app
+
+
 @pytest.fixture(scope='session')
 def app():
     """Session-wide test `Flask` application."""
@@ -48,6 +229,8 @@ def app():
     yield create_app(
         TESTING=True,
         SQLALCHEMY_DATABASE_URI=TEST_DATABASE_URI,
+        # Background threads would share the transactional test session
+        PREFETCH_FRAMES=0,
     )
 
     os.unlink(TESTDB_PATH)
@@ -87,7 +87,7 @@ class Exporter():
         trk_file_obj = io.BytesIO()
         with tarfile.open(fileobj=trk_file_obj, mode='w') as trks:
             with tempfile.NamedTemporaryFile('w') as lineage_file:
-                json.dump(tracks, lineage_file, indent=1)
+                json.dump(dict(tracks), lineage_file, indent=1)
                 lineage_file.flush()
                 trks.add(lineage_file.name, 'lineage.json')
 
@@ -1,29 +1,317 @@
 """Utilities for handling images"""
+import base64
+import functools
 import io
+import struct
+import zlib
 
 import matplotlib.pyplot as plt
-from matplotlib.colors import Normalize
 from skimage.segmentation import find_boundaries
 import numpy as np
 
 from PIL import Image
 
+from config import PNG_COMPRESS_LEVEL, PNG_STRATEGY, WEBP_METHOD, WEBP_QUALITY
 
-def pngify(imgarr, vmin, vmax, cmap=None):
-    out = io.BytesIO()
 
+# Mimetype of each image format
+IMAGE_MIMETYPES = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+    # Height and width as little-endian uint32 followed by the RGBA pixels in row-major order
+    'rgba': 'application/x-rgba',
+}
+# Formats that browsers can show in an <img> element
+BROWSER_FORMATS = ('png', 'webp')
+# zlib strategies for PNG compression
+PNG_STRATEGIES = {
+    'default': zlib.Z_DEFAULT_STRATEGY,
+    'filtered': zlib.Z_FILTERED,
+    'huffman': zlib.Z_HUFFMAN_ONLY,
+    'rle': zlib.Z_RLE,
+    'fixed': zlib.Z_FIXED,
+}
+
+# Integer frames with more distinct values than this are not mapped with a lookup table
+MAX_LUT_SIZE = 2 ** 16
+# Number of lookup tables to keep for each process
+LUT_CACHE_SIZE = 32
+
+
+def pngify(imgarr, vmin, vmax, cmap=None, bad=(0, 0, 0, 255)):
+    """
+    Encodes an image as a PNG.
+    With a colormap, the image is scaled from vmin to vmax like matplotlib.colors.Normalize
+    and colored with a uint8 RGBA lookup table instead of calling the colormap.
+
+    Args:
+        imgarr (np.array): 2d image, or a masked array to color masked pixels with bad
+        vmin (int): value for the first color, or None for the smallest value
+        vmax (int): value for the last color, or None for the largest value
+        cmap (str): name of a matplotlib colormap, or None to save imgarr as is
+        bad (tuple): RGBA color for masked pixels
+
+    Returns:
+        BytesIO: the image as a .png
+    """
+    return render_image(imgarr, vmin, vmax, cmap, 'png', bad)
+
+
+def render_image(imgarr, vmin, vmax, cmap=None, image_format='png', bad=(0, 0, 0, 255)):
+    """
+    Encodes an image like pngify in any of the IMAGE_MIMETYPES formats.
+
+    Args:
+        imgarr (np.array): 2d image, or a masked array to color masked pixels with bad
+        vmin (int): value for the first color, or None for the smallest value
+        vmax (int): value for the last color, or None for the largest value
+        cmap (str): name of a matplotlib colormap, or None to encode imgarr as is
+        image_format (str): 'png', 'webp' or 'rgba'
+        bad (tuple): RGBA color for masked pixels
+
+    Returns:
+        BytesIO: the encoded image
+    """
     if cmap:
-        cmap = plt.get_cmap(cmap)
-        imgarr = Normalize(vmin=vmin, vmax=vmax)(imgarr)
-        # apply the colormap
-        imgarr = cmap(imgarr, bytes=True)
+        imgarr = apply_colormap(imgarr, vmin, vmax, cmap, bad)
+    return encode_image(imgarr, image_format)
 
-    img = Image.fromarray(imgarr)
-    img.save(out, format="png")
+
+def encode_image(imgarr, image_format='png'):
+    """
+    Args:
+        imgarr (np.array): 2d image, or RGB or RGBA image with a last dimension of 3 or 4
+        image_format (str): 'png', 'webp' or 'rgba'
+
+    Returns:
+        BytesIO: the encoded image
+
+    Raises:
+        ValueError: the format is not in IMAGE_MIMETYPES
+    """
+    encoders = {
+        'png': encode_png,
+        'webp': encode_webp,
+        'rgba': encode_rgba,
+    }
+    if image_format not in encoders:
+        raise ValueError('Image format {} is not one of {}.'.format(
+            image_format, list(encoders)))
+    out = io.BytesIO()
+    encoders[image_format](imgarr, out)
     out.seek(0)
     return out
 
 
+def encode_png(imgarr, out, compress_level=PNG_COMPRESS_LEVEL, strategy=PNG_STRATEGY):
+    """
+    Writes an image as a PNG.
+    Lower compression levels are faster and make larger files.
+
+    Args:
+        imgarr (np.array): image to encode
+        out (BytesIO): file to write the PNG to
+        compress_level (int): zlib compression level from 0 to 9
+        strategy (str): zlib strategy in PNG_STRATEGIES
+    """
+    img = Image.fromarray(drop_opaque_alpha(imgarr))
+    img.save(out, format='png', compress_level=compress_level,
+             compress_type=PNG_STRATEGIES[strategy])
+
+
+def encode_webp(imgarr, out, method=WEBP_METHOD, quality=WEBP_QUALITY):
+    """
+    Writes an 8-bit image as a lossless WebP.
+    Lower methods and qualities are faster and make larger files.
+
+    Args:
+        imgarr (np.array): image to encode
+        out (BytesIO): file to write the WebP to
+        method (int): compression method from 0 to 6
+        quality (int): compression effort from 0 to 100
+    """
+    img = Image.fromarray(drop_opaque_alpha(imgarr))
+    img.save(out, format='webp', lossless=True, method=method, quality=quality)
+
+
+def encode_rgba(imgarr, out):
+    """
+    Writes an image as uncompressed RGBA pixels after its height and width.
+    Takes no time to encode but is several times larger than a PNG,
+    so it suits clients on the same machine or network.
+
+    Args:
+        imgarr (np.array): image to encode
+        out (BytesIO): file to write the pixels to
+    """
+    if imgarr.dtype != np.uint8 or imgarr.ndim != 3 or imgarr.shape[-1] != 4:
+        imgarr = np.asarray(Image.fromarray(imgarr).convert('RGBA'))
+    out.write(struct.pack('<II', imgarr.shape[0], imgarr.shape[1]))
+    out.write(np.ascontiguousarray(imgarr).data)
+
+
+def drop_opaque_alpha(imgarr):
+    """
+    Args:
+        imgarr (np.array): image to encode
+
+    Returns:
+        np.array: the RGB channels of an RGBA image that is opaque everywhere,
+                  which encode faster, or imgarr otherwise
+    """
+    if (imgarr.dtype == np.uint8 and imgarr.ndim == 3 and imgarr.shape[-1] == 4 and
+            (imgarr[..., 3] == 255).all()):
+        return np.ascontiguousarray(imgarr[..., :3])
+    return imgarr
+
+
+def apply_colormap(imgarr, vmin, vmax, cmap, bad=(0, 0, 0, 255)):
+    """
+    Colors an image with a matplotlib colormap.
+    Integer images index a cached lookup table with a color for each value from vmin to vmax,
+    so the image is never converted to floats.
+
+    Args:
+        imgarr (np.array): image of any shape, or a masked array
+        vmin (int): value for the first color, or None for the smallest value
+        vmax (int): value for the last color, or None for the largest value
+        cmap (str): name of a matplotlib colormap
+        bad (tuple): RGBA color for masked pixels
+
+    Returns:
+        np.array: uint8 RGBA image with an extra last dimension
+    """
+    mask = np.ma.getmaskarray(imgarr) if np.ma.isMaskedArray(imgarr) else None
+    data = np.ma.getdata(imgarr)
+    if data.dtype.kind == 'f':
+        # NaN is bad like in matplotlib
+        nan = np.isnan(data)
+        mask = nan if mask is None else mask | nan
+    if vmin is None or vmax is None:
+        values = data[~mask] if mask is not None else data
+        if vmin is None:
+            vmin = values.min() if values.size else 0
+        if vmax is None:
+            vmax = values.max() if values.size else 0
+
+    if data.dtype.kind in 'ui' and int(vmax) - int(vmin) < MAX_LUT_SIZE:
+        vmin, vmax = int(vmin), int(vmax)
+        lut = get_colormap_lut(cmap, vmin, vmax)
+        if vmin != 0:
+            data = data.astype(np.int64) - vmin
+        # Values below vmin and above vmax get the first and last colors
+        rgba = np.take(lut, data, axis=0, mode='clip')
+    else:
+        table = get_colormap_table(cmap)
+        indices = colormap_indices(np.where(mask, vmin, data) if mask is not None else data,
+                                   vmin, vmax, len(table))
+        rgba = np.take(table, indices, axis=0)
+
+    if mask is not None:
+        # Copy each RGBA pixel as one uint32, which is much faster than rgba[mask] = bad
+        pixels = rgba.view(np.uint32)[..., 0]
+        np.copyto(pixels, np.array(bad, dtype=np.uint8).view(np.uint32)[0], where=mask)
+    return rgba
+
+
+@functools.lru_cache(maxsize=None)
+def get_colormap_table(cmap):
+    """
+    Args:
+        cmap (str): name of a matplotlib colormap
+
+    Returns:
+        np.array: read-only uint8 RGBA color for each index of the colormap
+    """
+    colormap = plt.get_cmap(cmap)
+    table = colormap(np.arange(colormap.N), bytes=True)
+    table.flags.writeable = False
+    return table
+
+
+@functools.lru_cache(maxsize=LUT_CACHE_SIZE)
+def get_colormap_lut(cmap, vmin, vmax):
+    """
+    Args:
+        cmap (str): name of a matplotlib colormap
+        vmin (int): value for the first color
+        vmax (int): value for the last color
+
+    Returns:
+        np.array: read-only uint8 RGBA color for each value from vmin to vmax
+    """
+    table = get_colormap_table(cmap)
+    values = np.arange(vmin, max(vmin, vmax) + 1)
+    lut = table[colormap_indices(values, vmin, vmax, len(table))]
+    lut.flags.writeable = False
+    return lut
+
+
+def colormap_indices(values, vmin, vmax, num_colors):
+    """
+    Finds the color for each value the same way as calling a matplotlib colormap
+    on the values scaled by matplotlib.colors.Normalize(vmin, vmax).
+
+    Args:
+        values (np.array): values to color
+        vmin (int): value for the first color
+        vmax (int): value for the last color
+        num_colors (int): number of colors in the colormap
+
+    Returns:
+        np.array: index of the color for each value
+    """
+    if vmin >= vmax:
+        return np.zeros(values.shape, dtype=np.intp)
+    scaled = (values - np.float64(vmin)) * (num_colors / (np.float64(vmax) - vmin))
+    return np.clip(scaled, 0, num_colors - 1).astype(np.intp)
+
+
+def positive_percentiles(image, q):
+    """
+    Computes percentiles of the positive values in an image.
+    Matches np.percentile(image[image > 0], q), but counts the values
+    of small non-negative integer images with np.bincount instead of sorting them.
+
+    Args:
+        image (np.array): image of any shape
+        q (list): percentiles to compute, between 0 and 100
+
+    Returns:
+        np.array: one value for each percentile, or None if no values are positive
+    """
+    q = np.asarray(q, dtype='float64')
+    if image.size == 0:
+        return None
+    # uint8 and uint16 values always fit in the counts
+    small_unsigned = image.dtype.kind == 'u' and image.dtype.itemsize <= 2
+    if not small_unsigned and (image.dtype.kind not in 'ui' or
+                               image.min() < 0 or image.max() >= 2 ** 16):
+        positive = image[image > 0]
+        if positive.size == 0:
+            return None
+        return np.percentile(positive, q)
+
+    # Number of positive values up to each value
+    counts = np.bincount(image.reshape(-1))
+    counts[0] = 0
+    cumulative = np.cumsum(counts)
+    total = cumulative[-1]
+    if total == 0:
+        return None
+    # Interpolate between the values at the ranks around each percentile
+    ranks = q / 100 * (total - 1)
+    lower_rank = np.floor(ranks)
+    upper_rank = np.minimum(lower_rank + 1, total - 1)
+    lower = np.searchsorted(cumulative, lower_rank, side='right').astype('float64')
+    upper = np.searchsorted(cumulative, upper_rank, side='right').astype('float64')
+    weight = ranks - lower_rank
+    # Same interpolation as np.percentile
+    return np.where(weight >= 0.5,
+                    upper - (upper - lower) * (1 - weight),
+                    lower + (upper - lower) * weight)
+
+
 def add_outlines(frame):
     """
     Shows the frame with each label outlined with negative label values.
@@ -41,3 +329,177 @@ def add_outlines(frame):
     boundary_mask = find_boundaries(frame, mode='inner')
     outlined_frame = np.where(boundary_mask == 1, -frame, frame)
     return outlined_frame
+
+
+def update_outlines(outlined, frame, box):
+    """
+    Recomputes the outlines of add_outlines in place after the labels in a box changed.
+    Only the box and a 1-pixel margin around it can change,
+    so find_boundaries runs on that region and the pixels around it.
+
+    Args:
+        outlined (np.array): outlined frame before the change, updated in place
+        frame (np.array): 2d array with labels after the change
+        box (tuple): (y1, x1, y2, x2) bounding box of the changed labels
+
+    Returns:
+        np.array: outlined, with the outlines of the changed labels
+    """
+    height, width = frame.shape
+    y1, x1, y2, x2 = box
+    # Region whose outlines can change
+    y1, x1 = max(y1 - 1, 0), max(x1 - 1, 0)
+    y2, x2 = min(y2 + 1, height), min(x2 + 1, width)
+    # Boundaries in the region depend on the pixels next to it
+    top, left = max(y1 - 1, 0), max(x1 - 1, 0)
+    bottom, right = min(y2 + 1, height), min(x2 + 1, width)
+    region = add_outlines(frame[top:bottom, left:right])
+    outlined[y1:y2, x1:x2] = region[y1 - top:y2 - top, x1 - left:x2 - left]
+    return outlined
+
+
+def changed_box(before, after):
+    """
+    Finds the bounding box of the pixels that differ between two frames.
+
+    Args:
+        before (np.array): frame with the pixels in the first two dimensions
+        after (np.array): frame with the same shape as before
+
+    Returns:
+        tuple: (y1, x1, y2, x2) bounding box of the changed pixels,
+               or None if no pixels changed
+    """
+    changed = before != after
+    # Collapse any dimensions after the pixels (e.g. features)
+    if changed.ndim > 2:
+        changed = np.any(changed.reshape(*changed.shape[:2], -1), axis=-1)
+    rows = np.flatnonzero(np.any(changed, axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(np.any(changed, axis=0))
+    return int(rows[0]), int(cols[0]), int(rows[-1]) + 1, int(cols[-1]) + 1
+
+
+def rasterize_stroke(trace, radius, shape):
+    """
+    Finds the pixels covered by a round brush along a trace.
+    Each point covers the same pixels as skimage.draw.circle,
+    and repeated points are only drawn once.
+
+    Args:
+        trace (list): (y, x) coordinates of the brush center
+        radius (float): radius of the brush
+        shape (tuple): (height, width) of the image
+
+    Returns:
+        tuple: (y1, x1, y2, x2) bounding box of the stroke and a boolean mask
+               of the covered pixels in the box, or None if no pixels are covered
+    """
+    height, width = shape
+    points = np.asarray(trace, dtype='float64').reshape(-1, 2)
+    if radius <= 0 or points.size == 0:
+        return None
+    points = np.unique(points, axis=0)
+    corners = np.floor(points)
+    fractions = points - corners
+    corners = corners.astype(int)
+    # Offsets from the pixel at the corner of each point to the pixels its disc can cover
+    reach = int(np.ceil(radius)) + 1
+    offsets = np.arange(-reach, reach + 1)
+    rows, cols = [], []
+    # Points at integer coordinates share a single disc
+    for fraction in np.unique(fractions, axis=0):
+        disc = (((offsets[:, np.newaxis] - fraction[0]) / radius) ** 2 +
+                ((offsets[np.newaxis, :] - fraction[1]) / radius) ** 2 < 1)
+        disc_rows, disc_cols = np.nonzero(disc)
+        same = np.all(fractions == fraction, axis=1)
+        rows.append((corners[same, 0, np.newaxis] + offsets[disc_rows]).ravel())
+        cols.append((corners[same, 1, np.newaxis] + offsets[disc_cols]).ravel())
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    rows, cols = rows[inside], cols[inside]
+    if rows.size == 0:
+        return None
+
+    y1, x1 = int(rows.min()), int(cols.min())
+    y2, x2 = int(rows.max()) + 1, int(cols.max()) + 1
+    mask = np.zeros((y2 - y1, x2 - x1), dtype=bool)
+    mask[rows - y1, cols - x1] = True
+    return (y1, x1, y2, x2), mask
+
+
+def count_pyramid_levels(height, width, tile_size):
+    """
+    Counts the levels of a tile pyramid, from the full resolution frame
+    to the first level that fits in a single tile.
+    Each level halves the height and width of the previous level.
+
+    Args:
+        height (int): height of the full resolution frame
+        width (int): width of the full resolution frame
+        tile_size (int): height and width of the square tiles
+
+    Returns:
+        int: number of levels, at least 1
+    """
+    levels = 1
+    while max(height, width) > tile_size:
+        height, width = (height + 1) // 2, (width + 1) // 2
+        levels += 1
+    return levels
+
+
+def downsample(image, labels=False):
+    """
+    Halves the height and width of an image for the next level of a tile pyramid.
+    Images are averaged over 2x2 blocks, repeating the last row and column of odd sizes.
+    Labels cannot be averaged, so label images keep the top-left pixel of each block.
+
+    Args:
+        image (np.array): image with the pixels in the first two dimensions
+        labels (bool): whether the image has labels
+
+    Returns:
+        np.array: contiguous image with half the height and width, rounded up
+    """
+    if labels:
+        return np.ascontiguousarray(image[::2, ::2])
+    height, width = image.shape[:2]
+    pad = ((0, height % 2), (0, width % 2)) + ((0, 0),) * (image.ndim - 2)
+    padded = np.pad(image, pad, mode='edge')
+    if image.dtype.kind in 'ui':
+        total = padded[::2, ::2].astype('int64')
+    else:
+        total = padded[::2, ::2].astype('float64')
+    total += padded[1::2, ::2]
+    total += padded[::2, 1::2]
+    total += padded[1::2, 1::2]
+    if image.dtype.kind in 'ui':
+        return (total // 4).astype(image.dtype)
+    return (total / 4).astype(image.dtype)
+
+
+def encode_array(array):
+    """
+    Run-length encodes an array to send to the front-end.
+    Labeled images have long runs of background and of each label,
+    so the runs are much smaller than the array as a nested list.
+
+    Args:
+        array (np.array): integer array to encode
+
+    Returns:
+        dict: shape and dtype of the array, with the value and length of
+              each run in row-major order as base64 encoded little-endian bytes
+    """
+    flat = array.ravel()
+    starts = np.flatnonzero(np.concatenate(([True], flat[1:] != flat[:-1])))
+    lengths = np.diff(np.append(starts, flat.size))
+    dtype = flat.dtype.newbyteorder('<')
+    return {
+        'shape': list(array.shape),
+        'dtype': dtype.name,
+        'values': base64.b64encode(flat[starts].astype(dtype).tobytes()).decode(),
+        'lengths': base64.b64encode(lengths.astype('<u4').tobytes()).decode(),
+    }
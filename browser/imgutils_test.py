@@ -1,15 +1,21 @@
 """Tests for imgutils.py"""
 
+import base64
+import copy
 import os
+import struct
 
+from PIL import Image
+from skimage.draw import circle
 from skimage.io import imread
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.colors import Normalize
 import pytest
 
 import imgutils
 import models
-from conftest import DummyLoader
+from conftest import DummyLoader, decode_array
 
 
 def test_pngify(tmpdir):
@@ -43,6 +49,79 @@ def test_pngify(tmpdir):
     np.testing.assert_equal(imgarr.shape, loaded_image.shape[:-1])
 
 
+@pytest.mark.parametrize('dtype', ['uint8', 'uint16', 'int32', 'float64'])
+@pytest.mark.parametrize('vmin,vmax', [(0, None), (None, None), (5, 150), (3, 3)])
+def test_apply_colormap(dtype, vmin, vmax):
+    imgarr = np.random.RandomState(0).randint(0, 200, size=(32, 32)).astype(dtype)
+
+    rgba = imgutils.apply_colormap(imgarr, vmin, vmax, 'cubehelix')
+
+    expected = plt.get_cmap('cubehelix')(Normalize(vmin=vmin, vmax=vmax)(imgarr), bytes=True)
+    np.testing.assert_array_equal(rgba, expected)
+
+
+def test_apply_colormap_masked_background():
+    imgarr = np.random.RandomState(0).randint(0, 20, size=(32, 32)).astype('int32')
+    masked = np.ma.masked_equal(imgarr, 0)
+
+    rgba = imgutils.apply_colormap(masked, 0, imgarr.max(), 'viridis')
+
+    cmap = copy.copy(plt.get_cmap('viridis'))
+    cmap.set_bad('black')
+    expected = cmap(Normalize(vmin=0, vmax=imgarr.max())(masked), bytes=True)
+    np.testing.assert_array_equal(rgba, expected)
+    np.testing.assert_array_equal(rgba[imgarr == 0], [[0, 0, 0, 255]] * (imgarr == 0).sum())
+
+
+def test_get_colormap_lut_is_cached():
+    lut = imgutils.get_colormap_lut('viridis', 0, 10)
+
+    assert lut.shape == (11, 4)
+    assert lut.dtype == np.uint8
+    assert not lut.flags.writeable
+    assert imgutils.get_colormap_lut('viridis', 0, 10) is lut
+
+
+@pytest.mark.parametrize('image_format', ['png', 'webp'])
+@pytest.mark.parametrize('shape', [(8, 6), (8, 6, 3), (8, 6, 4)])
+def test_encode_image(image_format, shape):
+    # Lossless WebP can change the color of transparent pixels, so none are transparent
+    imgarr = np.random.RandomState(0).randint(1, 256, size=shape).astype('uint8')
+
+    out = imgutils.encode_image(imgarr, image_format)
+
+    decoded = Image.open(out).convert(Image.fromarray(imgarr).mode)
+    np.testing.assert_array_equal(np.asarray(decoded), imgarr)
+
+
+def test_encode_image_opaque_rgba():
+    imgarr = np.full((8, 6, 4), 255, dtype='uint8')
+    imgarr[..., 0] = 7
+
+    decoded = Image.open(imgutils.encode_image(imgarr, 'png'))
+
+    # Opaque images are encoded without the alpha channel
+    assert decoded.mode == 'RGB'
+    np.testing.assert_array_equal(np.asarray(decoded), imgarr[..., :3])
+
+
+@pytest.mark.parametrize('shape', [(8, 6), (8, 6, 3), (8, 6, 4)])
+def test_encode_image_rgba(shape):
+    imgarr = np.random.RandomState(0).randint(0, 256, size=shape).astype('uint8')
+
+    encoded = imgutils.encode_image(imgarr, 'rgba').getvalue()
+
+    height, width = struct.unpack('<II', encoded[:8])
+    assert (height, width) == (8, 6)
+    rgba = np.frombuffer(encoded[8:], dtype='uint8').reshape((height, width, 4))
+    np.testing.assert_array_equal(rgba, np.asarray(Image.fromarray(imgarr).convert('RGBA')))
+
+
+def test_encode_image_unknown_format():
+    with pytest.raises(ValueError):
+        imgutils.encode_image(np.zeros((2, 2), dtype='uint8'), 'gif')
+
+
 def test_add_outlines(db_session):
     db_session.autoflush = False
     labels = np.identity(10)
@@ -58,3 +137,114 @@ def test_add_outlines(db_session):
     outlined = imgutils.add_outlines(label_array)
     assert (outlined[outlined >= 0] == label_array[outlined >= 0]).all()
     assert (outlined[outlined < 0] == -label_array[outlined < 0]).all()
+
+
+def test_update_outlines():
+    rng = np.random.RandomState(0)
+    for _ in range(50):
+        labels = rng.randint(0, 4, size=(12, 10))
+        outlined = imgutils.add_outlines(labels)
+        edited = labels.copy()
+        y1, x1 = rng.randint(0, 12), rng.randint(0, 10)
+        y2, x2 = rng.randint(y1, 12) + 1, rng.randint(x1, 10) + 1
+        edited[y1:y2, x1:x2] = rng.randint(0, 4, size=(y2 - y1, x2 - x1))
+
+        box = imgutils.changed_box(labels, edited)
+        if box is not None:
+            imgutils.update_outlines(outlined, edited, box)
+
+        np.testing.assert_array_equal(outlined, imgutils.add_outlines(edited))
+
+
+def test_changed_box():
+    before = np.zeros((6, 5, 2))
+    after = before.copy()
+    assert imgutils.changed_box(before, after) is None
+
+    after[1, 3, 1] = 1
+    after[4, 2, 0] = 1
+    assert imgutils.changed_box(before, after) == (1, 2, 5, 4)
+
+
+@pytest.mark.parametrize('radius', [0, 1, 2.5, 4])
+def test_rasterize_stroke(radius):
+    shape = (20, 30)
+    trace = [[0, 0], [5, 5], [5, 6], [5, 6], [10.5, 20], [19, 29], [40, 40]]
+    expected = np.zeros(shape, dtype=bool)
+    for y, x in trace:
+        expected[circle(y, x, radius, shape)] = True
+
+    stroke = imgutils.rasterize_stroke(trace, radius, shape)
+
+    if not expected.any():
+        assert stroke is None
+        return
+    (y1, x1, y2, x2), mask = stroke
+    assert (y1, x1, y2, x2) == imgutils.changed_box(np.zeros(shape, dtype=bool), expected)
+    actual = np.zeros(shape, dtype=bool)
+    actual[y1:y2, x1:x2] = mask
+    np.testing.assert_array_equal(actual, expected)
+
+
+def test_rasterize_stroke_empty():
+    assert imgutils.rasterize_stroke([], 3, (10, 10)) is None
+
+
+def test_count_pyramid_levels():
+    assert imgutils.count_pyramid_levels(4, 4, 4) == 1
+    assert imgutils.count_pyramid_levels(4, 5, 4) == 2
+    assert imgutils.count_pyramid_levels(8192, 8192, 256) == 6
+    assert imgutils.count_pyramid_levels(300, 20, 64) == 4
+
+
+@pytest.mark.parametrize('dtype', ['uint16', 'float32'])
+def test_downsample(dtype):
+    image = np.arange(15, dtype=dtype).reshape(3, 5)
+
+    downsampled = imgutils.downsample(image)
+
+    assert downsampled.dtype == image.dtype
+    # The last row and column are repeated to average odd sizes
+    expected = np.array([[3, 5, 6.5], [10.5, 12.5, 14]])
+    if dtype == 'uint16':
+        expected = np.floor(expected)
+    np.testing.assert_array_equal(downsampled, expected)
+
+
+def test_downsample_labels():
+    labels = np.array([[1, 2, 3], [4, 5, 6], [7, 8, 9]])[..., np.newaxis]
+
+    downsampled = imgutils.downsample(labels, labels=True)
+
+    assert downsampled.flags.c_contiguous
+    np.testing.assert_array_equal(downsampled[..., 0], [[1, 3], [7, 9]])
+
+
+@pytest.mark.parametrize('dtype', ['int16', 'int32', '>i4'])
+def test_encode_array(dtype):
+    array = np.zeros((4, 5), dtype=dtype)
+    array[1:3, 1:4] = 7
+    array[2, 2] = -7
+    array[3, 4] = 2
+
+    encoded = imgutils.encode_array(array)
+
+    assert encoded['shape'] == [4, 5]
+    # Runs are 0, 7, 0, 7, -7, 7, 0, 2
+    assert len(np.frombuffer(base64.b64decode(encoded['lengths']), '<u4')) == 8
+    np.testing.assert_array_equal(decode_array(encoded), array)
+
+
+@pytest.mark.parametrize('dtype', ['uint8', 'uint16', 'int32', 'float32'])
+def test_positive_percentiles(dtype):
+    image = np.random.RandomState(0).poisson(lam=20, size=(16, 16)).astype(dtype)
+    q = [0, 5, 37.5, 95, 100]
+
+    percentiles = imgutils.positive_percentiles(image, q)
+
+    np.testing.assert_array_equal(percentiles, np.percentile(image[image > 0], q))
+
+
+def test_positive_percentiles_no_positive_values():
+    assert imgutils.positive_percentiles(np.zeros((4, 4), dtype='uint16'), [5, 95]) is None
+    assert imgutils.positive_percentiles(-np.ones((4, 4)), [5, 95]) is None
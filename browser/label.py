@@ -4,6 +4,7 @@ from __future__ import division
 from __future__ import print_function
 
 import base64
+import bisect
 import io
 import json
 import sys
@@ -12,14 +13,17 @@ import tempfile
 
 import numpy as np
 from matplotlib.colors import Normalize
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from skimage import filters
 from skimage.morphology import flood_fill, flood
 from skimage.morphology import watershed, dilation, disk, square, closing, erosion
-from skimage.draw import circle
 from skimage.exposure import rescale_intensity
 from skimage.measure import regionprops
 from skimage.segmentation import morphological_chan_vese
 
+from imgutils import rasterize_stroke
 from labelmaker import LabelInfoMaker
 
 
@@ -125,7 +129,7 @@ class BaseEdit(object):
         Returns:
             ndarray: the current label frame
         """
-        return self.project.label_frames[self.frame_id].frame
+        return self.project.get_label_frame(self.frame_id).frame
 
     @property
     def raw_frame(self):
@@ -133,7 +137,7 @@ class BaseEdit(object):
         Returns:
             ndarray: the current raw frame
         """
-        return self.project.raw_frames[self.frame_id].frame
+        return self.project.get_raw_frame(self.frame_id).frame
 
     # Access dynamic display attributes
     @property
@@ -168,7 +172,25 @@ class BaseEdit(object):
         """
         return self.project.scale_factor
 
-    def dispatch_action(self, action, info):
+    def frames_with(self, *labels):
+        """
+        Finds the frames with labels from the label metadata,
+        so multi-frame actions only load and edit those frames.
+
+        Args:
+            labels (int): labels in the current feature
+
+        Returns:
+            list: sorted IDs of the frames with any of the labels
+        """
+        frame_ids = set()
+        for label in labels:
+            info = self.labels.cell_info[self.feature].get(label)
+            if info is not None:
+                frame_ids.update(info['frames'])
+        return sorted(frame_ids)
+
+    def dispatch_action(self, action, info, known_version=None):
         """
         Call an action method based on an action type.
 
@@ -176,18 +198,23 @@ class BaseEdit(object):
             action (str): name of action method after "action_"
                           e.g. "handle_draw" to call "action_handle_draw"
             info (dict): key value pairs with arguments for action
+            known_version (int): project version of the tracks that the front-end has
 
         Returns:
             dict: payload to send to frontend application
         """
         attr_name = 'action_{}'.format(action)
+        # Labels are colored relative to the highest label
+        max_label = self.project.get_max_label()
         try:
             action_fn = getattr(self, attr_name)
             action_fn(**info)
         except AttributeError:
             raise ValueError('Invalid action "{}"'.format(action))
         return self.project.make_payload(y=self.y_changed,
-                                         labels=self.labels_changed)
+                                         labels=self.labels_changed,
+                                         max_label=max_label,
+                                         known_version=known_version)
 
     def add_cell_info(self, add_label, frame):
         raise NotImplementedError('add_cell_info is not implemented in BaseEdit')
@@ -255,44 +282,46 @@ class BaseEdit(object):
             brush_size (int): radius of the brush
             erase (bool): sets target_value in trace area to 0 when True
         """
-        img = np.copy(self.frame[..., self.feature])
-        in_original = np.any(np.isin(img, brush_value))
-
-        img_draw = np.where(img == target_value, brush_value, img)
-        img_erase = np.where(img == brush_value, target_value, img)
+        stroke = rasterize_stroke(trace, brush_size // self.scale_factor,
+                                  (self.project.height, self.project.width))
+        if stroke is None:
+            self.y_changed = False
+            return
+        (y1, x1, y2, x2), brush_area = stroke
 
-        for loc in trace:
-            # each element of trace is an array with [y,x] coordinates of array
-            x_loc = loc[1]
-            y_loc = loc[0]
+        # Only the bounding box of the stroke can change
+        img = self.frame[..., self.feature]
+        box = np.copy(img[y1:y2, x1:x2])
+        in_box_original = np.any(box == brush_value)
 
-            brush_area = circle(y_loc, x_loc,
-                                brush_size // self.scale_factor,
-                                (self.project.height, self.project.width))
+        # do not overwrite or erase labels other than the one you're editing
+        if not erase:
+            box[brush_area & (box == target_value)] = brush_value
+        else:
+            box[brush_area & (box == brush_value)] = target_value
+        in_box_modified = np.any(box == brush_value)
 
-            # do not overwrite or erase labels other than the one you're editing
-            if not erase:
-                img[brush_area] = img_draw[brush_area]
-            else:
-                img[brush_area] = img_erase[brush_area]
+        # check for image change, in case pixels changed but no new or del cell
+        self.y_changed = np.any(box != img[y1:y2, x1:x2])
+        # if label metadata changed, labels_changed set to true with info helper functions
+        if not self.y_changed:
+            return
 
-        in_modified = np.any(np.isin(img, brush_value))
+        # The label is in the rest of the frame before and after the stroke
+        in_rest = False
+        if in_box_original != in_box_modified:
+            in_rest = np.count_nonzero(img == brush_value) > np.count_nonzero(
+                img[y1:y2, x1:x2] == brush_value)
+        self.frame[y1:y2, x1:x2, self.feature] = box
 
         # cell deletion
-        if in_original and not in_modified:
+        if in_box_original and not in_box_modified and not in_rest:
             self.del_cell_info(del_label=brush_value, frame=self.frame_id)
 
         # cell addition
-        elif in_modified and not in_original:
+        elif in_box_modified and not in_box_original and not in_rest:
             self.add_cell_info(add_label=brush_value, frame=self.frame_id)
 
-        # check for image change, in case pixels changed but no new or del cell
-        comparison = np.where(img != self.frame[..., self.feature])
-        self.y_changed = np.any(comparison)
-        # if label metadata changed, labels_changed set to true with info helper functions
-
-        self.frame[..., self.feature] = img
-
     def action_trim_pixels(self, label, x_location, y_location):
         """
         Remove any pixels with value label that are not connected to the
@@ -593,7 +622,8 @@ class ZStackEdit(BaseEdit):
         """
         new_label = self.project.get_max_label() + 1
         # Replace old label with new in every frame until end
-        for label_frame in self.project.label_frames[self.frame_id:]:
+        frame_ids = [frame_id for frame_id in self.frames_with(label) if frame_id >= self.frame_id]
+        for label_frame in self.project.get_label_frames(frame_ids):
             img = label_frame.frame[..., self.feature]
             img[img == label] = new_label
             # Update cell info for this frame
@@ -622,14 +652,14 @@ class ZStackEdit(BaseEdit):
         are different before sending action
         """
         # TODO: check on backend that labels are different?
-        # Check each frame for label_2
-        for label_frame in self.project.label_frames:
+        # Check each frame with label_2
+        for label_frame in self.project.get_label_frames(self.frames_with(label_2)):
             img = label_frame.frame[..., self.feature]
             # if label being replaced is present, remove it from image and update cell info dict
-            if np.any(np.isin(img, label_2)):
+            if np.any(img == label_2):
                 img = np.where(img == label_2, label_1, img)
-                self.add_cell_info(add_label=label_1, frame=self.frame_id)
-                self.del_cell_info(del_label=label_2, frame=self.frame_id)
+                self.add_cell_info(add_label=label_1, frame=label_frame.frame_id)
+                self.del_cell_info(del_label=label_2, frame=label_frame.frame_id)
                 label_frame.frame[..., self.feature] = img
 
     def action_swap_all_frame(self, label_1, label_2):
@@ -637,8 +667,7 @@ class ZStackEdit(BaseEdit):
         Replaces all label_1 pixels with label_2 across all frames
         in the current feature and vice versa.
         """
-
-        for label_frame in self.project.label_frames:
+        for label_frame in self.project.get_label_frames(self.frames_with(label_1, label_2)):
             img = label_frame.frame[..., self.feature]
             img = np.where(img == label_1, -1, img)
             img = np.where(img == label_2, label_1, img)
@@ -688,6 +717,97 @@ class ZStackEdit(BaseEdit):
         self.y_changed = True
         self.remake_cell_info()
 
+    def action_relabel_frame(self):
+        """
+        Relabels the cells in the current frame from 1 without skipping values.
+        Labels no longer match the same cells in other frames.
+        """
+        self.relabel_frames([self.frame_id])
+
+    def action_relabel_all_frames(self):
+        """
+        Relabels the cells in each frame from 1 without skipping values.
+        Labels no longer match the same cells across frames.
+        """
+        self.relabel_frames(range(self.project.num_frames))
+
+    def action_relabel_preserve(self):
+        """
+        Relabels the cells in all frames from 1 without skipping values,
+        so each label keeps matching the same cell across frames.
+        Labels missing from the label metadata get the labels after the others,
+        and the metadata is remade from the frames.
+        """
+        # all labels in the feature, with background first
+        cells = np.union1d(self.labels.cell_ids[self.feature], [0]).astype(int)
+        new_labels = relabel_lookup(cells)
+        # new labels of the labels missing from the metadata
+        missing = {}
+        for label_frame in self.project.get_label_frames(range(self.project.num_frames)):
+            img = label_frame.frame[..., self.feature]
+            frame_cells, cell_ids = np.unique(img, return_inverse=True)
+            index = np.searchsorted(cells, frame_cells).clip(max=len(cells) - 1)
+            frame_new_labels = new_labels[index]
+            is_missing = cells[index] != frame_cells
+            if np.any(is_missing):
+                frame_new_labels = frame_new_labels.astype(int)
+                for i in np.flatnonzero(is_missing).tolist():
+                    frame_new_labels[i] = missing.setdefault(int(frame_cells[i]),
+                                                             len(cells) + len(missing))
+            if np.any(frame_cells != frame_new_labels):
+                img = frame_new_labels[cell_ids].reshape(img.shape)
+                label_frame.frame[..., self.feature] = img
+                self.y_changed = True
+
+        if missing:
+            self.remake_cell_info()
+        # each cell keeps its frames under its new label
+        elif self.y_changed:
+            feature_info = self.labels.cell_info[self.feature]
+            relabeled_info = {}
+            for old_label, new_label in zip(cells[1:].tolist(), new_labels[1:].tolist()):
+                info = feature_info[old_label]
+                info['label'] = str(new_label)
+                relabeled_info[new_label] = info
+            self.labels.cell_info[self.feature] = relabeled_info
+            self.labels.cell_ids[self.feature] = np.array(sorted(relabeled_info), dtype=int)
+            self.labels_changed = True
+
+    def relabel_frames(self, frame_ids):
+        """
+        Relabels the cells in each frame from 1 without skipping values
+        and moves the frames in the label metadata to the new labels.
+
+        Args:
+            frame_ids (list): indices of the frames to relabel
+        """
+        feature_info = self.labels.cell_info[self.feature]
+        for label_frame in self.project.get_label_frames(frame_ids):
+            img = label_frame.frame[..., self.feature]
+            cells, cell_ids = np.unique(img, return_inverse=True)
+            new_labels = relabel_lookup(cells)
+            moved = cells != new_labels
+            if not np.any(moved):
+                continue
+            label_frame.frame[..., self.feature] = new_labels[cell_ids].reshape(img.shape)
+            frame_id = label_frame.frame_id
+            # remove the frame from every moved label before adding it to the new ones
+            for label in cells[moved].tolist():
+                info = feature_info.get(label)
+                if info is None:
+                    continue
+                info['frames'] = [frame for frame in info['frames'] if frame != frame_id]
+                if not info['frames']:
+                    del feature_info[label]
+            for label in new_labels[moved].tolist():
+                info = feature_info.setdefault(label, {'label': str(label),
+                                                       'frames': [],
+                                                       'slices': ''})
+                bisect.insort(info['frames'], frame_id)
+            self.y_changed = self.labels_changed = True
+
+        self.labels.cell_ids[self.feature] = np.array(sorted(feature_info), dtype=int)
+
     def action_save_zstack(self, bucket):
         # save file to BytesIO object
         store_npz = io.BytesIO()
@@ -833,7 +953,7 @@ class TrackEdit(BaseEdit):
         Replacing label_2 with label_1 in all frames.
         """
         # replace arrays
-        for label_frame in self.project.label_frames:
+        for label_frame in self.project.get_label_frames(self.frames_with(label_2)):
             img = label_frame.frame
             img = np.where(img == label_2, label_1, img)
             label_frame.frame = img
@@ -866,7 +986,7 @@ class TrackEdit(BaseEdit):
         Replace label_1 with label_2 on all frames and vice versa.
         """
         def relabel(old_label, new_label):
-            for label_frame in self.project.label_frames:
+            for label_frame in self.project.get_label_frames(self.frames_with(old_label)):
                 img = label_frame.frame
                 img[img == old_label] = new_label
                 label_frame.frame = img
@@ -904,7 +1024,7 @@ class TrackEdit(BaseEdit):
 
         with tarfile.open(fileobj=trk_file_obj, mode='w') as trks:
             with tempfile.NamedTemporaryFile('w') as lineage_file:
-                json.dump(self.labels.tracks, lineage_file, indent=1)
+                json.dump(dict(self.labels.tracks), lineage_file, indent=1)
                 lineage_file.flush()
                 trks.add(lineage_file.name, 'lineage.json')
 
@@ -983,151 +1103,86 @@ class TrackEdit(BaseEdit):
 def predict_zstack_cell_ids(img, next_img, threshold=0.1):
     """
     Predict labels for next_img based on intersection over union (iou)
-    with img. If cells don't meet threshold for iou, they don't count as
+    with img. Cells are matched one to one to maximize their total iou.
+    If cells don't meet threshold for iou, they don't count as
     matching enough to share label with "matching" cell in img. Cells
     that don't have a match in img (new cells) get a new label so that
     output relabeled_next does not skip label values (unless label values
     present in prior image need to be skipped to avoid conflating labels).
     """
-
-    # relabel to remove skipped values, keeps subsequent predictions cleaner
-    next_img = relabel_frame(next_img)
-
-    # create np array that can hold all pairings between cells in one
-    # image and cells in next image
-    iou = np.zeros((np.max(img) + 1, np.max(next_img) + 1))
-
-    vals = np.unique(img)
-    cells = vals[np.nonzero(vals)]
-
-    # nothing to predict off of
-    if len(cells) == 0:
-        return next_img
-
-    next_vals = np.unique(next_img)
-    next_cells = next_vals[np.nonzero(next_vals)]
-
-    # no values to reassign
-    if len(next_cells) == 0:
-        return next_img
-
-    # calculate IOUs
-    for i in cells:
-        for j in next_cells:
-            intersection = np.logical_and(img == i, next_img == j)
-            union = np.logical_or(img == i, next_img == j)
-            iou[i, j] = intersection.sum(axis=(0, 1)) / union.sum(axis=(0, 1))
-
-    # relabel cells appropriately
-
-    # relabeled_next holds cells as they get relabeled appropriately
-    relabeled_next = np.zeros(next_img.shape, dtype=np.uint16)
-
-    # max_indices[cell_from_next_img] -> cell from first image that matches it best
-    max_indices = np.argmax(iou, axis=0)
-
-    # put cells that into new image if they've been matched with another cell
-
-    # keep track of which (next_img)cells don't have matches
-    # this can be if (next_img)cell matched background, or if (next_img)cell matched
-    # a cell already used
-    unmatched_cells = []
-    # don't reuse cells (if multiple cells in next_img match one particular cell)
-    used_cells_src = []
-
-    # next_cell ranges between 0 and max(next_img)
-    # matched_cell is which cell in img matched next_cell the best
-
-    # this for loop does the matching between cells
-    for next_cell, matched_cell in enumerate(max_indices):
-        # if more than one match, look for best match
-        # otherwise the first match gets linked together, not necessarily reproducible
-
-        # matched_cell != 0 prevents adding the background to used_cells_src
-        if matched_cell != 0 and matched_cell not in used_cells_src:
-            bool_matches = np.where(max_indices == matched_cell)
-            count_matches = np.count_nonzero(bool_matches)
-            if count_matches > 1:
-                # for a given cell in img, which next_cell has highest iou
-                matching_next_options = np.argmax(iou, axis=1)
-                best_matched_next = matching_next_options[matched_cell]
-
-                # ignore if best_matched_next is the background
-                if best_matched_next != 0:
-                    if next_cell != best_matched_next:
-                        unmatched_cells = np.append(unmatched_cells, next_cell)
-                        continue
-                    else:
-                        # don't add if bad match
-                        if iou[matched_cell][best_matched_next] > threshold:
-                            relabeled_next = np.where(next_img == best_matched_next,
-                                                      matched_cell, relabeled_next)
-
-                        # if it's a bad match, we still need to add next_cell back
-                        # into relabeled next later
-                        elif iou[matched_cell][best_matched_next] <= threshold:
-                            unmatched_cells = np.append(unmatched_cells, best_matched_next)
-
-                        # in either case, we want to be done with the "matched_cell" from img
-                        used_cells_src = np.append(used_cells_src, matched_cell)
-
-            # matched_cell != 0 is still true
-            elif count_matches == 1:
-                # add the matched cell to the relabeled image
-                if iou[matched_cell][next_cell] > threshold:
-                    relabeled_next = np.where(next_img == next_cell, matched_cell, relabeled_next)
-                else:
-                    unmatched_cells = np.append(unmatched_cells, next_cell)
-
-                used_cells_src = np.append(used_cells_src, matched_cell)
-
-        elif matched_cell in used_cells_src and next_cell != 0:
-            # skip that pairing, add next_cell to unmatched_cells
-            unmatched_cells = np.append(unmatched_cells, next_cell)
-
-        # if the cell in next_img didn't match anything (and is not the background):
-        if matched_cell == 0 and next_cell != 0:
-            unmatched_cells = np.append(unmatched_cells, next_cell)
-            # note: this also puts skipped (nonexistent) labels into unmatched cells,
-            # main reason to relabel first
-
-    # figure out which labels we should use to label remaining, unmatched cells
-
-    # these are the values that have already been used in relabeled_next
-    relabeled_values = np.unique(relabeled_next)[np.nonzero(np.unique(relabeled_next))]
-
-    # to account for any new cells that appear, create labels by adding to the max number of cells
-    # assumes that these are new cells and that all prev labels have been assigned
-    # only make as many new labels as needed
-
-    current_max = max(np.max(cells), np.max(relabeled_values)) + 1
-
-    stringent_allowed = []
-    for additional_needed in range(len(unmatched_cells)):
-        stringent_allowed.append(current_max)
-        current_max += 1
-
-    # replace each unmatched cell with a value from the stringent_allowed list,
-    # add that relabeled cell to relabeled_next
-    if len(unmatched_cells) > 0:
-        for reassigned_cell in range(len(unmatched_cells)):
-            relabeled_next = np.where(next_img == unmatched_cells[reassigned_cell],
-                                      stringent_allowed[reassigned_cell], relabeled_next)
-
-    return relabeled_next
+    # number the cells in each image from 1 without skipping values, keeping 0 as background
+    cells, cell_ids = np.unique(img, return_inverse=True)
+    next_cells, next_ids = np.unique(next_img, return_inverse=True)
+    if cells[0] != 0:
+        cells = np.insert(cells, 0, 0)
+        cell_ids += 1
+    if next_cells[0] != 0:
+        next_cells = np.insert(next_cells, 0, 0)
+        next_ids += 1
+    num_cells, num_next_cells = len(cells), len(next_cells)
+
+    # nothing to predict off of, or no values to reassign
+    if num_cells == 1 or num_next_cells == 1:
+        return next_ids.reshape(next_img.shape).astype(np.uint16)
+
+    # count the pixels of each pair of overlapping cells in one image and in next image,
+    # without a table of every pair
+    pairs, intersection = np.unique(cell_ids * num_next_cells + next_ids, return_counts=True)
+    rows, cols = np.divmod(pairs, num_next_cells)
+    areas = np.bincount(cell_ids, minlength=num_cells)
+    next_areas = np.bincount(next_ids, minlength=num_next_cells)
+    overlaps = (rows != 0) & (cols != 0)
+    rows, cols, intersection = rows[overlaps], cols[overlaps], intersection[overlaps]
+    iou = intersection / (areas[rows] + next_areas[cols] - intersection)
+
+    # cells only match cells they overlap, so match each group of overlapping cells
+    # separately to maximize the total iou, and don't keep bad matches
+    graph = coo_matrix((iou, (rows, num_cells + cols)),
+                       shape=(num_cells + num_next_cells,) * 2)
+    _, groups = connected_components(graph, directed=False)
+    order = np.argsort(groups[rows], kind='stable')
+    rows, cols, iou = rows[order], cols[order], iou[order]
+    starts = np.flatnonzero(np.diff(groups[rows], prepend=-1))
+    sizes = np.diff(np.append(starts, len(rows)))
+
+    # relabel cells with a lookup from next cell to its new label
+    new_labels = np.zeros(num_next_cells, dtype=np.int64)
+    # most cells only overlap the same cell in the other image
+    single = starts[sizes == 1]
+    good = single[iou[single] > threshold]
+    new_labels[cols[good]] = cells[rows[good]]
+    for start, size in zip(starts[sizes > 1], sizes[sizes > 1]):
+        group = slice(start, start + size)
+        group_cells, row_ids = np.unique(rows[group], return_inverse=True)
+        group_next_cells, col_ids = np.unique(cols[group], return_inverse=True)
+        group_iou = np.zeros((len(group_cells), len(group_next_cells)))
+        group_iou[row_ids, col_ids] = iou[group]
+        matched, next_matched = linear_sum_assignment(-group_iou)
+        good = group_iou[matched, next_matched] > threshold
+        new_labels[group_next_cells[next_matched[good]]] = cells[group_cells[matched[good]]]
+
+    # new cells get labels after the highest label in img
+    unmatched = np.flatnonzero(new_labels[1:] == 0) + 1
+    new_labels[unmatched] = cells[-1] + 1 + np.arange(len(unmatched))
+
+    dtype = np.promote_types(np.uint16, np.min_scalar_type(new_labels.max()))
+    return new_labels.astype(dtype)[next_ids].reshape(next_img.shape)
+
+
+def relabel_lookup(cells, start_val=1):
+    '''
+    lookup table from each of the sorted labels in cells to labels starting
+    from start_val without skipping values, keeping 0 as background
+    '''
+    is_cell = cells != 0
+    num_cells = np.count_nonzero(is_cell)
+    dtype = np.promote_types(np.uint16, np.min_scalar_type(start_val + num_cells))
+    new_labels = np.zeros(len(cells), dtype=dtype)
+    new_labels[is_cell] = np.arange(start_val, start_val + num_cells)
+    return new_labels
 
 
 def relabel_frame(img, start_val=1):
-    '''relabel cells in frame starting from 1 without skipping values'''
-
-    # cells in image to be relabeled
-    cell_list = np.unique(img)
-    cell_list = cell_list[np.nonzero(cell_list)]
-
-    relabeled_cell_list = range(start_val, len(cell_list) + start_val)
-
-    relabeled_img = np.zeros(img.shape, dtype=np.uint16)
-    for i, cell in enumerate(cell_list):
-        relabeled_img = np.where(img == cell, relabeled_cell_list[i], relabeled_img)
-
-    return relabeled_img
+    '''relabel cells in frame starting from start_val without skipping values'''
+    cells, cell_ids = np.unique(img, return_inverse=True)
+    return relabel_lookup(cells, start_val)[cell_ids].reshape(img.shape)
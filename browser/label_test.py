@@ -155,6 +155,50 @@ class TestBaseEdit():
             assert edit.y_changed
             assert edit.labels_changed
 
+    def test_action_handle_draw(self, app):
+        labels = np.zeros((1, 10, 10, 1))
+        labels[0, 0:2, 0:2] = 2
+        project = models.Project.create(DummyLoader(labels=labels))
+        edit = label.ZStackEdit(project)
+        trace = [[5, 5], [5, 6], [5, 6], [5, 7]]
+
+        with app.app_context():
+            # Drawing a new label adds it to the frame
+            edit.action_handle_draw(trace, target_value=0, brush_value=1,
+                                    brush_size=2, erase=False)
+            expected = labels[0, ..., 0].copy()
+            # A radius of 2 covers the 3x3 square around each point
+            expected[4:7, 4:9] = 1
+            np.testing.assert_array_equal(edit.frame[..., 0], expected)
+            assert edit.y_changed
+            assert 1 in project.labels.cell_info[0]
+
+            # Erasing the whole label deletes it
+            edit.action_handle_draw(trace, target_value=0, brush_value=1,
+                                    brush_size=2, erase=True)
+            np.testing.assert_array_equal(edit.frame[..., 0], labels[0, ..., 0])
+            assert 1 not in project.labels.cell_info[0]
+
+    def test_action_handle_draw_other_labels_unchanged(self, app):
+        labels = np.zeros((1, 10, 10, 1))
+        labels[0, 0:5, 0:5] = 2
+        labels[0, 8:, 8:] = 1
+        project = models.Project.create(DummyLoader(labels=labels))
+        edit = label.ZStackEdit(project)
+
+        with app.app_context():
+            edit.action_handle_draw([[3, 3], [4, 4]], target_value=0, brush_value=1,
+                                    brush_size=3, erase=False)
+            np.testing.assert_array_equal(edit.frame[..., 0] == 2, labels[0, ..., 0] == 2)
+            # Label 1 was already in the frame
+            assert project.labels.cell_info[0][1]['frames'] == [0]
+
+            # Erasing part of a label keeps it in the frame
+            edit.action_handle_draw([[9, 9]], target_value=0, brush_value=1,
+                                    brush_size=1, erase=True)
+            assert edit.frame[9, 9, 0] == 0
+            assert 1 in project.labels.cell_info[0]
+
 
 class TestZStackEdit():
 
@@ -250,6 +294,22 @@ class TestZStackEdit():
             edit.action_replace(cell1, cell2)
             np.testing.assert_array_equal(edit.project.label_array, expected_labels)
 
+    def test_action_replace_edits_only_frames_with_label(self, app):
+        labels = np.zeros((5, 2, 2, 1))
+        labels[0, 0] = 1
+        labels[[1, 3], 1] = 2
+        project = models.Project.create(DummyLoader(labels=labels))
+        edit = label.ZStackEdit(project)
+        expected_labels = np.where(labels == 2, 1, labels)
+
+        with app.app_context():
+            edit.action_replace(1, 2)
+            loaded = {frame_id for _, frame_id in project._loaded_frames}
+            assert loaded == {1, 3}
+            np.testing.assert_array_equal(edit.project.label_array, expected_labels)
+            assert edit.labels.cell_info[0][1]['frames'] == [0, 1, 3]
+            assert 2 not in edit.labels.cell_info[0]
+
     def test_action_swap_all_frame(self, app):
         # three 2 x 2 frame with two labels: 1s in top row, 2s in bottom
         frame = np.array([[[1], [1]],
@@ -272,6 +332,97 @@ class TestZStackEdit():
             np.testing.assert_array_equal(edit.project.label_array, expected_labels)
             assert edit.y_changed
 
+    def test_action_relabel_frame(self, app):
+        labels = np.zeros((2, 2, 2, 1))
+        labels[:, 0] = 3
+        labels[:, 1, 1] = 7
+        project = models.Project.create(DummyLoader(labels=labels))
+        edit = label.ZStackEdit(project)
+        expected_labels = labels.copy()
+        expected_labels[1] = np.array([[[1], [1]],
+                                       [[0], [2]]])
+
+        with app.app_context():
+            edit.project.frame = 1
+            edit.action_relabel_frame()
+            np.testing.assert_array_equal(edit.project.label_array, expected_labels)
+            assert edit.y_changed and edit.labels_changed
+            assert edit.labels.cell_info[0] == {
+                1: {'label': '1', 'frames': [1], 'slices': ''},
+                2: {'label': '2', 'frames': [1], 'slices': ''},
+                3: {'label': '3', 'frames': [0], 'slices': ''},
+                7: {'label': '7', 'frames': [0], 'slices': ''},
+            }
+            np.testing.assert_array_equal(edit.labels.cell_ids[0], [1, 2, 3, 7])
+
+    def test_action_relabel_all_frames(self, app):
+        labels = np.zeros((3, 2, 2, 1))
+        labels[0, 0] = 2
+        labels[1, 0, 0] = 5
+        labels[1, 1] = 2
+        labels[2, 1, 1] = 1
+        project = models.Project.create(DummyLoader(labels=labels))
+        edit = label.ZStackEdit(project)
+        expected_labels = labels.copy()
+        expected_labels[0, 0] = 1
+        expected_labels[1, 0, 0] = 2
+        expected_labels[1, 1] = 1
+
+        with app.app_context():
+            edit.action_relabel_all_frames()
+            np.testing.assert_array_equal(edit.project.label_array, expected_labels)
+            expected_maker = label.LabelInfoMaker(expected_labels)
+            assert edit.labels.cell_info == expected_maker.cell_info
+            np.testing.assert_array_equal(edit.labels.cell_ids[0], expected_maker.cell_ids[0])
+
+    def test_action_relabel_preserve(self, app):
+        labels = np.zeros((3, 2, 2, 1))
+        labels[0, 0] = 4
+        labels[1, 0, 0] = 9
+        labels[1, 1] = 4
+        labels[2, 1, 1] = 9
+        project = models.Project.create(DummyLoader(labels=labels))
+        edit = label.ZStackEdit(project)
+        expected_labels = np.where(labels == 4, 1, np.where(labels == 9, 2, 0))
+
+        with app.app_context():
+            edit.action_relabel_preserve()
+            np.testing.assert_array_equal(edit.project.label_array, expected_labels)
+            assert edit.labels.cell_info[0] == {
+                1: {'label': '1', 'frames': [0, 1], 'slices': ''},
+                2: {'label': '2', 'frames': [1, 2], 'slices': ''},
+            }
+            np.testing.assert_array_equal(edit.labels.cell_ids[0], [1, 2])
+
+            # labels already start from 1 without skipping values
+            edit = label.ZStackEdit(project)
+            edit.action_relabel_preserve()
+            assert not edit.y_changed and not edit.labels_changed
+
+    def test_action_relabel_preserve_label_missing_from_metadata(self, app):
+        labels = np.zeros((2, 2, 2, 1))
+        labels[0, 0] = 4
+        labels[0, 1, 1] = 7
+        labels[1, 0] = 9
+        labels[1, 1] = 7
+        project = models.Project.create(DummyLoader(labels=labels))
+        edit = label.ZStackEdit(project)
+        del edit.labels.cell_info[0][7]
+        edit.labels.cell_ids[0] = np.array([4, 9])
+        # labels in the metadata keep their order, and missing labels come after them
+        expected_labels = np.select([labels == 4, labels == 9, labels == 7], [1, 2, 3])
+
+        with app.app_context():
+            edit.action_relabel_preserve()
+            np.testing.assert_array_equal(edit.project.label_array, expected_labels)
+            assert edit.labels_changed
+            assert edit.labels.cell_info[0] == {
+                1: {'label': '1', 'frames': [0], 'slices': ''},
+                2: {'label': '2', 'frames': [1], 'slices': ''},
+                3: {'label': '3', 'frames': [0, 1], 'slices': ''},
+            }
+            np.testing.assert_array_equal(edit.labels.cell_ids[0], [1, 2, 3])
+
     def test_action_active_contour_other_labels_unchanged(self, app):
         """
         Tests that other labels not affected by active contouring a label
@@ -459,3 +610,93 @@ class TestTrackEdit():
             assert expected_new_cell in edit.labels.cell_ids[feature]
             assert prev_track['frames'] == (tracks[cell]['frames'] +
                                             tracks[expected_new_cell]['frames'])
+
+    def test_action_swap_tracks_edits_only_frames_with_labels(self, app):
+        labels = np.array([1, 2, 0, 1]).reshape((4, 1, 1, 1))
+        project = models.Project.create(DummyLoader(labels=labels, path='test.trk'))
+        edit = label.TrackEdit(project)
+        tracks = edit.labels.tracks
+
+        with app.app_context():
+            edit.action_swap_tracks(1, 2)
+            loaded = {frame_id for _, frame_id in project._loaded_frames}
+            assert loaded == {0, 1, 3}
+            np.testing.assert_array_equal(edit.project.label_array.ravel(), [2, 1, 0, 2])
+            assert tracks[1]['frames'] == [1]
+            assert tracks[2]['frames'] == [0, 3]
+
+
+def test_predict_zstack_cell_ids():
+    img = np.zeros((10, 10), dtype='int32')
+    img[0:4, 0:4] = 1
+    img[0:4, 6:10] = 3
+    img[6:10, 0:4] = 2
+    next_img = np.zeros((10, 10), dtype='int32')
+    next_img[0:4, 0:4] = 2  # same cell as 1
+    next_img[0:4, 6:9] = 5  # most of cell 3
+    next_img[6:8, 6:8] = 7  # new cell
+    next_img[9, 0] = 8  # too small a part of cell 2
+
+    predicted = label.predict_zstack_cell_ids(img, next_img)
+
+    expected = np.zeros((10, 10))
+    expected[0:4, 0:4] = 1
+    expected[0:4, 6:9] = 3
+    # new cells get labels after the highest label
+    expected[6:8, 6:8] = 4
+    expected[9, 0] = 5
+    np.testing.assert_array_equal(predicted, expected)
+
+
+def test_predict_zstack_cell_ids_one_match_per_cell():
+    img = np.zeros((4, 10), dtype='int32')
+    img[:, 0:10] = 1
+    next_img = np.zeros((4, 10), dtype='int32')
+    next_img[:, 0:4] = 1
+    next_img[:, 4:10] = 2
+
+    predicted = label.predict_zstack_cell_ids(img, next_img)
+
+    # the larger cell keeps the label, and the other cell is new
+    np.testing.assert_array_equal(predicted[:, 4:10], 1)
+    np.testing.assert_array_equal(predicted[:, 0:4], 2)
+
+
+def test_predict_zstack_cell_ids_overlapping_groups():
+    img = np.zeros((4, 10), dtype='int32')
+    img[:, 0:5] = 3
+    img[:, 5:10] = 6
+    next_img = np.zeros((4, 10), dtype='int32')
+    next_img[:, 0:3] = 1
+    next_img[:, 3:8] = 2  # overlaps both cells
+    next_img[:, 8:10] = 4
+    next_img[0, 0] = 9  # overlaps no cell
+    next_img[3, 9] = 0
+    img[3, 9] = 8  # overlaps no cell
+
+    predicted = label.predict_zstack_cell_ids(img, next_img)
+
+    # the matches with the highest total iou keep their labels
+    np.testing.assert_array_equal(predicted[1:, 0:3], 3)
+    np.testing.assert_array_equal(predicted[:, 3:8], 6)
+    np.testing.assert_array_equal(predicted[:3, 8:10], 9)
+    assert predicted[0, 0] == 10
+
+
+def test_predict_zstack_cell_ids_no_cells():
+    img = np.zeros((2, 2), dtype='int32')
+    next_img = np.array([[0, 4], [9, 9]])
+
+    predicted = label.predict_zstack_cell_ids(img, next_img)
+
+    np.testing.assert_array_equal(predicted, [[0, 1], [2, 2]])
+    np.testing.assert_array_equal(label.predict_zstack_cell_ids(next_img, img), img)
+
+
+def test_relabel_frame():
+    img = np.array([[0, 7, 7],
+                    [3, 0, 100000]])
+
+    np.testing.assert_array_equal(label.relabel_frame(img), [[0, 2, 2], [1, 0, 3]])
+    np.testing.assert_array_equal(label.relabel_frame(img, start_val=5), [[0, 6, 6], [5, 0, 7]])
+    np.testing.assert_array_equal(label.relabel_frame(np.zeros((2, 2))), np.zeros((2, 2)))
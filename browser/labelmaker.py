@@ -2,6 +2,8 @@
 
 import numpy as np
 
+from parallel import map_frames
+
 
 class LabelInfoMaker():
     """
@@ -29,43 +31,29 @@ class LabelInfoMaker():
     @property
     def cell_ids(self):
         if self._cell_ids is None:
-            self.compute_ids()
+            self.compute()
         return self._cell_ids
 
     @property
     def cell_info(self):
         if self._cell_info is None:
-            if self._tracking:
-                self.compute_tracks()
-            else:
-                self.compute_info()
+            self.compute()
         return self._cell_info
 
-    def compute_ids(self):
+    def compute(self):
         """
-        Make the cell_ids dict.
+        Make the cell_ids and cell_info dicts, which are found in the same pass over the labels.
         """
-        self._cell_ids = {}
-        for feature in range(self.num_features):
-            self.compute_feature_ids(feature)
-
-    def compute_feature_ids(self, feature):
-        """
-        Make a list of cell IDs present in a given feature.
-
-        Args:
-            feature (int): which feature to find IDs
-        """
-        feature = int(feature)
-        # Find the labels in the feature
-        feature_labels = self.labels[..., feature]
-        feature_cells = np.unique(feature_labels)[np.nonzero(np.unique(feature_labels))]
-        self.cell_ids[feature] = feature_cells
+        if self._tracking:
+            self.compute_tracks()
+        else:
+            self.compute_info()
 
     def compute_info(self):
         """
         Make the cell_info dict.
         """
+        self._cell_ids = {}
         self._cell_info = {}
         for feature in range(self.num_features):
             self.compute_feature_info(feature)
@@ -76,21 +64,15 @@ class LabelInfoMaker():
             feature (int): which feature to recompute label metadata for
         """
         feature = int(feature)
-        # Find the labels in the feature
-        feature_labels = self.labels[..., feature]
-        feature_cells = np.unique(feature_labels)[np.nonzero(np.unique(feature_labels))]
+        cell_frames = self.get_cell_frames(feature)
         # Compute the label metadata for the feature
         feature_info = {}
-        for cell in feature_cells:
-            cell = int(cell)
+        for cell in sorted(cell_frames):
             feature_info[cell] = {'label': str(cell),
-                                  'frames': [],
+                                  'frames': cell_frames[cell],
                                   'slices': ''}
-            for frame in range(self.num_frames):
-                if cell in feature_labels[frame, ...]:
-                    feature_info[cell]['frames'].append(int(frame))
-        self.cell_ids[feature] = feature_cells
-        self.cell_info[feature] = feature_info
+        self._cell_ids[feature] = self.get_cell_ids(cell_frames)
+        self._cell_info[feature] = feature_info
 
     def compute_tracks(self):
         """
@@ -100,18 +82,54 @@ class LabelInfoMaker():
         """
         assert self.num_features == 1
 
-        cells = np.unique(self.labels)[np.nonzero(np.unique(self.labels))]
+        cell_frames = self.get_cell_frames(0)
         tracks = {}
-        for cell in cells:
-            cell = int(cell)
+        for cell in sorted(cell_frames):
             tracks[cell] = {'label': str(cell),
-                            'frames': [],
+                            'frames': cell_frames[cell],
                             'frame_div': None,
                             'daughters': [],
                             'capped': False,
                             'parent': None}
-            for frame in range(self.labels.shape[0]):
-                if cell in self.labels[frame, ...]:
-                    tracks[cell]['frames'].append(int(frame))
-        self._cell_ids = {0: cells}
+        self._cell_ids = {0: self.get_cell_ids(cell_frames)}
         self._cell_info = {0: tracks}
+
+    def get_cell_frames(self, feature):
+        """
+        Finds the frames of every label in a feature in a single pass over the frames,
+        finding the labels in each frame in parallel for large stacks.
+
+        Args:
+            feature (int): which feature to find the frames of the labels in
+
+        Returns:
+            dict: maps each label in the feature to the sorted list of frames it is in
+        """
+        cell_frames = {}
+        frame_cells = map_frames(get_frame_cells, self.labels[..., feature])
+        for frame, cells in enumerate(frame_cells):
+            for cell in cells:
+                cell_frames.setdefault(int(cell), []).append(frame)
+        return cell_frames
+
+    def get_cell_ids(self, cell_frames):
+        """
+        Args:
+            cell_frames (dict): maps each label in a feature to its frames
+
+        Returns:
+            numpy.array: sorted labels in the feature, with the dtype of the labels
+        """
+        return np.array(sorted(cell_frames), dtype=self.labels.dtype)
+
+
+def get_frame_cells(frame):
+    """
+    Args:
+        frame (np.array): label frame
+
+    Returns:
+        list: labels in the frame, without the background
+    """
+    cells = np.unique(frame)
+    return cells[cells != 0].tolist()
@@ -60,6 +60,21 @@ class TestLabelInfoMaker():
         assert self.compare_cell_ids(labeler.cell_ids, expected_ids)
         assert labeler.cell_info == expected_info
 
+    def test_labels_in_some_frames(self):
+        labels = np.zeros((3, 2, 2, 2), dtype='int32')
+        labels[0, 0, 0, 0] = 5
+        labels[2, 1, :, 0] = 5
+        labels[1, 0, 1, 0] = 3
+        labels[1, :, :, 1] = 3
+        expected_ids = {0: np.array([3, 5]), 1: np.array([3])}
+        expected_info = {0: {3: {'label': '3', 'frames': [1], 'slices': ''},
+                             5: {'label': '5', 'frames': [0, 2], 'slices': ''}},
+                         1: {3: {'label': '3', 'frames': [1], 'slices': ''}}}
+        labeler = LabelInfoMaker(labels)
+
+        assert self.compare_cell_ids(labeler.cell_ids, expected_ids)
+        assert labeler.cell_info == expected_info
+
     def test_tracking_empty(self):
         labels = np.zeros((1, 1, 1, 1))
         expected_ids = {0: np.array([])}
@@ -85,6 +100,14 @@ class TestLabelInfoMaker():
         assert self.compare_cell_ids(labeler.cell_ids, expected_ids)
         assert labeler.cell_info == expected_info
 
+    def test_tracking_cell_ids_before_info(self):
+        labels = np.array([[[[2]]], [[[0]]], [[[2]]]])
+        labeler = LabelInfoMaker(labels, tracking=True)
+
+        assert self.compare_cell_ids(labeler.cell_ids, {0: np.array([2])})
+        assert labeler.cell_info[0][2]['frames'] == [0, 2]
+        assert labeler.cell_info[0][2]['daughters'] == []
+
     def test_tracking_two_features(self):
         labels = np.ones((1, 1, 1, 2))
         with pytest.raises(ValueError):
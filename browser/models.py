@@ -4,36 +4,143 @@ from __future__ import division
 from __future__ import print_function
 
 import base64
-import copy
+import collections.abc
 import enum
+import functools
+import io
+import json
 import logging
+import math
 import os
+import pickle
+import struct
 import timeit
+import zlib
 from secrets import token_urlsafe
 
 from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
-from matplotlib import pyplot as plt
 import numpy as np
-from skimage.exposure import rescale_intensity
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.mutable import Mutable
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy.schema import PrimaryKeyConstraint, ForeignKeyConstraint
+from sqlalchemy.types import TypeDecorator
 
-from imgutils import pngify, add_outlines
+from caches import ProjectCache, RenderCache
+from config import FRAME_CODEC, FRAME_COMPRESSION_LEVEL, RGB_PERCENTILES
+from config import PROJECT_CACHE_SIZE, RENDER_CACHE_SIZE, LABEL_TILE_SIZE, PYRAMID_TILE_SIZE
+from imgutils import render_image, add_outlines, update_outlines, changed_box
+from imgutils import count_pyramid_levels, downsample
+from imgutils import encode_array, positive_percentiles
+from parallel import map_frames, timed
 
 
 logger = logging.getLogger('models.Project')  # pylint: disable=C0103
 # Accessing relationships (like project.label_frames) issues a Query, causing a flush
 # autoflush=False prevents the flush, so we still access the db.session.dirty after the query
 db = SQLAlchemy(session_options={'autoflush': False})  # pylint: disable=C0103
+# Decoded frames and label metadata of recently used projects in this worker process
+project_cache = ProjectCache(PROJECT_CACHE_SIZE * 1024 ** 2)  # pylint: disable=C0103
+render_cache = RenderCache(RENDER_CACHE_SIZE * 1024 ** 2)  # pylint: disable=C0103
+
+
+class NdarrayType(TypeDecorator):
+    """
+    Stores numpy arrays as a small header followed by the array buffer.
+
+    The header records the dtype, shape and codec of the buffer, so arrays
+    are decoded with np.frombuffer instead of being unpickled.
+    Rows written as pickled arrays (before this type existed) are still read.
+
+    Args:
+        codec (str): 'raw' stores the buffer as is, 'zlib' compresses it
+        level (int): zlib compression level
+        writable (bool): when False, decoded arrays are read-only views
+                         of the stored buffer and are not copied
+    """
+    impl = db.LargeBinary
+
+    MAGIC = b'\x93NDA'
+    PREFIX = struct.Struct('<4sH')
+    ALIGNMENT = 16
+    CODECS = ('raw', 'zlib')
+
+    def __init__(self, codec=FRAME_CODEC, level=FRAME_COMPRESSION_LEVEL,
+                 writable=True, **kwargs):
+        super(NdarrayType, self).__init__(**kwargs)
+        if codec not in self.CODECS:
+            raise ValueError('Invalid codec "{}", choose from {}'.format(codec, self.CODECS))
+        self.codec = codec
+        self.level = level
+        self.writable = writable
+
+    def process_bind_param(self, value, dialect):
+        if value is None or isinstance(value, bytes):
+            return value
+        return self.encode(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return self.decode(value)
+
+    def encode(self, array):
+        """
+        Args:
+            array (np.array): array to store
+
+        Returns:
+            bytes: header and (compressed) buffer of the array
+        """
+        array = np.ascontiguousarray(array)
+        header = json.dumps({
+            'dtype': array.dtype.str,
+            'shape': array.shape,
+            'codec': self.codec,
+        }).encode('ascii')
+        # Pad the header so the buffer starts at an aligned offset
+        padding = -(self.PREFIX.size + len(header)) % self.ALIGNMENT
+        header += b' ' * padding
+        buffer = memoryview(array.reshape(-1).view(np.uint8))
+        if self.codec == 'zlib':
+            buffer = zlib.compress(buffer, self.level)
+        return b''.join([self.PREFIX.pack(self.MAGIC, len(header)), header, buffer])
+
+    def decode(self, value):
+        """
+        Args:
+            value (bytes): stored array, either encoded by this type or pickled
+
+        Returns:
+            np.array: decoded array
+        """
+        if not value.startswith(self.MAGIC):
+            # Legacy PickleType row
+            return pickle.loads(value)
+        magic, header_size = self.PREFIX.unpack_from(value)
+        offset = self.PREFIX.size + header_size
+        header = json.loads(bytes(value[self.PREFIX.size:offset]).decode('ascii'))
+        if header['codec'] == 'zlib':
+            buffer = zlib.decompress(memoryview(value)[offset:])
+            offset = 0
+        else:
+            buffer = value
+        array = np.frombuffer(buffer, dtype=np.dtype(header['dtype']), offset=offset)
+        array = array.reshape(header['shape'])
+        if self.writable:
+            array = array.copy()
+        return array
 
 
 @compiles(db.PickleType, 'mysql')
+@compiles(NdarrayType, 'mysql')
 def compile_pickle_mysql(type_, compiler, **kw):
     """
-    Replaces default BLOB with LONGBLOB for PickleType columns on MySQL backend.
+    Replaces default BLOB with LONGBLOB for PickleType and NdarrayType columns on MySQL backend.
     BLOB (64 kB) truncates pickled objects, while LONGBLOB (4 GB) stores it in full.
     TODO: change to MEDIUMBLOB (16 MB)?
     """
@@ -88,15 +195,18 @@ class Project(db.Model):
     num_channels = db.Column(db.Integer, nullable=False)
     num_features = db.Column(db.Integer, nullable=False)
     rgb = db.Column(db.Boolean, default=False)
+    # Stack-wide percentiles to rescale RGB frames with; frames use their own when null
+    rgb_percentiles = db.Column(NdarrayType())
     frame = db.Column(db.Integer, default=0)
     channel = db.Column(db.Integer, default=0)
     feature = db.Column(db.Integer, default=0)
     scale_factor = db.Column(db.Float, default=1)
-    colormap = db.Column(db.PickleType)
+    # Increases when the project data changes to invalidate cached frames
+    version = db.Column(db.Integer, nullable=False, default=0)
 
-    raw_frames = db.relationship('RawFrame', backref='project')
-    rgb_frames = db.relationship('RGBFrame', backref='project')
-    label_frames = db.relationship('LabelFrame', backref='project',
+    raw_frames = db.relationship('RawFrame', backref='project', order_by='RawFrame.frame_id')
+    rgb_frames = db.relationship('RGBFrame', backref='project', order_by='RGBFrame.frame_id')
+    label_frames = db.relationship('LabelFrame', backref='project', order_by='LabelFrame.frame_id',
                                    # Delete frames detached by undo/redo
                                    cascade='save-update, merge, delete, delete-orphan')
     labels = db.relationship('Labels', backref='project', uselist=False,
@@ -124,21 +234,17 @@ class Project(db.Model):
         self.width = raw.shape[2]
         self.num_channels = raw.shape[-1]
         self.num_features = label.shape[-1]
-        cmap = plt.get_cmap('viridis')
-        cmap.set_bad('black')
-        self.colormap = cmap
+        self.version = 0
 
         if self.is_track:
             # Track files require a different scale factor
             self.scale_factor = 2
 
-        # Create frames from raw, RGB, and labeled images
-        self.raw_frames = [RawFrame(i, frame)
-                           for i, frame in enumerate(raw)]
-        self.rgb_frames = [RGBFrame(i, frame)
-                           for i, frame in enumerate(raw)]
-        self.label_frames = [LabelFrame(i, frame)
-                             for i, frame in enumerate(label)]
+        if RGB_PERCENTILES == 'stack':
+            self.rgb_percentiles = RGBFrame.get_percentiles(raw)
+
+        # Frames are inserted in bulk by Project.create
+        # RGB frames are created when first displayed
 
         # Create label metadata
         self.labels = Labels()
@@ -151,12 +257,138 @@ class Project(db.Model):
     @property
     def label_array(self):
         """Compiles all label frames into a single numpy array."""
-        return np.array([frame.frame for frame in self.label_frames])
+        return np.array([frame.frame for frame in self._load_frames(LabelFrame)])
 
     @property
     def raw_array(self):
         """Compiles all raw frames into a single numpy array."""
-        return np.array([frame.frame for frame in self.raw_frames])
+        return np.array([frame.frame for frame in self._load_frames(RawFrame)])
+
+    def get_label_frame(self, frame_id):
+        """
+        Args:
+            frame_id (int): index of the frame
+
+        Returns:
+            LabelFrame: label frame of the project, loaded without the other frames
+        """
+        return self._get_frame(LabelFrame, frame_id)
+
+    def get_label_frames(self, frame_ids):
+        """
+        Loads label frames of the project, querying the frames that are not loaded yet together.
+
+        Args:
+            frame_ids (list): indices of the frames
+
+        Returns:
+            list: label frames in the order of frame_ids, without frames that do not exist
+        """
+        table = LabelFrame.__tablename__
+        frame_ids = [int(frame_id) for frame_id in frame_ids]
+        loaded = self._loaded_frames
+        missing = [frame_id for frame_id in frame_ids if (table, frame_id) not in loaded]
+        cached = [frame_id for frame_id in missing if (self.id, table, frame_id) in project_cache]
+        uncached = [frame_id for frame_id in missing if frame_id not in cached]
+        for ids, undefer in ((cached, False), (uncached, True)):
+            if not ids:
+                continue
+            query = (db.session.query(LabelFrame)
+                     .filter(LabelFrame.project_id == self.id)
+                     .filter(LabelFrame.frame_id.in_(ids)))
+            if undefer:
+                # Load the deferred arrays with the rows instead of in a query for each
+                query = query.options(db.undefer('frame'))
+            for label_frame in query:
+                loaded[(table, label_frame.frame_id)] = label_frame
+        return [loaded[(table, frame_id)] for frame_id in frame_ids if (table, frame_id) in loaded]
+
+    def get_raw_frame(self, frame_id):
+        """
+        Args:
+            frame_id (int): index of the frame
+
+        Returns:
+            RawFrame: raw frame of the project, loaded without the other frames
+        """
+        return self._get_frame(RawFrame, frame_id)
+
+    def get_rgb_frame(self, frame_id):
+        """
+        Creates the RGB frame from the raw frame the first time it is requested,
+        as most projects are never displayed in RGB.
+        The new frame is saved with the next commit.
+
+        Args:
+            frame_id (int): index of the frame
+
+        Returns:
+            RGBFrame: RGB frame of the project, loaded without the other frames
+        """
+        rgb_frame = self._get_frame(RGBFrame, frame_id)
+        if rgb_frame is None:
+            start = timeit.default_timer()
+            rgb_frame = RGBFrame(frame_id, self.get_raw_frame(frame_id).frame,
+                                 percentiles=self.rgb_percentiles)
+            rgb_frame.project_id = self.id
+            db.session.add(rgb_frame)
+            self._loaded_frames[(RGBFrame.__tablename__, frame_id)] = rgb_frame
+            logger.debug('Created RGB frame %s for project %s in %ss.',
+                         frame_id, self.id, timeit.default_timer() - start)
+        return rgb_frame
+
+    @property
+    def _loaded_frames(self):
+        """
+        The session only holds weak references to unchanged rows, so the project
+        keeps the frames it loaded alive for changes to be detected.
+
+        Returns:
+            dict: maps (table, frame ID) to frames loaded by the project
+        """
+        return vars(self).setdefault('_loaded_frames', {})
+
+    def _get_frame(self, model, frame_id):
+        """
+        Loads one frame of the project by its primary key.
+        Frames already in the session are not queried again,
+        and frames in the project cache are not read from the database.
+
+        Args:
+            model (db.Model): RawFrame, RGBFrame, or LabelFrame
+            frame_id (int): index of the frame
+
+        Returns:
+            db.Model: the frame row, or None if it does not exist
+        """
+        key = (model.__tablename__, frame_id)
+        if key not in self._loaded_frames:
+            query = db.session.query(model)
+            if (self.id, model.__tablename__, frame_id) not in project_cache:
+                # Load the deferred array with the row instead of in a second query
+                query = query.options(db.undefer('frame'))
+            frame = query.get((self.id, frame_id))
+            if frame is None:
+                return None
+            self._loaded_frames[key] = frame
+        return self._loaded_frames[key]
+
+    def _load_frames(self, model):
+        """
+        Loads all frames of the project in a single query,
+        as frame columns are otherwise loaded one row at a time.
+
+        Args:
+            model (db.Model): RawFrame, RGBFrame, or LabelFrame
+
+        Returns:
+            list: frames of the project ordered by frame ID
+        """
+        return (db.session.query(model)
+                .options(db.undefer('frame'))
+                .filter_by(project_id=self.id)
+                .order_by(model.frame_id)
+                .all())
 
     @property
     def is_zstack(self):
@@ -179,17 +411,22 @@ class Project(db.Model):
         """
         start = timeit.default_timer()
         project = db.session.query(Project).filter_by(token=token).first()
+        if project is not None:
+            project_cache.validate(project.id, project.token, project.version)
         logger.debug('Got project %s in %ss.',
                      token, timeit.default_timer() - start)
         return project
 
     @staticmethod
-    def create(loader):
+    def create(loader, batch_size=50):
         """
         Create a new project in the Project table.
+        The frames are serialized and inserted in bulk,
+        all in the same transaction as the project.
 
         Args:
             loader (Loader): loads or creates raw_array, label_array, cell_ids, & cell_info
+            batch_size (int): number of frames to serialize before inserting them
 
         Returns:
             Project: new row in the Project table
@@ -202,25 +439,78 @@ class Project(db.Model):
             if not db.session.query(Project).filter_by(token=token).first():
                 new_project.token = token
                 break
+        load_time = timeit.default_timer() - start
+
         db.session.add(new_project)
-        db.session.commit()
-        new_project.create_memento('create_project', all_frames=True)
-        db.session.commit()
-        logger.debug('Created new project %s (id %s) in %ss.',
-                     new_project.token, new_project.id, timeit.default_timer() - start)
+        # Flush to insert the project before its frames
+        db.session.flush()
+        new_project.create_memento('create_project')
+        db.session.flush()
+        serialize_time, insert_time = new_project._insert_frames(
+            loader.raw_array, loader.label_array, batch_size)
+        new_project.labels.update()
+        new_project.commit()
+        logger.debug('Created new project %s (id %s) in %ss '
+                     '(load %ss, serialize %ss, insert %ss).',
+                     token, new_project.id, timeit.default_timer() - start,
+                     load_time, serialize_time, insert_time)
         return new_project
 
+    def _insert_frames(self, raw, label, batch_size):
+        """
+        Inserts the raw and label frames of a new project with executemany statements,
+        recording each label frame in the first action of the project.
+        Frames are serialized in parallel for large stacks,
+        inserting the raw frames before the label frames so only one pool runs at a time.
+        The pool serializes at most the next batch while a batch is inserted.
+
+        Args:
+            raw (np.array): raw image stack
+            label (np.array): label image stack
+            batch_size (int): number of frames to serialize before inserting them
+
+        Returns:
+            tuple: seconds spent serializing the frames, summed over the workers,
+                   and seconds spent inserting them
+        """
+        serialize_time = insert_time = 0
+        for frame_class, stack in ((RawFrame, raw), (LabelFrame, label)):
+            table = frame_class.__table__
+            # Encoded frames are passed through by NdarrayType
+            encode = functools.partial(timed, table.c.frame.type.encode)
+            encoded_frames = map_frames(encode, stack, max_pending=batch_size)
+            for first in range(0, self.num_frames, batch_size):
+                frame_ids = range(first, min(first + batch_size, self.num_frames))
+                rows = []
+                for i, (encoded_frame, seconds) in zip(frame_ids, encoded_frames):
+                    rows.append({'project_id': self.id, 'frame_id': i, 'frame': encoded_frame})
+                    serialize_time += seconds
+
+                start = timeit.default_timer()
+                db.session.execute(table.insert(), rows)
+                if frame_class is LabelFrame:
+                    memento_rows = [{'project_id': self.id, 'action_id': self.action.action_id,
+                                     'frame_id': i}
+                                    for i in frame_ids]
+                    db.session.execute(FrameMemento.__table__.insert(), memento_rows)
+                insert_time += timeit.default_timer() - start
+        return serialize_time, insert_time
+
     def update(self):
         """
         Commit the project changes from an action.
         Records the effects of the action in the Action table.
         """
         start = timeit.default_timer()
-        if self.action.labels_changed:
-            self.labels.update()
-        db.session.commit()
+        # Only save the labels after a new action, not after changing the display
+        labels_changed = False
+        if self.action in db.session.new:
+            labels_changed = self.labels.update(self.action)
+        # Read ID before committing expires it
+        project_id = self.id
+        self.commit(changed=labels_changed)
         logger.debug('Updated project %s in %ss.',
-                     self.id, timeit.default_timer() - start)
+                     project_id, timeit.default_timer() - start)
 
     def finish(self):
         """
@@ -229,7 +519,6 @@ class Project(db.Model):
         """
         start = timeit.default_timer()
         self.finished = db.func.current_timestamp()
-        self.colormap = None
         # Clear label metadata
         self.labels.finish()
         # Clear frames
@@ -240,31 +529,160 @@ class Project(db.Model):
         for rgb_frame in self.rgb_frames:
             rgb_frame.finish()
         self.finished = db.func.current_timestamp()
+        # Read ID before committing expires it
+        project_id = self.id
         db.session.commit()
+        project_cache.invalidate(project_id)
+        render_cache.invalidate(project_id)
         logger.debug('Finished project %s in %ss.',
-                     self.id, timeit.default_timer() - start)
+                     project_id, timeit.default_timer() - start)
+
+    def commit(self, changed=False):
+        """
+        Commits the session and writes the frames loaded or changed
+        and the saved label metadata in the session through to the project cache.
+        Increases the project version when the project data changed
+        so other workers drop their cached frames.
+        The version is increased in the database, so commits from other workers are not lost.
+
+        Args:
+            changed (bool): whether the project data changed outside of the session,
+                            like label metadata saved with Labels.update
+        """
+        session = db.session
+        # RGB frames are derived from the raw frames, so creating them is not a change
+        models = (LabelFrame, Labels, RawFrame)
+        changed = changed or any(isinstance(obj, models)
+                                 for objs in (session.dirty, session.new, session.deleted)
+                                 for obj in objs)
+        # Read attributes before committing expires them
+        project_id, token, version = self.id, self.token, self.version
+        expected_version = version + 1 if changed else version
+        if changed:
+            self.version = Project.version + 1
+        frames = self._get_uncached_frames(session)
+        labels = self.__dict__.get('labels')
+        edited_frames = [(frame.frame_id, frame.version) for frame in session.dirty
+                         if isinstance(frame, LabelFrame) and session.is_modified(frame)]
+        session.flush()
+        # Read the increased version back before committing releases the project row
+        new_version = self.version
+        session.commit()
+        # Keep the new version readable without refreshing the project
+        set_committed_value(self, 'version', new_version)
+        project_cache.advance(project_id, token, version, new_version)
+        # Frames read before another worker committed may be out of date
+        if new_version == expected_version:
+            for table, frame_id, array in frames:
+                project_cache.put(project_id, table, frame_id, array, new_version)
+            if labels is not None:
+                labels.cache(project_id, new_version)
+        # Renderings of the other versions of the edited frames are out of date
+        for frame_id, frame_version in edited_frames:
+            render_cache.invalidate_labels(project_id, frame_id, keep_version=frame_version)
+
+    def commit_rgb_frames(self):
+        """
+        Commits the RGB frames created to render images of the project.
+        Concurrent requests for images of the same frame may both create its RGB frame,
+        so a frame that another request saved first is not saved again.
+        """
+        # Read ID before rolling back expires it
+        project_id = self.id
+        try:
+            self.commit()
+        except IntegrityError:
+            db.session.rollback()
+            logger.debug('RGB frames of project %s were already saved.', project_id)
+
+    def _get_uncached_frames(self, session):
+        """
+        Finds the frames loaded in the session that are changed or missing from the cache.
+
+        Args:
+            session (Session): session containing the frames
 
-    def create_memento(self, action_name, all_frames=False, session=None):
+        Returns:
+            list: (table, frame ID, array) for each frame to cache
+        """
+        frames = []
+        for frame in list(session.identity_map.values()) + list(session.new):
+            if not isinstance(frame, (RawFrame, RGBFrame, LabelFrame)):
+                continue
+            # Skip other projects and frames whose array was not loaded
+            if frame.__dict__.get('project_id') != self.id or 'frame' not in frame.__dict__:
+                continue
+            key = (self.id, frame.__tablename__, frame.frame_id)
+            if key in project_cache and frame not in session.dirty:
+                continue
+            array = frame.frame
+            if isinstance(frame, LabelFrame) and array is not None:
+                # Label frames are edited in place, so cache a separate copy
+                array = np.array(array)
+            frames.append((frame.__tablename__, frame.frame_id, array))
+        return frames
+
+    def create_memento(self, action_name, session=None):
         """
-        Saves the project state.
+        Saves the changes to the project state made by an action.
+        Edited frames are compared with their last committed version
+        so only the changed region of each frame is stored.
+
+        Args:
+            action_name (str): name of the action that changed the project
+            session (Session): session containing the changes
         """
         session = session or db.session
         # Create action and store project state inside
         action = Action(self, action_name=action_name)
-        for frame in self.label_frames:
-            if frame in session.dirty or all_frames:
-                session.add(FrameMemento(action=action, frame=frame))
-        action.labels = self.labels
+        # Only look at the frames loaded in the session
+        frames = sorted((frame for frame in session.dirty
+                         if isinstance(frame, LabelFrame) and frame.project_id == self.id),
+                        key=lambda frame: frame.frame_id)
+        before_frames = self._get_committed_frames([frame.frame_id for frame in frames],
+                                                   session=session)
+        for frame in frames:
+            session.add(FrameMemento(action=action, frame=frame,
+                                     before=before_frames[frame.frame_id]))
         if self.action is not None:
             self.action.next_action = action
         # Move the Project to the new action
         self.action = action
         self.num_actions += 1
 
-    def undo(self):
+    def _get_committed_frames(self, frame_ids, session=None):
+        """
+        Loads the label frames as they are in the database, ignoring uncommitted changes.
+
+        Args:
+            frame_ids (list): IDs of the label frames to load
+            session (Session): session to query with
+
+        Returns:
+            dict: maps frame IDs to label frame arrays
+        """
+        session = session or db.session
+        # The cache holds the committed version of frames
+        frames = {}
+        for frame_id in frame_ids:
+            array = project_cache.get(self.id, LabelFrame.__tablename__, frame_id)
+            if array is not None:
+                frames[frame_id] = array
+        missing = [frame_id for frame_id in frame_ids if frame_id not in frames]
+        if missing:
+            query = (session.query(LabelFrame.frame_id, LabelFrame.frame)
+                     .filter(LabelFrame.project_id == self.id)
+                     .filter(LabelFrame.frame_id.in_(missing)))
+            frames.update(query.all())
+        return frames
+
+    def undo(self, known_version=None):
         """
         Restores the project to before the current action.
 
+        Args:
+            known_version (int): project version of the tracks that the front-end has
+
         Returns:
             dict: payload to send to frontend
         """
@@ -272,30 +690,37 @@ class Project(db.Model):
         action = self.action
         if self.action.prev_action is None:
             return
+        max_label = self.get_max_label()
         # Restore edited label frames
-        for prev_frame in action.before_frames:
-            frame_id = prev_frame.frame_id
-            frame = prev_frame.frame_array
-            self.label_frames[frame_id].frame = frame
+        for memento in action.before_frames:
+            memento.restore_before(self.get_label_frame(memento.frame_id))
         # Restore edited label info
-        if action.before_labels is not None:
-            self.labels.cell_ids = action.before_labels.cell_ids
-            self.labels.cell_info = action.before_labels.cell_info
+        for memento in action.cell_mementos:
+            memento.restore_before(self.labels)
+        labels_changed = self.labels.update()
 
         payload = self.make_payload(y=action.y_changed,
-                                    labels=action.labels_changed)
+                                    labels=action.labels_changed,
+                                    max_label=max_label,
+                                    known_version=known_version)
         action.done = False
         self.action = action.prev_action
 
-        db.session.commit()
+        # Read IDs before committing expires them
+        action_id, project_id = action.action_id, self.id
+        self.commit(changed=labels_changed)
+        payload['version'] = self.version
         logger.debug('Undo action %s project %s in %ss.',
-                     action.action_id, self.id, timeit.default_timer() - start)
+                     action_id, project_id, timeit.default_timer() - start)
         return payload
 
-    def redo(self):
+    def redo(self, known_version=None):
         """
         Restore the project to after the next action.
 
+        Args:
+            known_version (int): project version of the tracks that the front-end has
+
         Returns:
             dict: payload to send to frontend
         """
@@ -303,41 +728,50 @@ class Project(db.Model):
         if self.action.next_action is None:
             return
         next_action = self.action.next_action
+        max_label = self.get_max_label()
 
         # Restore edited label frames
-        for after_frame in next_action.after_frames:
-            frame_id = after_frame.frame_id
-            frame = after_frame.frame_array
-            self.label_frames[frame_id].frame = frame
+        for memento in next_action.after_frames:
+            memento.restore_after(self.get_label_frame(memento.frame_id))
         # Restore edited label info
-        if next_action.after_labels is not None:
-            self.labels.cell_ids = next_action.after_labels.cell_ids
-            self.labels.cell_info = next_action.after_labels.cell_info
+        for memento in next_action.cell_mementos:
+            memento.restore_after(self.labels)
+        labels_changed = self.labels.update()
 
         payload = self.make_payload(y=next_action.y_changed,
-                                    labels=next_action.labels_changed)
+                                    labels=next_action.labels_changed,
+                                    max_label=max_label,
+                                    known_version=known_version)
         self.action = self.action.next_action
         next_action.done = True
 
-        db.session.commit()
+        # Read IDs before committing expires them
+        action_id, project_id = next_action.action_id, self.id
+        self.commit(changed=labels_changed)
+        payload['version'] = self.version
         logger.debug('Redo action %s project %s in %ss.',
-                     next_action.action_id, self.id, timeit.default_timer() - start)
+                     action_id, project_id, timeit.default_timer() - start)
         return payload
 
-    def get_max_label(self):
+    def get_max_label(self, feature=None):
         """
         Get the highest label in use in currently-viewed feature.
         If feature is empty, returns 0 to prevent other functions from crashing.
 
+        Args:
+            feature (int): feature to get the highest label of; defaults to the current feature
+
         Returns:
             int: highest label in the current feature
         """
+        if feature is None:
+            feature = self.feature
         # check this first, np.max of empty array will crash
-        if len(self.labels.cell_ids[self.feature]) == 0:
+        if len(self.labels.cell_ids[feature]) == 0:
             max_label = 0
         # if any labels exist in feature, find the max label
         else:
-            max_label = int(np.max(self.labels.cell_ids[self.feature]))
+            max_label = int(np.max(self.labels.cell_ids[feature]))
         return max_label
 
     def make_first_payload(self):
@@ -351,21 +785,22 @@ class Project(db.Model):
         payload = {}
 
         img_payload = {}
-        encode = lambda x: base64.encodebytes(x.read()).decode()
-        raw_png = self._get_raw_png()
-        img_payload['raw'] = f'data:image/png;base64,{encode(raw_png)}'
-        label_png = self._get_label_png()
-        img_payload['segmented'] = f'data:image/png;base64,{encode(label_png)}'
+        img_payload['viewport'] = self._get_viewport_url()
+        img_payload['raw'] = self._get_raw_url()
+        img_payload['segmented'] = self._get_label_url()
         img_payload['seg_arr'] = self._get_label_arr()
         payload['imgs'] = img_payload
 
         payload['tracks'] = self.labels.readable_tracks
+        payload['version'] = self.version
 
         # Other Project attributes to initialize frontend variables
         payload['frame'] = self.frame
         payload['numFrames'] = self.num_frames
         payload['project_id'] = self.token
         payload['dimensions'] = (self.width, self.height)
+        payload['pyramid'] = {'levels': self.count_pyramid_levels(),
+                              'tileSize': PYRAMID_TILE_SIZE}
         # Attributes specific to filetype
         if self.is_track:
             payload['screen_scale'] = self.scale_factor
@@ -373,112 +808,591 @@ class Project(db.Model):
             payload['numChannels'] = self.num_channels
             payload['numFeatures'] = self.num_features
 
-        # First frame edited by each action
-        # Excludes the first action, which loads the project
-        payload['actionFrames'] = [action.frames[0].frame_id
-                                   for action in self.actions[1:] if action.done]
+        payload['actionFrames'] = self._get_action_frames()
 
         return payload
 
-    def make_payload(self, x=False, y=False, labels=False):
+    def _get_action_frames(self):
+        """
+        Finds the first frame edited by each action in the project's history
+        with a single query, excluding the first action, which loads the project.
+        Actions that edit no frames use the frame of the action before them.
+
+        Returns:
+            list: frame ID for each action
+        """
+        query = (db.session.query(Action.action_id, db.func.min(FrameMemento.frame_id))
+                 .outerjoin(FrameMemento, db.and_(
+                     FrameMemento.project_id == Action.project_id,
+                     FrameMemento.action_id == Action.action_id))
+                 .filter(Action.project_id == self.id)
+                 .filter(Action.done)
+                 .group_by(Action.action_id)
+                 .order_by(Action.action_id)
+                 .offset(1))
+        action_frames = []
+        prev_frame = 0
+        for _, frame_id in query:
+            if frame_id is None:
+                frame_id = prev_frame
+            action_frames.append(frame_id)
+            prev_frame = frame_id
+        return action_frames
+
+    def make_payload(self, x=False, y=False, labels=False, max_label=None, known_version=None):
         """
         Creates a payload to send to the front-end after completing an action.
 
         Args:
-            x (bool): when True, payload includes raw image PNG
+            x (bool): when True, payload includes the URL of the raw image PNG
             y (bool): when True, payload includes labeled image data
-                           sends both a PNG and an array of where each label is
+                           sends both a PNG URL and an array of where each label is
             labels (bool): when True, payload includes the label "tracks",
                            or the frames that each label appears in (e.g. [0-10, 15-20])
+            max_label (int): highest label of the current feature before the action;
+                             when it is unchanged, the labeled image data
+                             is only the tiles that the action changed
+            known_version (int): project version of the tracks that the front-end has;
+                                 when it is the current version, the label tracks
+                                 are only the tracks that changed, in "trackChanges"
 
         Returns:
             dict: payload with image data and label tracks
         """
         if x or y:
-            img_payload = {}
-            encode = lambda x: base64.encodebytes(x.read()).decode()
+            img_payload = {'viewport': self._get_viewport_url()}
             if x:
-                raw_png = self._get_raw_png()
-                img_payload['raw'] = f'data:image/png;base64,{encode(raw_png)}'
-            if y:
-                label_png = self._get_label_png()
-                img_payload['segmented'] = f'data:image/png;base64,{encode(label_png)}'
+                img_payload['raw'] = self._get_raw_url()
+            tiles = None
+            if y and max_label is not None and max_label == self.get_max_label():
+                tiles = self.get_label_tiles(self.frame, self.feature)
+            if tiles is not None:
+                img_payload['tiles'] = tiles
+            elif y:
+                img_payload['segmented'] = self._get_label_url()
                 img_payload['seg_arr'] = self._get_label_arr()
         else:
             img_payload = False
 
-        if labels:
-            tracks = self.labels.readable_tracks
-        else:
-            tracks = False
-
-        return {'imgs': img_payload, 'tracks': tracks}
+        payload = {'imgs': img_payload, 'tracks': False}
+        if known_version is not None and known_version != self.version:
+            # The front-end missed changes from other requests
+            payload['tracks'] = self.labels.readable_tracks
+        elif labels and known_version is not None:
+            payload['trackChanges'] = self.labels.readable_changes
+        elif labels:
+            payload['tracks'] = self.labels.readable_tracks
+        return payload
 
     def _get_label_arr(self):
         """
         Returns:
-            list: nested list of labels at each positions, with negative label outlines.
+            dict: run-length encoded labels at each position, with negative label outlines.
+        """
+        return self.get_label_arr(self.frame, self.feature)
+
+    def get_label_arr(self, frame_id, feature):
+        """
+        Args:
+            frame_id (int): index of the frame
+            feature (int): index of the feature
+
+        Returns:
+            dict: run-length encoded labels of a frame, with negative label outlines.
+        """
+        label_frame = self.get_label_frame(frame_id)
+        key = ('outlines', self.id, frame_id, feature, label_frame.version)
+        label_arr = render_cache.get(key)
+        if label_arr is None:
+            label_arr = encode_array(self.get_outlined_frame(frame_id, feature))
+            render_cache.put(key, label_arr,
+                             len(label_arr['values']) + len(label_arr['lengths']))
+        return label_arr
+
+    def get_outlined_frame(self, frame_id, feature):
+        """
+        Outlines the labels of a frame with imgutils.add_outlines.
+        When the frame was edited, only the outlines in the changed region are recomputed
+        from the cached outlines of the committed frame.
+
+        Args:
+            frame_id (int): index of the frame
+            feature (int): index of the feature
+
+        Returns:
+            np.array: read-only int16 labels of a frame, with negative label outlines
+        """
+        label_frame = self.get_label_frame(frame_id)
+        key = ('outlined', self.id, frame_id, feature, label_frame.version)
+        outlined = render_cache.get(key)
+        if outlined is None:
+            outlined = self._update_committed_outlines(label_frame, feature)
+            if outlined is None:
+                outlined = add_outlines(label_frame.frame[..., feature])
+            outlined.flags.writeable = False
+            render_cache.put(key, outlined, outlined.nbytes)
+        return outlined
+
+    def _update_committed_outlines(self, label_frame, feature):
+        """
+        Updates the outlines of the committed version of an edited frame
+        within the bounding box of the pixels changed by the edit.
+
+        Args:
+            label_frame (LabelFrame): frame to outline
+            feature (int): index of the feature
+
+        Returns:
+            np.array: int16 labels with negative label outlines, or None when the frame
+                      is not edited or its committed version or outlines are not cached
         """
-        # Create label array
-        label_frame = self.label_frames[self.frame]
-        label_arr = label_frame.frame[..., self.feature]
-        return add_outlines(label_arr).tolist()
+        committed_version = db.inspect(label_frame).attrs.version.history.deleted
+        if not committed_version:
+            return None
+        key = ('outlined', self.id, label_frame.frame_id, feature, committed_version[0])
+        outlined = render_cache.get(key)
+        before = project_cache.get(self.id, LabelFrame.__tablename__, label_frame.frame_id)
+        if outlined is None or before is None:
+            return None
+        frame = label_frame.frame[..., feature]
+        outlined = np.array(outlined)
+        box = changed_box(before[..., feature], frame)
+        if box is not None:
+            update_outlines(outlined, frame, box)
+        return outlined
+
+    def get_label_tiles(self, frame_id, feature):
+        """
+        Finds the tiles of the label image and label array that changed
+        since the frame was committed, so the front-end only updates those tiles.
+        Tiles are LABEL_TILE_SIZE pixels on each side and cover the changed pixels
+        and the outlines around them.
+
+        Args:
+            frame_id (int): index of the frame
+            feature (int): index of the feature
+
+        Returns:
+            dict: tile size, URL of the whole label image, and
+                  position, base64 PNG and run-length encoded labels of each changed tile,
+                  or None when the tiles are not smaller than the frame
+                  or the committed frame is not cached
+        """
+        label_frame = self.get_label_frame(frame_id)
+        before = project_cache.get(self.id, LabelFrame.__tablename__, frame_id)
+        if before is None:
+            return None
+        frame = label_frame.frame[..., feature]
+        box = changed_box(before[..., feature], frame)
+        tiles = []
+        if box is not None:
+            # Outlines change next to the changed pixels
+            y1, x1 = max(box[0] - 1, 0) // LABEL_TILE_SIZE, max(box[1] - 1, 0) // LABEL_TILE_SIZE
+            y2, x2 = min(box[2], self.height - 1), min(box[3], self.width - 1)
+            y2, x2 = y2 // LABEL_TILE_SIZE + 1, x2 // LABEL_TILE_SIZE + 1
+            # Send the whole frame when the tiles cover most of it
+            if (y2 - y1) * (x2 - x1) * LABEL_TILE_SIZE ** 2 > self.height * self.width // 2:
+                return None
+            outlined = self.get_outlined_frame(frame_id, feature)
+            max_label = self.get_max_label(feature)
+            for y in range(y1 * LABEL_TILE_SIZE, y2 * LABEL_TILE_SIZE, LABEL_TILE_SIZE):
+                for x in range(x1 * LABEL_TILE_SIZE, x2 * LABEL_TILE_SIZE, LABEL_TILE_SIZE):
+                    tile = (slice(y, y + LABEL_TILE_SIZE), slice(x, x + LABEL_TILE_SIZE))
+                    png = render_image(imgarr=np.ma.masked_equal(frame[tile], 0),
+                                       vmin=0,
+                                       vmax=max_label,
+                                       cmap='viridis')
+                    tiles.append({
+                        'y': y,
+                        'x': x,
+                        'png': base64.b64encode(png.getvalue()).decode(),
+                        'arr': encode_array(outlined[tile]),
+                    })
+        return {
+            'size': LABEL_TILE_SIZE,
+            'segmented': self._get_label_url(),
+            'tiles': tiles,
+        }
+
+    def _get_label_url(self):
+        """
+        Returns:
+            str: URL of the current label frame as a .png,
+                 with a version that changes when the image changes
+        """
+        version = self.get_label_image_version(self.frame, self.feature)
+        return (f'/api/image/{self.token}/labels/{self.frame}/{self.feature}.png'
+                f'?version={version}')
+
+    def _get_raw_url(self):
+        """
+        Returns:
+            str: URL of the current raw frame as a .png
+        """
+        if self.rgb:
+            return f'/api/image/{self.token}/rgb/{self.frame}.png'
+        return f'/api/image/{self.token}/raw/{self.frame}/{self.channel}.png'
+
+    def _get_viewport_url(self):
+        """
+        Returns:
+            str: URL listing the tiles of the current frame that cover a viewport
+        """
+        return f'/api/tiles/{self.token}/{self.frame}'
+
+    def get_label_image_version(self, frame_id, feature):
+        """
+        Identifies the label image of a frame for HTTP caching.
+        The image changes when the frame is edited
+        and when the highest label changes, as labels are colored relative to it.
+
+        Args:
+            frame_id (int): index of the frame
+            feature (int): index of the feature
+
+        Returns:
+            str: version of the label image, or None if the frame does not exist
+        """
+        label_frame = self.get_label_frame(frame_id)
+        if label_frame is None:
+            return None
+        return f'{label_frame.version}-{self.get_max_label(feature)}'
+
+    def get_label_image(self, frame_id, feature, image_format='png'):
+        """
+        Args:
+            frame_id (int): index of the frame
+            feature (int): index of the feature
+            image_format (str): 'png', 'webp' or 'rgba'
+
+        Returns:
+            BytesIO: the labels of a frame as an image
+        """
+        label_frame = self.get_label_frame(frame_id)
+        # Labels are colored relative to the highest label
+        max_label = self.get_max_label(feature)
+
+        def render():
+            label_arr = label_frame.frame[..., feature]
+            return render_image(imgarr=np.ma.masked_equal(label_arr, 0),
+                                vmin=0,
+                                vmax=max_label,
+                                cmap='viridis',
+                                image_format=image_format)
+        key = ('labels', self.id, frame_id, feature, label_frame.version, max_label, image_format)
+        return self._get_rendered_image(key, render)
+
+    def get_raw_image(self, frame_id, channel, image_format='png'):
+        """
+        Args:
+            frame_id (int): index of the frame
+            channel (int): index of the channel
+            image_format (str): 'png', 'webp' or 'rgba'
+
+        Returns:
+            BytesIO: a channel of a raw frame as an image
+        """
+        def render():
+            raw_arr = self.get_raw_frame(frame_id).frame[..., channel]
+            return render_image(imgarr=raw_arr,
+                                vmin=0,
+                                vmax=None,
+                                cmap='cubehelix',
+                                image_format=image_format)
+        key = ('raw', self.id, frame_id, channel, image_format)
+        return self._get_rendered_image(key, render)
+
+    def get_rgb_image(self, frame_id, image_format='png'):
+        """
+        Args:
+            frame_id (int): index of the frame
+            image_format (str): 'png', 'webp' or 'rgba'
+
+        Returns:
+            BytesIO: a raw frame with all channels mixed into RGB as an image
+        """
+        def render():
+            return render_image(imgarr=self.get_rgb_frame(frame_id).frame,
+                                vmin=None,
+                                vmax=None,
+                                cmap=None,
+                                image_format=image_format)
+        return self._get_rendered_image(('rgb', self.id, frame_id, image_format), render)
+
+    @staticmethod
+    def _get_rendered_image(key, render):
+        """
+        Gets an encoded image from the render cache, rendering it on a miss.
+
+        Args:
+            key (tuple): key of the image in the render cache
+            render (function): renders the image into a BytesIO
+
+        Returns:
+            BytesIO: the image
+        """
+        image = render_cache.get(key)
+        if image is None:
+            image = render().getvalue()
+            render_cache.put(key, image, len(image))
+        return io.BytesIO(image)
+
+    def count_pyramid_levels(self):
+        """
+        Returns:
+            int: number of levels in the image pyramids of the frames,
+                 from full resolution to a single tile
+        """
+        return count_pyramid_levels(self.height, self.width, PYRAMID_TILE_SIZE)
+
+    def get_tile_grid(self, level):
+        """
+        Args:
+            level (int): level of the image pyramid, 0 for full resolution
+
+        Returns:
+            tuple: (rows, columns) of tiles at the level,
+                   or None if the level is not in the pyramid
+        """
+        if not 0 <= level < self.count_pyramid_levels():
+            return None
+        # Each level halves the previous level, rounding up
+        height = -(-self.height // 2 ** level)
+        width = -(-self.width // 2 ** level)
+        return -(-height // PYRAMID_TILE_SIZE), -(-width // PYRAMID_TILE_SIZE)
+
+    def get_pyramid_level(self, layer, frame_id, index, level):
+        """
+        Gets a level of the image pyramid of a frame from the render cache,
+        downsampling the previous level on a miss.
+
+        Args:
+            layer (str): 'raw', 'rgb' or 'labels'
+            frame_id (int): index of the frame
+            index (int): channel of raw frames or feature of label frames; ignored for RGB
+            level (int): level of the pyramid, 0 for full resolution
+
+        Returns:
+            np.array: the frame downsampled 2 ** level times, read-only above level 0
+        """
+        if layer == 'labels':
+            label_frame = self.get_label_frame(frame_id)
+            key = ('labels_level', self.id, frame_id, index, label_frame.version, level)
+            get_frame = lambda: label_frame.frame[..., index]
+        elif layer == 'raw':
+            key = ('raw_level', self.id, frame_id, index, level)
+            get_frame = lambda: self.get_raw_frame(frame_id).frame[..., index]
+        else:
+            key = ('rgb_level', self.id, frame_id, level)
+            get_frame = lambda: self.get_rgb_frame(frame_id).frame
+        if level == 0:
+            return get_frame()
+        image = render_cache.get(key)
+        if image is None:
+            image = downsample(self.get_pyramid_level(layer, frame_id, index, level - 1),
+                               labels=layer == 'labels')
+            image.flags.writeable = False
+            render_cache.put(key, image, image.nbytes)
+        return image
+
+    def get_tile_image(self, layer, frame_id, index, level, row, col, image_format='png'):
+        """
+        Args:
+            layer (str): 'raw', 'rgb' or 'labels'
+            frame_id (int): index of the frame
+            index (int): channel of raw frames or feature of label frames; ignored for RGB
+            level (int): level of the image pyramid, 0 for full resolution
+            row (int): row of the tile in the level
+            col (int): column of the tile in the level
+            image_format (str): 'png', 'webp' or 'rgba'
+
+        Returns:
+            BytesIO: a tile of the image pyramid of a frame as an image,
+                     colored like the whole frame
+        """
+        size = PYRAMID_TILE_SIZE
+        if layer == 'labels':
+            version = self.get_label_frame(frame_id).version
+            # Labels are colored relative to the highest label
+            max_label = self.get_max_label(index)
+            key = ('labels_tile', self.id, frame_id, index, version, max_label,
+                   level, row, col, image_format)
+        elif layer == 'raw':
+            key = ('raw_tile', self.id, frame_id, index, level, row, col, image_format)
+        else:
+            key = ('rgb_tile', self.id, frame_id, level, row, col, image_format)
+
+        def render():
+            image = self.get_pyramid_level(layer, frame_id, index, level)
+            tile = image[row * size:(row + 1) * size, col * size:(col + 1) * size]
+            if layer == 'labels':
+                return render_image(imgarr=np.ma.masked_equal(tile, 0),
+                                    vmin=0,
+                                    vmax=max_label,
+                                    cmap='viridis',
+                                    image_format=image_format)
+            if layer == 'raw':
+                return render_image(imgarr=tile,
+                                    vmin=0,
+                                    vmax=self._get_raw_max(frame_id, index),
+                                    cmap='cubehelix',
+                                    image_format=image_format)
+            return render_image(imgarr=tile,
+                                vmin=None,
+                                vmax=None,
+                                cmap=None,
+                                image_format=image_format)
+        return self._get_rendered_image(key, render)
+
+    def _get_raw_max(self, frame_id, channel):
+        """
+        Returns:
+            int: largest value in a channel of a raw frame,
+                 so tiles are colored on the same scale as the whole frame
+        """
+        key = ('raw_max', self.id, frame_id, channel)
+        vmax = render_cache.get(key)
+        if vmax is None:
+            raw_arr = self.get_raw_frame(frame_id).frame[..., channel]
+            vmax = raw_arr.max().item() if raw_arr.size else 0
+            render_cache.put(key, vmax, 8)
+        return vmax
+
+    def get_viewport_tiles(self, frame_id, x, y, width, height, scale):
+        """
+        Lists the tiles of the displayed raw and label images that cover a viewport,
+        from the coarsest pyramid level that still has a pixel for each screen pixel.
+
+        Args:
+            frame_id (int): index of the frame
+            x (int): left edge of the viewport in full resolution pixels
+            y (int): top edge of the viewport in full resolution pixels
+            width (int): width of the viewport in full resolution pixels
+            height (int): height of the viewport in full resolution pixels
+            scale (float): screen pixels for each full resolution pixel
+
+        Returns:
+            dict: the pyramid level, the size of its tiles in full resolution pixels,
+                  and the position and URLs of each tile
+        """
+        num_levels = self.count_pyramid_levels()
+        level = 0
+        if scale < 1:
+            level = min(int(math.floor(-math.log2(scale))), num_levels - 1)
+        rows, cols = self.get_tile_grid(level)
+        # Size of a tile in full resolution pixels
+        span = PYRAMID_TILE_SIZE * 2 ** level
+        first_row, first_col = max(y // span, 0), max(x // span, 0)
+        last_row = min(-(-(y + height) // span), rows)
+        last_col = min(-(-(x + width) // span), cols)
+
+        version = self.get_label_image_version(frame_id, self.feature)
+        if self.rgb:
+            raw_prefix = f'/api/tiles/{self.token}/rgb/{frame_id}/{level}'
+        else:
+            raw_prefix = f'/api/tiles/{self.token}/raw/{frame_id}/{self.channel}/{level}'
+        label_prefix = f'/api/tiles/{self.token}/labels/{frame_id}/{self.feature}/{level}'
+        tiles = [
+            {
+                'row': row,
+                'col': col,
+                'y': row * span,
+                'x': col * span,
+                'raw': f'{raw_prefix}/{row}/{col}.png',
+                'segmented': f'{label_prefix}/{row}/{col}.png?version={version}',
+            }
+            for row in range(first_row, last_row)
+            for col in range(first_col, last_col)
+        ]
+        return {'level': level, 'size': span, 'tiles': tiles}
 
     def _get_label_png(self):
         """
         Returns:
             BytesIO: returns the current label frame as a .png
         """
-        # Create label png
-        label_frame = self.label_frames[self.frame]
-        label_arr = label_frame.frame[..., self.feature]
-        label_png = pngify(imgarr=np.ma.masked_equal(label_arr, 0),
-                           vmin=0,
-                           vmax=self.get_max_label(),
-                           cmap=self.colormap)
-        return label_png
+        return self.get_label_image(self.frame, self.feature)
 
     def _get_raw_png(self):
         """
         Returns:
             BytesIO: contains the current raw frame as a .png
         """
-        # RGB png
         if self.rgb:
-            raw_frame = self.rgb_frames[self.frame]
-            raw_arr = raw_frame.frame
-            raw_png = pngify(imgarr=raw_arr,
-                             vmin=None,
-                             vmax=None,
-                             cmap=None)
-            return raw_png
-        # Raw png
-        raw_frame = self.raw_frames[self.frame]
-        raw_arr = raw_frame.frame[..., self.channel]
-        raw_png = pngify(imgarr=raw_arr,
-                         vmin=0,
-                         vmax=None,
-                         cmap='cubehelix')
-        return raw_png
+            return self.get_rgb_image(self.frame)
+        return self.get_raw_image(self.frame, self.channel)
 
 
 class Labels(db.Model):
     """
     Table definition that stores metadata about the labeling.
+    The metadata is stored one label at a time in the cells and cellframes tables,
+    and is edited in memory as the cell_ids and cell_info dictionaries.
     Cell_info stores a dictionary with frame information about each cell.
+    Cells are read from the cells tables when first used, and the cells read by a worker
+    are cached with the version of the project for later requests.
     """
     # pylint: disable=E1101
     __tablename__ = 'labels'
     project_id = db.Column(db.Integer, db.ForeignKey('projects.id'),
                            primary_key=True, nullable=False)
-    # Label metadata
-    cell_ids = db.Column(db.PickleType(comparator=lambda *a: False))
-    cell_info = db.Column(db.PickleType(comparator=lambda *a: False))
+    # Pickled label metadata from before the cells tables existed
+    # Moved to the cells tables the next time the labels are saved
+    legacy_cell_ids = db.Column('cell_ids', db.PickleType(comparator=lambda *a: False))
+    legacy_cell_info = db.Column('cell_info', db.PickleType(comparator=lambda *a: False))
+
+    # Most cells read by their labels; reading more cells reads the whole feature at once
+    MAX_LABELS_READ = 100
 
     def __init__(self):
+        self.init_on_load()
+        self._loaded = True
         self.cell_ids = {}
         self.cell_info = {}
 
+    @db.reconstructor
+    def init_on_load(self):
+        """Initializes the in-memory label metadata, which is loaded when first used."""
+        self._loaded = False
+        self._cell_ids = None
+        self._cell_info = None
+        # Labels in each feature as last saved in the cells tables
+        self._saved_labels = {}
+        # States of the cells read from or last saved in the cells tables
+        self._saved = {}
+        # States of cells cached by this worker for the version the labels were loaded at
+        self._cached = {}
+        # Cells saved by Labels.update since the labels were last cached
+        self._uncached = set()
+        # Cells saved by Labels.update in this session, to send to the front-end
+        self._changed = set()
+        # Whether the labels were loaded from the pickled legacy columns and not saved yet
+        self._legacy = False
+
+    @property
+    def cell_ids(self):
+        if not self._loaded:
+            self._load()
+        return self._cell_ids
+
+    @cell_ids.setter
+    def cell_ids(self, cell_ids):
+        if not self._loaded:
+            self._load()
+        self._cell_ids = cell_ids
+
+    @property
+    def cell_info(self):
+        if not self._loaded:
+            self._load()
+        return self._cell_info
+
+    @cell_info.setter
+    def cell_info(self, cell_info):
+        if not self._loaded:
+            self._load()
+        self._cell_info = cell_info
+
     @property
     def tracks(self):
         """Alias for .trk for backward compatibility"""
@@ -491,30 +1405,475 @@ class Labels(db.Model):
         simplifying track['frames'] into something like [0-29] instead of
         [0,1,2,3,...].
         """
-        cell_info = copy.deepcopy(self.cell_info)
-        for _, feature in cell_info.items():
-            for _, label in feature.items():
-                slices = list(map(list, consecutive(label['frames'])))
-                slices = '[' + ', '.join(["{}".format(a[0])
-                                          if len(a) == 1 else "{}-{}".format(a[0], a[-1])
-                                          for a in slices]) + ']'
-                label['slices'] = str(slices)
+        return {feature: {label: make_readable(info) for label, info in feature_info.items()}
+                for feature, feature_info in self.cell_info.items()}
 
-        return cell_info
+    @property
+    def readable_changes(self):
+        """
+        Preprocesses only the tracks that changed since the labels were loaded,
+        to update the tracks that the front-end already has.
 
-    def update(self):
+        Returns:
+            dict: maps each feature with changes to a dictionary
+                  from each changed label to its readable track, or None if it was deleted
+        """
+        changed = set(self._changed)
+        if self._loaded and self._cell_info is not None:
+            changed.update(self._get_changes())
+        changes = {}
+        for feature, label in sorted(changed):
+            info = self.cell_info[feature].get(label)
+            changes.setdefault(feature, {})[label] = None if info is None else make_readable(info)
+        return changes
+
+    def _load(self):
         """
-        Update the label metatdata by explicitly copying the PickleType
-        columns so the database knows to commit them.
+        Loads the labels in each feature from the project cache or the cells table.
+        The frames and lineage of each cell are read when the cell is first used.
         """
-        # TODO: use Mutable mixin to avoid explicit copying
-        self.cell_ids = self.cell_ids.copy()
-        self.cell_info = self.cell_info.copy()
+        start = timeit.default_timer()
+        self._loaded = True
+        project = self.project
+        if project.finished is not None:
+            return
+        if self.legacy_cell_info is not None:
+            self._cell_ids = self.legacy_cell_ids
+            self._cell_info = self.legacy_cell_info
+            self._legacy = True
+            self._saved = self._get_cell_states()
+            self._saved_labels = {}
+            for feature, label in self._saved:
+                self._saved_labels.setdefault(feature, set()).add(label)
+            return
+
+        cached = project_cache.get(self.project_id, Cell.__tablename__, None)
+        if cached is None:
+            labels = {}
+            cells = Cell.__table__
+            for feature, label in db.session.execute(
+                    db.select([cells.c.feature, cells.c.label])
+                    .where(cells.c.project_id == self.project_id)
+                    .order_by(cells.c.feature, cells.c.label)):
+                labels.setdefault(feature, []).append(label)
+            cached = ({feature: np.array(feature_labels, dtype=int)
+                       for feature, feature_labels in labels.items()}, {})
+            self._put_cached(self.project_id, project.version, *cached)
+        cell_ids, self._cached = cached
+
+        empty = np.array([], dtype=int)
+        self._cell_ids = {feature: cell_ids.get(feature, empty).copy()
+                          for feature in range(project.num_features)}
+        self._saved_labels = {feature: set(ids.tolist()) for feature, ids in self._cell_ids.items()}
+        self._cell_info = {feature: CellInfo(self, feature, labels)
+                           for feature, labels in self._saved_labels.items()}
+        logger.debug('Loaded labels for project %s in %ss.',
+                     self.project_id, timeit.default_timer() - start)
+
+    def _read_states(self, feature, labels):
+        """
+        Reads the saved states of cells in the cells tables,
+        or from the project cache when this worker already read them.
+
+        Args:
+            feature (int): feature of the cells
+            labels (list): labels of the cells
+
+        Returns:
+            dict: maps (feature, label) to the state of each cell
+        """
+        states = {}
+        missing = set()
+        for label in labels:
+            key = (feature, label)
+            state = self._saved.get(key, self._cached.get(key))
+            if state is None:
+                missing.add(label)
+            else:
+                states[key] = state
+        if not missing:
+            return states
+
+        cells = Cell.__table__
+        query = (db.select([cells, CellFrame.__table__.c.frame_id])
+                 .select_from(cells.outerjoin(CellFrame.__table__))
+                 .where(cells.c.project_id == self.project_id)
+                 .where(cells.c.feature == feature)
+                 .order_by(cells.c.label, CellFrame.__table__.c.frame_id))
+        if len(missing) <= self.MAX_LABELS_READ:
+            query = query.where(cells.c.label.in_(sorted(missing)))
+        rows = {}
+        for row in db.session.execute(query):
+            if row.label not in rows:
+                rows[row.label] = dict(row, frames=[])
+            if row.frame_id is not None:
+                rows[row.label]['frames'].append(row.frame_id)
+
+        is_track = self.project.is_track
+        for label, row in rows.items():
+            key = (feature, label)
+            state = Cell.get_state(Cell.make_info(label, row, is_track))
+            # Cells saved in this session are not committed yet
+            if key not in self._uncached:
+                self._cached[key] = state
+            if label in missing:
+                states[key] = state
+        return states
+
+    def read_cells(self, feature, labels):
+        """
+        Reads cells from the cells tables into cell_info entries.
+
+        Args:
+            feature (int): feature of the cells
+            labels (list): labels of the cells
+
+        Returns:
+            dict: maps the label of each cell to its cell_info entry
+        """
+        states = self._read_states(feature, labels)
+        self._saved.update(states)
+        is_track = self.project.is_track
+        return {label: Cell.make_info(label, state, is_track)
+                for (_, label), state in states.items()}
+
+    def _get_cell_states(self):
+        """
+        Returns:
+            dict: maps (feature, label) to the state of each cell in cell_info
+        """
+        return {(int(feature), int(label)): Cell.get_state(info)
+                for feature, feature_info in self._cell_info.items()
+                for label, info in feature_info.items()}
+
+    def _get_changes(self):
+        """
+        Compares the cells that may have changed with their saved states.
+        Cells that were never read from the cells tables are unchanged,
+        so only the cells read, added or removed are compared.
+
+        Returns:
+            dict: maps (feature, label) of each changed cell to its (before, after) states;
+                  before is None for new cells and after is None for removed cells
+        """
+        changes = {}
+        features = {int(feature) for feature in self._cell_info} | set(self._saved_labels)
+        for feature in sorted(features):
+            feature_info = self._cell_info.get(feature, {})
+            saved_labels = self._saved_labels.get(feature, set())
+            if isinstance(feature_info, CellInfo):
+                labels = set(map(int, feature_info.loaded))
+            else:
+                labels = set(map(int, feature_info))
+            labels.update(label for label in saved_labels if label not in feature_info)
+            unread = [label for label in sorted(labels)
+                      if label in saved_labels and (feature, label) not in self._saved]
+            self._saved.update(self._read_states(feature, unread))
+            for label in sorted(labels):
+                info = feature_info.get(label)
+                before = self._saved.get((feature, label))
+                after = None if info is None else Cell.get_state(info)
+                if before != after:
+                    changes[(feature, label)] = (before, after)
+        return changes
+
+    def update(self, action=None):
+        """
+        Saves the cells that changed since the labels were loaded or last saved.
+        Each changed cell writes only its own rows in the cells and cellframes tables.
+
+        Args:
+            action (Action): action that changed the labels;
+                             records the changed cells so the action can be undone
+
+        Returns:
+            bool: whether any cells changed
+        """
+        if not self._loaded or self._cell_info is None:
+            return False
+        changes = self._get_changes()
+        if action is not None:
+            for (feature, label), (before, after) in changes.items():
+                db.session.add(CellMemento(action, feature, label, before=before, after=after))
+        # Legacy labels are not in the cells tables yet, so write every cell
+        if self.legacy_cell_info is not None:
+            changes = {key: (None, state) for key, state in self._get_cell_states().items()}
+            self._saved = {}
+            self._saved_labels = {}
+            self._legacy = False
+            self.legacy_cell_ids = None
+            self.legacy_cell_info = None
+        if not changes:
+            return False
+
+        project_id = self.project_id
+        cells = Cell.__table__
+        cell_frames = CellFrame.__table__
+        new_cells, deleted_cells, updated_cells = [], [], []
+        new_frames, deleted_frames = [], []
+        for (feature, label), (before, after) in changes.items():
+            key = {'project_id': project_id, 'feature': feature, 'label': label}
+            before_frames = set(before['frames']) if before is not None else set()
+            after_frames = set(after['frames']) if after is not None else set()
+            if before is None:
+                new_cells.append(dict(key, **Cell.get_columns(after)))
+            elif after is None:
+                deleted_cells.append(key)
+            elif Cell.get_columns(before) != Cell.get_columns(after):
+                updated_cells.append(dict(key, **Cell.get_columns(after)))
+            new_frames.extend(dict(key, frame_id=frame_id)
+                              for frame_id in sorted(after_frames - before_frames))
+            deleted_frames.extend(dict(key, frame_id=frame_id)
+                                  for frame_id in sorted(before_frames - after_frames))
+
+        # Bind primary key values under different names than the columns
+        def where(table, keys):
+            return db.and_(*[table.c[key] == db.bindparam('_' + key) for key in keys])
+
+        def rename(rows):
+            return [{'_' + key: value for key, value in row.items()} for row in rows]
+
+        cell_keys = ['project_id', 'feature', 'label']
+        frame_keys = cell_keys + ['frame_id']
+        if deleted_frames:
+            db.session.execute(cell_frames.delete().where(where(cell_frames, frame_keys)),
+                               rename(deleted_frames))
+        if deleted_cells:
+            db.session.execute(cells.delete().where(where(cells, cell_keys)),
+                               rename(deleted_cells))
+        if updated_cells:
+            columns = {column: db.bindparam(column) for column in Cell.COLUMNS}
+            updated_cells = [dict(row, **{'_' + key: row[key] for key in cell_keys})
+                             for row in updated_cells]
+            db.session.execute(cells.update().where(where(cells, cell_keys)).values(columns),
+                               updated_cells)
+        if new_cells:
+            db.session.execute(cells.insert(), new_cells)
+        if new_frames:
+            db.session.execute(cell_frames.insert(), new_frames)
+
+        for (feature, label), (_, after) in changes.items():
+            saved_labels = self._saved_labels.setdefault(feature, set())
+            if after is None:
+                self._saved.pop((feature, label), None)
+                saved_labels.discard(label)
+            else:
+                self._saved[(feature, label)] = after
+                saved_labels.add(label)
+        self._uncached.update(changes)
+        self._changed.update(changes)
+        return True
+
+    def cache(self, project_id, version):
+        """
+        Caches the labels and the cells saved by Labels.update
+        with the version of the project they were committed at,
+        or the labels of new projects that were not cached yet.
+
+        Args:
+            project_id (int): primary key of the project, read before committing expired it
+            version (int): version of the project after committing the saved cells
+        """
+        if not self._loaded or self._cell_info is None or self._legacy:
+            return
+        if not self._uncached and (project_id, Cell.__tablename__, None) in project_cache:
+            return
+        cached = self._cached.copy()
+        for key in self._uncached:
+            cached.pop(key, None)
+        cached.update(self._saved)
+        cell_ids = {feature: np.array(sorted(labels), dtype=int)
+                    for feature, labels in self._saved_labels.items()}
+        self._put_cached(project_id, version, cell_ids, cached)
+        self._cached = cached
+        self._uncached = set()
+
+    @staticmethod
+    def _put_cached(project_id, version, cell_ids, states):
+        """Caches the labels in each feature and the states of cells for a project version."""
+        # Rough memory used by the label arrays and the frames and lineage of each cell
+        nbytes = (sum(ids.nbytes for ids in cell_ids.values()) +
+                  sum(256 + 32 * len(state['frames']) for state in list(states.values())))
+        project_cache.put(project_id, Cell.__tablename__, None, (cell_ids, states), version,
+                          nbytes=nbytes)
+
+    def restore(self, feature, label, state, saved):
+        """
+        Restores one cell in cell_info to a saved state.
+
+        Args:
+            feature (int): feature of the cell
+            label (int): label of the cell
+            state (dict): state of the cell from Cell.get_state, or None to remove the cell
+            saved (dict): state of the cell currently in the cells tables, or None if absent;
+                          the cell is not read again when it was not read yet
+        """
+        feature_info = self.cell_info[feature]
+        if saved is not None and label in self._saved_labels.get(feature, ()):
+            self._saved.setdefault((feature, label), saved)
+        if state is None:
+            if label in feature_info:
+                del feature_info[label]
+        else:
+            feature_info[label] = Cell.make_info(label, state, self.project.is_track)
+        ids = self.cell_ids[feature]
+        if state is None:
+            self.cell_ids[feature] = ids[ids != label]
+        elif label not in ids:
+            self.cell_ids[feature] = np.union1d(ids, [label]).astype(int)
 
     def finish(self):
-        """Set PickleType columns to null."""
-        self.cell_ids = None
-        self.cell_info = None
+        """Deletes the label metadata."""
+        self._loaded = True
+        self._cell_ids = None
+        self._cell_info = None
+        self._saved_labels = {}
+        self._saved = {}
+        self._cached = {}
+        self.legacy_cell_ids = None
+        self.legacy_cell_info = None
+        for table in (CellFrame.__table__, Cell.__table__):
+            db.session.execute(table.delete().where(table.c.project_id == self.project_id))
+
+
+class CellInfo(collections.abc.MutableMapping):
+    """
+    Cell_info entries of the cells in one feature,
+    read from the cells tables when each cell is first used.
+    Iterating over the cells reads all of them at once.
+
+    Args:
+        labels (Labels): label metadata that reads the cells
+        feature (int): feature of the cells
+        cell_labels (iterable): labels of the cells in the cells tables
+    """
+
+    def __init__(self, labels, feature, cell_labels):
+        self._labels = labels
+        self._feature = feature
+        self._keys = set(cell_labels)
+        # Entries read or set in this session, the only ones that can have changed
+        self.loaded = {}
+
+    def __getitem__(self, label):
+        info = self.loaded.get(label)
+        if info is None:
+            if label not in self._keys:
+                raise KeyError(label)
+            # Read cells keep the integer labels of the cells table
+            label = int(label)
+            info = self.loaded[label] = self._labels.read_cells(self._feature, [label])[label]
+        return info
+
+    def __setitem__(self, label, info):
+        self._keys.add(label)
+        self.loaded[label] = info
+
+    def __delitem__(self, label):
+        self._keys.remove(label)
+        self.loaded.pop(label, None)
+
+    def __contains__(self, label):
+        return label in self._keys
+
+    def __iter__(self):
+        unread = sorted(label for label in self._keys if label not in self.loaded)
+        if unread:
+            self.loaded.update(self._labels.read_cells(self._feature, unread))
+        return iter(self.loaded)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, dict(self))
+
+
+class Cell(db.Model):
+    """
+    Table definition for the labels in each feature of a project.
+    Stores the lineage of cells in tracking projects.
+    """
+    # pylint: disable=E1101
+    __tablename__ = 'cells'
+    project_id = db.Column(db.Integer, db.ForeignKey('projects.id'),
+                           primary_key=True, nullable=False)
+    feature = db.Column(db.Integer, primary_key=True, nullable=False, autoincrement=False)
+    label = db.Column(db.Integer, primary_key=True, nullable=False, autoincrement=False)
+    # Lineage of tracked cells; null in zstack projects
+    frame_div = db.Column(db.Integer)
+    capped = db.Column(db.Boolean)
+    parent = db.Column(db.Integer)
+    daughters = db.Column(db.JSON)
+
+    COLUMNS = ('frame_div', 'capped', 'parent', 'daughters')
+
+    @staticmethod
+    def get_state(info):
+        """
+        Args:
+            info (dict): cell_info entry of a cell
+
+        Returns:
+            dict: JSON serializable frames and lineage of the cell
+        """
+        state = {'frames': sorted(map(int, info['frames']))}
+        if 'daughters' in info:
+            optional_int = lambda value: None if value is None else int(value)
+            state['frame_div'] = optional_int(info.get('frame_div'))
+            state['capped'] = None if info.get('capped') is None else bool(info['capped'])
+            state['parent'] = optional_int(info.get('parent'))
+            state['daughters'] = [int(daughter) for daughter in info['daughters']]
+        return state
+
+    @staticmethod
+    def get_columns(state):
+        """Returns the values of the lineage columns for a cell state."""
+        return {column: state.get(column) for column in Cell.COLUMNS}
+
+    @staticmethod
+    def make_info(label, state, is_track):
+        """
+        Args:
+            label (int): label of the cell
+            state (dict): cell state, or row from the cells table without frames
+            is_track (bool): whether to make a track with lineage information
+
+        Returns:
+            dict: cell_info entry of a cell
+        """
+        frames = list(state.get('frames', []))
+        if not is_track:
+            return {'label': str(label), 'frames': frames, 'slices': ''}
+        return {
+            'label': label,
+            'frames': frames,
+            'frame_div': state.get('frame_div'),
+            'daughters': list(state.get('daughters') or []),
+            'capped': bool(state.get('capped')),
+            'parent': state.get('parent'),
+        }
+
+
+class CellFrame(db.Model):
+    """
+    Table definition for the frames that each label appears in.
+    """
+    # pylint: disable=E1101
+    __tablename__ = 'cellframes'
+    project_id = db.Column(db.Integer, primary_key=True, nullable=False)
+    feature = db.Column(db.Integer, primary_key=True, nullable=False, autoincrement=False)
+    label = db.Column(db.Integer, primary_key=True, nullable=False, autoincrement=False)
+    frame_id = db.Column(db.Integer, primary_key=True, nullable=False, autoincrement=False)
+
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ['project_id', 'feature', 'label'],
+            ['cells.project_id', 'cells.feature', 'cells.label']
+        ),
+        # Finds the labels in a frame
+        db.Index('ix_cellframes_frame', 'project_id', 'feature', 'frame_id'),
+    )
 
 
 class RawFrame(db.Model):
@@ -526,7 +1885,8 @@ class RawFrame(db.Model):
     project_id = db.Column(db.Integer, db.ForeignKey('projects.id'),
                            primary_key=True, nullable=False)
     frame_id = db.Column(db.Integer, primary_key=True, nullable=False)
-    frame = db.Column(db.PickleType)
+    # Deferred so listing the frames of a project does not load every array
+    frame = db.deferred(db.Column(NdarrayType(writable=False)))
 
     def __init__(self, frame_id, frame):
         self.frame_id = frame_id
@@ -534,7 +1894,7 @@ class RawFrame(db.Model):
 
     def finish(self):
         """
-        Finish the frame by setting its PickleType column to null.
+        Finish the frame by setting its frame column to null.
         """
         self.frame = None
 
@@ -548,92 +1908,113 @@ class RGBFrame(db.Model):
     project_id = db.Column(db.Integer, db.ForeignKey('projects.id'),
                            primary_key=True, nullable=False)
     frame_id = db.Column(db.Integer, primary_key=True, nullable=False)
-    frame = db.Column(db.PickleType)
-
-    def __init__(self, frame_id, frame):
+    # Deferred so listing the frames of a project does not load every array
+    frame = db.deferred(db.Column(NdarrayType(writable=False)))
+
+    # Adds each of up to 6 rescaled channels (red, green, blue, cyan, magenta, yellow)
+    # to the RGB channels it is made of
+    CHANNEL_MIXER = np.array([
+        [1, 0, 0],
+        [0, 1, 0],
+        [0, 0, 1],
+        [0, 1, 1],
+        [1, 0, 1],
+        [1, 1, 0],
+    ], dtype='float32')
+
+    def __init__(self, frame_id, frame, percentiles=None):
         self.frame_id = frame_id
-        self.frame = self.reduce_to_RGB(frame)
+        self.frame = self.reduce_to_RGB(frame, percentiles)
 
     def finish(self):
         """Finish a frame by setting its frame to null."""
         self.frame = None
 
-    def rescale_95(self, frame):
+    @staticmethod
+    def get_percentiles(raw):
         """
-        Rescale a single- or multi-channel image.
+        Finds the 5th and 95th percentiles of the positive values in the first 6 channels.
 
         Args:
-            frame (np.array): 2d image frame to rescale
+            raw (np.array): a raw frame, or a stack of raw frames for stack-wide percentiles
 
         Returns:
-            np.array: rescaled image
+            np.array: percentiles with shape (channels, 2); NaN for channels without positive values
         """
-        percentiles = np.percentile(frame[frame > 0], [5, 95])
-        rescaled_frame = rescale_intensity(
-            frame,
-            in_range=(percentiles[0], percentiles[1]),
-            out_range='uint8')
-        rescaled_frame = rescaled_frame.astype('uint8')
-        return rescaled_frame
+        num_channels = min(6, raw.shape[-1])
+        percentiles = np.full((num_channels, 2), np.nan)
+        # Channels of a stack are computed in parallel when large enough
+        channels = np.moveaxis(raw[..., :num_channels], -1, 0)
+        get_channel_percentiles = functools.partial(positive_percentiles, q=[5, 95])
+        for channel, channel_percentiles in enumerate(map_frames(get_channel_percentiles,
+                                                                 channels)):
+            if channel_percentiles is not None:
+                percentiles[channel] = channel_percentiles
+        return percentiles
+
+    def rescale_channel(self, channel, low, high):
+        """
+        Rescale a single channel from [low, high] to [0, 255].
+
+        Args:
+            channel (np.array): 2d image to rescale
+            low (float): value rescaled to 0
+            high (float): value rescaled to 255
 
-    def rescale_raw(self, frame):
+        Returns:
+            np.array: rescaled uint8 image
+        """
+        if channel.dtype.kind == 'u' and channel.dtype.itemsize <= 2:
+            # Rescale each possible value once and look up the pixels
+            values = np.arange(np.iinfo(channel.dtype).max + 1)
+            return self.rescale_channel(values, low, high)[channel]
+        if high == low:
+            return np.where(channel >= high, 255, 0).astype('uint8')
+        rescaled = (np.clip(channel, low, high) - low) / float(high - low) * 255
+        return rescaled.astype('uint8')
+
+    def rescale_raw(self, frame, percentiles=None):
         """
-        Rescale first 6 raw channels individually and store in memory.
+        Rescale first 6 raw channels individually between their 5th and 95th percentiles.
         The rescaled raw array is used subsequently for image display purposes.
 
-        Args: multi-channel frame to rescale
+        Args:
+            frame (np.array): multi-channel frame to rescale
+            percentiles (np.array): percentiles to rescale each channel with (e.g. for a stack);
+                                    computed from the frame when None
 
         Returns:
             np.array: upto 6-channel rescaled image
         """
+        frame = frame[..., :6]
+        if percentiles is None:
+            percentiles = self.get_percentiles(frame)
         rescaled = np.zeros(frame.shape, dtype='uint8')
         # this approach allows noise through
-        for channel in range(min(6, frame.shape[-1])):
-            raw_channel = frame[..., channel]
-            if np.sum(raw_channel) != 0:
-                rescaled[..., channel] = self.rescale_95(raw_channel)
+        for channel, (low, high) in enumerate(percentiles[:frame.shape[-1]]):
+            # Channels without positive values stay black
+            if not np.isnan(low):
+                rescaled[..., channel] = self.rescale_channel(frame[..., channel], low, high)
         return rescaled
 
-    def reduce_to_RGB(self, frame):
+    def reduce_to_RGB(self, frame, percentiles=None):
         """
         Go from rescaled raw array with up to 6 channels to an RGB image for display.
-        Handles adding in CMY channels as needed, and adjusting each channel if
-        viewing adjusted raw. Used to update self.rgb, which is used to display
-        raw current frame.
+        Adds the CMY channels to the RGB channels with a single mixing matrix.
 
         Args:
             frame (np.array): upto 6-channel image to reduce to 3-channel image
+            percentiles (np.array): percentiles to rescale each channel with;
+                                    computed from the frame when None
 
         Returns:
             np.array: 3-channel image
         """
-        rescaled = self.rescale_raw(frame)
-        # rgb starts as uint16 so it can handle values above 255 without overflow
-        rgb_img = np.zeros((frame.shape[0], frame.shape[1], 3), dtype='uint16')
-
-        # for each of the channels that we have
-        for c in range(min(6, frame.shape[-1])):
-            # straightforward RGB -> RGB
-            new_channel = (rescaled[..., c]).astype('uint16')
-            if c < 3:
-                rgb_img[..., c] = new_channel
-            # collapse cyan to G and B
-            if c == 3:
-                rgb_img[..., 1] += new_channel
-                rgb_img[..., 2] += new_channel
-            # collapse magenta to R and B
-            if c == 4:
-                rgb_img[..., 0] += new_channel
-                rgb_img[..., 2] += new_channel
-            # collapse yellow to R and G
-            if c == 5:
-                rgb_img[..., 0] += new_channel
-                rgb_img[..., 1] += new_channel
-
-            # clip values to uint8 range so it can be cast without overflow
-            rgb_img[..., 0:3] = np.clip(rgb_img[..., 0:3], a_min=0, a_max=255)
-
-        return rgb_img.astype('uint8')
+        rescaled = self.rescale_raw(frame, percentiles)
+        mixer = self.CHANNEL_MIXER[:rescaled.shape[-1]]
+        rgb_img = np.tensordot(rescaled.astype('float32'), mixer, axes=1)
+        # clip values to uint8 range so it can be cast without overflow
+        return np.minimum(rgb_img, 255).astype('uint8')
 
 
 class LabelFrame(db.Model):
@@ -646,12 +2027,16 @@ class LabelFrame(db.Model):
     project_id = db.Column(db.Integer, db.ForeignKey('projects.id'),
                            primary_key=True, nullable=False)
     frame_id = db.Column(db.Integer, primary_key=True, nullable=False)
-    frame = db.Column(MutableNdarray.as_mutable(db.PickleType))
+    # Deferred so listing the frames of a project does not load every array
+    frame = db.deferred(db.Column(MutableNdarray.as_mutable(NdarrayType())))
+    # Increases when the frame is edited to identify its images in HTTP caches
+    version = db.Column(db.Integer, nullable=False, default=0)
 
     actions = association_proxy('frame_actions', 'action')
 
     def __init__(self, frame_id, frame):
         self.frame_id = frame_id
+        self.version = 0
         self.frame = frame
 
     def finish(self):
@@ -683,9 +2068,6 @@ class Action(db.Model):
                                   "remote(Action.action_id)==foreign(Action.next_action_id))")
     # Whether the action is currently in the Projects lineage
     done = db.Column(db.Boolean, default=True)
-    # Records label info after an action (whether or not its changed)
-    # Pickles an ORM row from the Labels table
-    labels = db.Column(db.PickleType)
 
     frames = association_proxy('action_frames', 'frame')
 
@@ -701,55 +2083,44 @@ class Action(db.Model):
 
     @property
     def labels_changed(self):
-        return self.labels is not None
+        return len(self.cell_mementos) > 0
 
     @property
     def before_frames(self):
         """
-        Returns a list of FrameMementos containing
+        Returns a list of FrameMementos that restore
         the before version of frames edited by this action.
-        TODO: profile this search
-        """
-        # Find the most last version of each edited frame before this action
-        before_frames = []
-        for frame in self.frames:
-            # Actions in the frame's lineage before this action
-            valid_actions = filter(lambda action: action.done and action.action_id < self.action_id,
-                                   frame.actions)
-            # Action containing the most recent version
-            before_action = max(valid_actions, key=lambda action: action.action_id)
-            before_frame = next(filter(lambda bf, f=frame: bf.frame_id == f.frame_id,
-                                       before_action.action_frames))
-            before_frames.append(before_frame)
-        return before_frames
+        """
+        return self.action_frames
 
     @property
     def after_frames(self):
-        """Returns a list of FramesMementos containing
-        the after version of frames edited by this action."""
+        """
+        Returns a list of FrameMementos that restore
+        the after version of frames edited by this action.
+        """
         return self.action_frames
 
-    @property
-    def before_labels(self):
-        if self.prev_action is None:
-            return None
-        return self.prev_action.labels
-
-    @property
-    def after_labels(self):
-        return self.labels
-
 
 class FrameMemento(db.Model):
     """
-    Table to store label frames in a Memento.
+    Table to store the changes to a label frame in a Memento.
+    Stores the bounding box of the changed pixels and
+    the contents of the box before and after the action,
+    so undo and redo only write the changed region back into the frame.
     """
     # pylint: disable=E1101
     __tablename__ = 'framemementos'
     project_id = db.Column(db.Integer)
     action_id = db.Column(db.Integer)
     frame_id = db.Column(db.Integer)
-    frame_array = db.Column(db.PickleType)
+    # Bounding box of the changed pixels; null when no pixels changed
+    y1 = db.Column(db.Integer)
+    x1 = db.Column(db.Integer)
+    y2 = db.Column(db.Integer)
+    x2 = db.Column(db.Integer)
+    before_patch = db.Column(NdarrayType())
+    after_patch = db.Column(NdarrayType())
 
     action = db.relationship("Action", backref="action_frames")
     frame = db.relationship("LabelFrame", backref="frame_actions")
@@ -766,11 +2137,337 @@ class FrameMemento(db.Model):
         )
     )
 
-    def __init__(self, action, frame):
+    def __init__(self, action, frame, before=None):
+        """
+        Args:
+            action (Action): action that edited the frame
+            frame (LabelFrame): frame after the action
+            before (np.array): frame array before the action;
+                               when None, no changes are stored
+        """
         self.action = action
         self.frame = frame
-        self.frame_array = frame.frame.copy()
+        if before is None:
+            return
+        after = frame.frame
+        box = changed_box(before, after)
+        if box is None:
+            return
+        self.y1, self.x1, self.y2, self.x2 = box
+        self.before_patch = np.array(before[self.y1:self.y2, self.x1:self.x2])
+        self.after_patch = np.array(after[self.y1:self.y2, self.x1:self.x2])
+
+    @property
+    def changed(self):
+        """Whether any pixels changed in the frame."""
+        return self.y1 is not None
+
+    def restore_before(self, label_frame):
+        """
+        Restores the changed region of the frame to before the action.
 
+        Args:
+            label_frame (LabelFrame): frame to restore
+        """
+        if self.changed:
+            label_frame.frame[self.y1:self.y2, self.x1:self.x2] = self.before_patch
+
+    def restore_after(self, label_frame):
+        """
+        Restores the changed region of the frame to after the action.
+
+        Args:
+            label_frame (LabelFrame): frame to restore
+        """
+        if self.changed:
+            label_frame.frame[self.y1:self.y2, self.x1:self.x2] = self.after_patch
 
-def consecutive(data, stepsize=1):
-    return np.split(data, np.where(np.diff(data) != stepsize)[0] + 1)
+
+@db.event.listens_for(RawFrame, 'load', insert=True)
+@db.event.listens_for(RGBFrame, 'load', insert=True)
+@db.event.listens_for(LabelFrame, 'load', insert=True)
+def load_cached_frame(frame, context, attrs=None):
+    """
+    Fills the deferred frame column from the project cache when a frame is loaded,
+    or caches the frame when its column was loaded from the database.
+    Inserted before the MutableNdarray listener so cached label frames are still tracked.
+
+    Args:
+        frame (db.Model): RawFrame, RGBFrame, or LabelFrame that was loaded
+        context (QueryContext): context of the query that loaded the frame
+        attrs (iterable): attributes loaded by a refresh; None when the whole row was loaded
+    """
+    table = frame.__tablename__
+    if 'frame' in frame.__dict__:
+        # Frames loaded before a refresh, or edited, are not the committed arrays
+        if (attrs is not None and 'frame' not in attrs) or db.inspect(frame).modified:
+            return
+        # Loaded from the database, so cache the committed array
+        # at the version of the project loaded in the same session
+        project = context.session.identity_map.get(identity_key(Project, frame.project_id))
+        version = None if project is None else project.__dict__.get('version')
+        array = frame.__dict__['frame']
+        if isinstance(frame, LabelFrame) and array is not None:
+            array = np.array(array)
+        project_cache.put(frame.project_id, table, frame.frame_id, array, version)
+        return
+    array = project_cache.get(frame.project_id, table, frame.frame_id)
+    if array is None:
+        return
+    if isinstance(frame, LabelFrame):
+        # Label frames are edited in place, so the cached array must stay unchanged
+        array = array.copy()
+    set_committed_value(frame, 'frame', array)
+
+
+@db.event.listens_for(RawFrame, 'refresh', insert=True)
+@db.event.listens_for(RGBFrame, 'refresh', insert=True)
+@db.event.listens_for(LabelFrame, 'refresh', insert=True)
+def refresh_cached_frame(frame, context, attrs):
+    """Fills or caches the frame column of frames reloaded after their session expired them."""
+    load_cached_frame(frame, context, attrs)
+
+
+@db.event.listens_for(LabelFrame.frame, 'set')
+@db.event.listens_for(LabelFrame.frame, 'modified')
+def increase_frame_version(frame, *args):
+    """
+    Increases the version of a label frame the first time it changes in a transaction,
+    so payloads made before committing the edit already refer to the new version.
+    Saved frames are increased in the database, so edits from other workers are not lost.
+    """
+    state = db.inspect(frame)
+    if state.attrs.version.history.has_changes():
+        return
+    if not state.persistent:
+        frame.version += 1
+        return
+    table = LabelFrame.__table__
+    where = db.and_(table.c.project_id == frame.project_id, table.c.frame_id == frame.frame_id)
+    state.session.execute(table.update().where(where).values(version=table.c.version + 1))
+    # Set rather than load the increased version, so it is written again on flush
+    # and the committed version stays in the history of the frame
+    frame.version = state.session.execute(db.select([table.c.version]).where(where)).scalar()
+
+
+class CellMemento(db.Model):
+    """
+    Table to store the changes to a label's metadata in a Memento.
+    Stores the frames and lineage of the label before and after the action.
+    """
+    # pylint: disable=E1101
+    __tablename__ = 'cellmementos'
+    project_id = db.Column(db.Integer)
+    action_id = db.Column(db.Integer)
+    feature = db.Column(db.Integer)
+    label = db.Column(db.Integer)
+    # Cell states from Cell.get_state; null when the label does not exist
+    before = db.Column(db.JSON)
+    after = db.Column(db.JSON)
+
+    action = db.relationship('Action', backref='cell_mementos')
+
+    __table_args__ = (
+        PrimaryKeyConstraint('project_id', 'action_id', 'feature', 'label'),
+        ForeignKeyConstraint(
+            ['project_id', 'action_id'],
+            ['actions.project_id', 'actions.action_id']
+        ),
+    )
+
+    def __init__(self, action, feature, label, before, after):
+        self.action = action
+        self.feature = feature
+        self.label = label
+        self.before = before
+        self.after = after
+
+    def restore_before(self, labels):
+        """Restores the label to before the action."""
+        labels.restore(self.feature, self.label, self.before, self.after)
+
+    def restore_after(self, labels):
+        """Restores the label to after the action."""
+        labels.restore(self.feature, self.label, self.after, self.before)
+
+
+def upgrade_schema():
+    """
+    Creates the missing tables and adds the columns missing from tables
+    created by older versions, as create_all does not add columns to existing tables.
+    Columns that cannot be null are added with their default value.
+
+    Returns:
+        list: added columns as 'table.column'
+    """
+    db.create_all()
+    connection = db.session.connection()
+    dialect = connection.dialect
+    quote = dialect.identifier_preparer.quote
+    inspector = db.inspect(connection)
+    added = []
+    for name, table in sorted(db.metadata.tables.items()):
+        columns = {column['name'] for column in inspector.get_columns(name)}
+        for column in table.columns:
+            if column.name in columns:
+                continue
+            ddl = 'ALTER TABLE {} ADD COLUMN {} {}'.format(
+                quote(name), quote(column.name), column.type.compile(dialect))
+            if not column.nullable:
+                default = db.literal(column.default.arg).compile(
+                    dialect=dialect, compile_kwargs={'literal_binds': True})
+                ddl += ' NOT NULL DEFAULT {}'.format(default)
+            db.session.execute(ddl)
+            added.append('{}.{}'.format(name, column.name))
+    db.session.commit()
+    if added:
+        logger.info('Added columns %s to the database.', ', '.join(added))
+    return added
+
+
+def migrate_frames(batch_size=100):
+    """
+    Re-encodes frames stored as pickled arrays with NdarrayType.
+    Pickled frames are still readable, so migrating is optional
+    but shrinks the database and speeds up reading frames.
+    Brings the schema of older databases up to date first.
+
+    Args:
+        batch_size (int): number of rows to update per statement
+
+    Returns:
+        int: number of rows re-encoded
+    """
+    upgrade_schema()
+    start = timeit.default_timer()
+    count = 0
+    columns = [(RawFrame, 'frame'), (RGBFrame, 'frame'), (LabelFrame, 'frame')]
+    for model, column_name in columns:
+        table = model.__table__
+        column = table.c[column_name]
+        primary_key = list(table.primary_key.columns)
+        # Select the stored bytes without decoding them
+        stored = db.type_coerce(column, db.LargeBinary).label('stored')
+        rows = db.session.execute(db.select(primary_key + [stored]))
+        # Bind primary key values under different names than the columns
+        where = db.and_(*[key == db.bindparam('_' + key.name) for key in primary_key])
+        update = table.update().where(where).values({column_name: db.bindparam('stored')})
+        batch = []
+        for row in rows:
+            if row.stored is None or row.stored.startswith(NdarrayType.MAGIC):
+                continue
+            array = pickle.loads(row.stored)
+            params = {'_' + key.name: row[key.name] for key in primary_key}
+            params['stored'] = column.type.encode(array)
+            batch.append(params)
+            if len(batch) == batch_size:
+                db.session.execute(update, batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            db.session.execute(update, batch)
+            count += len(batch)
+    db.session.commit()
+    logger.debug('Migrated %s pickled frames in %ss.',
+                 count, timeit.default_timer() - start)
+    return count
+
+
+def migrate_frame_mementos():
+    """
+    Converts frame mementos that store the whole frame after their action
+    in the legacy frame_array column to the region of the frame changed by the action.
+    The frame before the action is the memento of the same frame
+    from the closest action on the undo path before it.
+    Adds the columns of the changed region to tables created before they existed
+    with upgrade_schema.
+
+    Returns:
+        int: number of mementos converted
+    """
+    start = timeit.default_timer()
+    table = FrameMemento.__table__
+    columns = {column['name'] for column in
+               db.inspect(db.session.connection()).get_columns(table.name)}
+    if 'frame_array' not in columns:
+        return 0
+    upgrade_schema()
+
+    # The mapped table without the legacy column
+    legacy = db.table(table.name, db.column('frame_array', db.LargeBinary),
+                      *[db.column(column.name, column.type) for column in table.columns])
+    actions = Action.__table__
+    prev_actions = {(project_id, action_id): prev_action_id
+                    for project_id, action_id, prev_action_id in db.session.execute(
+                        db.select([actions.c.project_id, actions.c.action_id,
+                                   actions.c.prev_action_id]))}
+    keys = db.session.execute(db.select([legacy.c.project_id, legacy.c.action_id,
+                                         legacy.c.frame_id])
+                              .where(legacy.c.frame_array.isnot(None))).fetchall()
+    legacy_keys = {tuple(key) for key in keys}
+
+    def where(project_id, action_id, frame_id):
+        return db.and_(legacy.c.project_id == project_id, legacy.c.action_id == action_id,
+                       legacy.c.frame_id == frame_id)
+
+    def load(*key):
+        stored = db.session.execute(db.select([legacy.c.frame_array]).where(where(*key)))
+        return pickle.loads(stored.scalar())
+
+    # Later actions first, so the mementos before them are still whole frames
+    for project_id, action_id, frame_id in sorted(legacy_keys, reverse=True):
+        prev_action_id = prev_actions.get((project_id, action_id))
+        while (prev_action_id is not None and
+               (project_id, prev_action_id, frame_id) not in legacy_keys):
+            prev_action_id = prev_actions.get((project_id, prev_action_id))
+        values = {'frame_array': None}
+        if prev_action_id is not None:
+            after = load(project_id, action_id, frame_id)
+            before = load(project_id, prev_action_id, frame_id)
+            box = changed_box(before, after)
+            if box is not None:
+                y1, x1, y2, x2 = box
+                values.update(y1=y1, x1=x1, y2=y2, x2=x2,
+                              before_patch=np.array(before[y1:y2, x1:x2]),
+                              after_patch=np.array(after[y1:y2, x1:x2]))
+        db.session.execute(legacy.update().where(where(project_id, action_id, frame_id))
+                           .values(values))
+    db.session.commit()
+    logger.debug('Migrated %s frame mementos in %ss.',
+                 len(legacy_keys), timeit.default_timer() - start)
+    return len(legacy_keys)
+
+
+def make_readable(info):
+    """
+    Args:
+        info (dict): cell_info entry of a cell
+
+    Returns:
+        dict: copy of the entry with its frames as a slices string like [0-29, 31]
+    """
+    readable = dict(info)
+    readable['slices'] = format_slices(info['frames'])
+    return readable
+
+
+def format_slices(frames):
+    """
+    Args:
+        frames (list): frame IDs in order
+
+    Returns:
+        str: runs of consecutive frames like [0-29, 31]
+    """
+    runs = []
+    start = prev = None
+    for frame in frames:
+        if prev is not None and frame == prev + 1:
+            prev = frame
+            continue
+        if start is not None:
+            runs.append(f'{start}' if start == prev else f'{start}-{prev}')
+        start = prev = frame
+    if start is not None:
+        runs.append(f'{start}' if start == prev else f'{start}-{prev}')
+    return '[' + ', '.join(runs) + ']'
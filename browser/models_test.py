@@ -1,13 +1,16 @@
 """Test for DeepCell Label Models"""
 
+import base64
 import io
+import pickle
 
 import numpy as np
 import pytest
 
+import imgutils
 import models
 from imgutils import pngify
-from conftest import DummyLoader
+from conftest import DummyLoader, decode_array
 
 
 # Automatically enable transactions for all tests, without importing any extra fixtures.
@@ -17,6 +20,131 @@ def enable_transactional_tests(db_session):
     pass
 
 
+@pytest.mark.parametrize('codec', ['raw', 'zlib'])
+@pytest.mark.parametrize('dtype', ['uint8', 'int16', 'int32', 'float64', '>u2'])
+def test_ndarray_type_roundtrip(codec, dtype):
+    array = np.arange(60).reshape((3, 4, 5)).astype(dtype)
+    ndarray_type = models.NdarrayType(codec=codec)
+
+    stored = ndarray_type.process_bind_param(array, None)
+    loaded = ndarray_type.process_result_value(stored, None)
+
+    assert stored.startswith(models.NdarrayType.MAGIC)
+    assert loaded.dtype == array.dtype
+    np.testing.assert_array_equal(loaded, array)
+    # Writable arrays can be edited in place
+    loaded[0, 0, 0] = 1
+
+
+def test_ndarray_type_non_contiguous():
+    array = np.arange(60).reshape((3, 4, 5))[..., 1]
+    ndarray_type = models.NdarrayType()
+
+    stored = ndarray_type.process_bind_param(array, None)
+    loaded = ndarray_type.process_result_value(stored, None)
+
+    np.testing.assert_array_equal(loaded, array)
+
+
+def test_ndarray_type_read_only():
+    array = np.ones((4, 4, 1), dtype='uint16')
+    ndarray_type = models.NdarrayType(codec='raw', writable=False)
+
+    stored = ndarray_type.process_bind_param(array, None)
+    loaded = ndarray_type.process_result_value(stored, None)
+
+    np.testing.assert_array_equal(loaded, array)
+    assert not loaded.flags.writeable
+
+
+def test_ndarray_type_none():
+    ndarray_type = models.NdarrayType()
+    assert ndarray_type.process_bind_param(None, None) is None
+    assert ndarray_type.process_result_value(None, None) is None
+
+
+def test_ndarray_type_invalid_codec():
+    with pytest.raises(ValueError):
+        models.NdarrayType(codec='bad codec')
+
+
+def test_ndarray_type_legacy_pickle():
+    array = np.arange(16).reshape((4, 4))
+    ndarray_type = models.NdarrayType()
+
+    loaded = ndarray_type.process_result_value(pickle.dumps(array), None)
+
+    np.testing.assert_array_equal(loaded, array)
+
+
+def test_migrate_frames(db_session):
+    labels = np.arange(4).reshape((1, 2, 2, 1))
+    project = models.Project.create(DummyLoader(labels=labels))
+    table = models.LabelFrame.__table__
+    stored = models.db.type_coerce(table.c.frame, models.db.LargeBinary)
+
+    # Store the label frame as a pickled array
+    db_session.execute(table.update()
+                       .where(table.c.project_id == project.id)
+                       .values(frame=models.db.type_coerce(pickle.dumps(labels[0]),
+                                                           models.db.LargeBinary)))
+    row = db_session.execute(models.db.select([stored])
+                             .where(table.c.project_id == project.id)).first()
+    assert not row[0].startswith(models.NdarrayType.MAGIC)
+
+    models.migrate_frames()
+
+    row = db_session.execute(models.db.select([stored])
+                             .where(table.c.project_id == project.id)).first()
+    assert row[0].startswith(models.NdarrayType.MAGIC)
+    db_session.expire(project.label_frames[0])
+    np.testing.assert_array_equal(project.label_frames[0].frame, labels[0])
+
+
+def test_migrate_frame_mementos(db_session):
+    labels = np.zeros((2, 4, 4, 1), dtype='int32')
+    project = models.Project.create(DummyLoader(labels=labels))
+    token = project.token
+    frames = [np.array(labels[0]), np.array(labels[0]), np.array(labels[0])]
+    frames[1][0, 0] = 1
+    frames[2][0, 0] = 1
+    frames[2][1:3, 1:3] = 2
+    for frame in frames[1:]:
+        project.label_frames[0].frame[:] = frame
+        project.create_memento('edit')
+        project.update()
+
+    # Store the mementos like before they stored the changed region:
+    # the whole frame after each action, and every frame for the first action
+    table = models.FrameMemento.__table__
+    action_ids = [action.action_id for action in project.actions]
+    db_session.execute('ALTER TABLE framemementos ADD COLUMN frame_array BLOB')
+    db_session.execute(table.delete().where(table.c.project_id == project.id))
+    legacy = [(action_ids[0], 0, frames[0]), (action_ids[0], 1, labels[1]),
+              (action_ids[1], 0, frames[1]), (action_ids[2], 0, frames[2])]
+    legacy_table = models.db.table(table.name, *[models.db.column(name) for name in
+                                                 ('project_id', 'action_id', 'frame_id',
+                                                  'frame_array')])
+    for action_id, frame_id, frame in legacy:
+        db_session.execute(legacy_table.insert().values(
+            project_id=project.id, action_id=action_id, frame_id=frame_id,
+            frame_array=models.db.type_coerce(pickle.dumps(frame), models.db.LargeBinary)))
+
+    assert models.migrate_frame_mementos() == 4
+    assert models.migrate_frame_mementos() == 0
+
+    db_session.expire_all()
+    project = models.Project.get(token)
+    memento = project.action.action_frames[0]
+    assert (memento.y1, memento.x1, memento.y2, memento.x2) == (1, 1, 3, 3)
+    project.undo()
+    np.testing.assert_array_equal(project.label_frames[0].frame, frames[1])
+    project.undo()
+    np.testing.assert_array_equal(project.label_frames[0].frame, frames[0])
+    project.redo()
+    np.testing.assert_array_equal(project.label_frames[0].frame, frames[1])
+
+
 def test_project_init():
     """
     Test constructor for Project table.
@@ -31,7 +159,6 @@ def test_project_init():
     project.width is not None
     project.num_channels is not None
     project.num_features is not None
-    project.colormap is not None
 
 
 def test_is_track():
@@ -123,6 +250,22 @@ def test_create():
     assert project.num_actions == 1
 
 
+@pytest.mark.parametrize('num_frames', [1, 20])
+def test_create_inserts_frames_in_bulk(query_counter, num_frames):
+    raw = np.random.RandomState(0).randint(0, 100, size=(num_frames, 4, 4, 1))
+    labels = np.arange(num_frames).reshape((num_frames, 1, 1, 1)) * np.ones((1, 4, 4, 1))
+
+    with query_counter() as counter:
+        project = models.Project.create(DummyLoader(raw=raw, labels=labels), batch_size=50)
+
+    inserts = [s for s in counter.statements if s.startswith('INSERT')]
+    for table in ('rawframes', 'labelframes', 'framemementos'):
+        assert len([s for s in inserts if s.startswith(f'INSERT INTO {table} ')]) == 1
+    np.testing.assert_array_equal(project.raw_array, raw)
+    np.testing.assert_array_equal(project.label_array, labels)
+    assert [memento.frame_id for memento in project.action.action_frames] == list(range(num_frames))
+
+
 def test_create_memento_no_changes(db_session):
     project = models.Project.create(DummyLoader())
     # Store action info before creating new action
@@ -139,8 +282,7 @@ def test_create_memento_no_changes(db_session):
 
     assert len(project.action.before_frames) == 0
     assert len(project.action.after_frames) == 0
-    assert project.action.before_labels is not None
-    assert project.action.after_labels is not None
+    assert not project.action.labels_changed
 
 
 def test_create_memento_frame_changed(db_session):
@@ -168,6 +310,55 @@ def test_create_memento_frame_changed(db_session):
     assert project.action.before_frames[0].frame is changed_frame
 
 
+def test_create_memento_stores_changed_region(db_session):
+    labels = np.zeros((1, 100, 100, 2))
+    project = models.Project.create(DummyLoader(labels=labels))
+
+    # Mock action that changes two pixels
+    project.label_frames[0].frame[10, 20, 1] = 1
+    project.label_frames[0].frame[12, 25, 1] = 2
+    project.create_memento(action_name='test')
+    project.update()
+
+    memento = project.action.after_frames[0]
+    assert memento.changed
+    assert (memento.y1, memento.x1, memento.y2, memento.x2) == (10, 20, 13, 26)
+    assert memento.before_patch.shape == (3, 6, 2)
+    assert memento.after_patch.shape == (3, 6, 2)
+    np.testing.assert_array_equal(memento.before_patch, 0)
+    assert memento.after_patch[0, 0, 1] == 1
+    assert memento.after_patch[2, 5, 1] == 2
+
+
+def test_create_memento_frame_not_changed(db_session):
+    project = models.Project.create(DummyLoader())
+
+    # Mock action that assigns the same values to the frame
+    project.label_frames[0].frame[:] = 0
+    project.create_memento(action_name='test')
+    project.update()
+
+    memento = project.action.after_frames[0]
+    assert not memento.changed
+    assert memento.before_patch is None
+    assert memento.after_patch is None
+
+
+def test_undo_redo_changed_region():
+    labels = np.zeros((1, 10, 10, 1))
+    project = models.Project.create(DummyLoader(labels=labels))
+    expected_after = labels[0].copy()
+    expected_after[2:4, 5:7] = 3
+
+    project.label_frames[0].frame[2:4, 5:7] = 3
+    project.create_memento(action_name='test')
+    project.update()
+    project.undo()
+    np.testing.assert_array_equal(project.label_frames[0].frame, labels[0])
+    project.redo()
+    np.testing.assert_array_equal(project.label_frames[0].frame, expected_after)
+
+
 def test_undo_no_previous_action():
     """Test undoing at the start of the action history."""
     project = models.Project.create(DummyLoader())
@@ -287,6 +478,419 @@ def test_redo_frame_not_changed_in_next_action():
     assert 1 in project.label_frames[1].frame
 
 
+@pytest.mark.parametrize('history_length', [1, 5, 25])
+def test_undo_queries_independent_of_history(db_session, query_counter, history_length):
+    """Undo queries only the mementos of the undone action, however long the history is."""
+    project = models.Project.create(DummyLoader(raw=np.zeros((3, 4, 4, 1))))
+    for i in range(history_length):
+        # Edit one frame with every action
+        project.label_frames[i % 3].frame[:] = i + 1
+        project.create_memento('edit_one_frame')
+        project.update()
+    # Start from a fresh session like a request
+    db_session.expire_all()
+    project = models.Project.get(project.token)
+
+    with query_counter() as counter:
+        project.undo()
+
+    # project.action, action.prev_action, action_frames, the undone label frame,
+    # its increased version, cell_mementos, labels (with its cells cached by this worker),
+    # the increased project version,
+    # and the displayed label frame for the payload when it is not the undone frame
+    undone_frame = (history_length - 1) % 3
+    assert len(counter.selects) == 8 + (undone_frame != project.frame)
+
+
+def test_action_frames(db_session):
+    project = models.Project.create(DummyLoader(raw=np.zeros((3, 1, 1, 1))))
+
+    project.label_frames[2].frame[:] = 1
+    project.create_memento('edit_frame_2')
+    project.update()
+    # Action that edits no frames
+    project.create_memento('no_frames')
+    project.update()
+    project.label_frames[1].frame[:] = 1
+    project.label_frames[0].frame[:] = 1
+    project.create_memento('edit_frames_0_and_1')
+    project.update()
+    project.label_frames[1].frame[:] = 2
+    project.create_memento('undone')
+    project.update()
+    project.undo()
+
+    assert project._get_action_frames() == [2, 2, 0]
+
+
+def test_cached_frames_not_queried(db_session, query_counter):
+    project = models.Project.create(DummyLoader(raw=np.ones((2, 4, 4, 1))))
+    # Load the frames into the cache
+    project.get_label_frame(1).frame
+    project.get_raw_frame(1).frame
+    # Start from a fresh session like a request
+    db_session.expire_all()
+    project = models.Project.get(project.token)
+
+    with query_counter() as counter:
+        frame = project.label_frames[1].frame
+        raw_frame = project.raw_frames[1].frame
+
+    np.testing.assert_array_equal(frame, np.zeros((4, 4, 1)))
+    np.testing.assert_array_equal(raw_frame, np.ones((4, 4, 1)))
+    # Only list the frames, without loading any frame columns
+    assert len(counter.selects) == 2
+    assert all('.frame AS' not in select for select in counter.selects)
+
+
+def test_cache_writes_through_edits(db_session):
+    project = models.Project.create(DummyLoader(raw=np.zeros((2, 4, 4, 1))))
+    project_id, version = project.id, project.version
+
+    project.label_frames[1].frame[0, 0] = 1
+    project.create_memento('edit')
+    project.update()
+
+    assert project.version == version + 1
+    cached = models.project_cache.get(project_id, 'labelframes', 1)
+    assert cached[0, 0, 0] == 1
+    # Cached arrays are not shared with the edited frames
+    assert not np.shares_memory(cached, project.label_frames[1].frame)
+
+
+def test_cache_dropped_for_new_version(db_session):
+    project = models.Project.create(DummyLoader(raw=np.zeros((2, 4, 4, 1))))
+    project.get_label_frame(0).frame
+    assert len(models.project_cache) > 0
+    # Mock another worker changing the project
+    models.db.session.query(models.Project).filter_by(id=project.id).update(
+        {'version': models.Project.version + 1})
+    db_session.expire_all()
+
+    models.Project.get(project.token)
+
+    assert len(models.project_cache) == 0
+
+
+def test_cache_skips_frames_read_at_old_version(db_session):
+    project = models.Project.create(DummyLoader(raw=np.zeros((2, 4, 4, 1))))
+    project_id, token, version = project.id, project.token, project.version
+    models.project_cache.clear()
+    db_session.expire_all()
+    project = models.Project.get(token)
+    # Mock a commit from another session, like a request during a prefetch
+    models.project_cache.advance(project_id, token, version, version + 1)
+
+    project.get_label_frame(0).frame
+
+    assert models.project_cache.get(project_id, 'labelframes', 0) is None
+
+
+def test_cache_skips_edited_frames_loaded_again(db_session):
+    project = models.Project.create(DummyLoader(raw=np.zeros((2, 4, 4, 1))))
+    project_id, token = project.id, project.token
+    models.project_cache.clear()
+    db_session.expire_all()
+    project = models.Project.get(token)
+    project.label_frames[1].frame[0, 0] = 1
+
+    # Loads the frames again, like remaking the label metadata after an edit
+    project.label_array
+    project.create_memento('edit')
+    project.update()
+
+    assert models.project_cache.get(project_id, 'labelframes', 0) is not None
+    memento = project.action.before_frames[0]
+    assert memento.frame_id == 1 and memento.changed
+    project.undo()
+    assert project.get_label_frame(1).frame[0, 0] == 0
+
+
+def test_commit_keeps_versions_from_other_workers(db_session):
+    project = models.Project.create(DummyLoader(raw=np.zeros((2, 4, 4, 1))))
+    project_id, version = project.id, project.version
+    label_frame = project.get_label_frame(1)
+    # Mock another worker committing edits to the project and frame
+    models.db.session.query(models.Project).filter_by(id=project_id).update(
+        {'version': models.Project.version + 1}, synchronize_session=False)
+    models.db.session.query(models.LabelFrame).filter_by(project_id=project_id, frame_id=1).update(
+        {'version': models.LabelFrame.version + 1}, synchronize_session=False)
+
+    label_frame.frame[0, 0] = 1
+    assert label_frame.version == 2
+    project.create_memento('edit')
+    project.update()
+
+    assert project.version == version + 2
+    # Frames read before the other commit are not cached at the new version
+    assert models.project_cache.get(project_id, 'labelframes', 1) is None
+    assert project.get_label_frame(1).version == 2
+
+
+def test_label_edit_writes_changed_cells(db_session, query_counter):
+    """Adding a label to one frame inserts one row instead of rewriting the labels."""
+    labels = np.zeros((3, 2, 2, 1))
+    labels[0, 0, 0, 0] = labels[2, 0, 0, 0] = 1
+    project = models.Project.create(DummyLoader(labels=labels))
+    assert project.labels.cell_info[0][1]['frames'] == [0, 2]
+
+    project.labels.cell_info[0][1]['frames'].append(1)
+    project.create_memento('add_frame')
+    with query_counter() as counter:
+        project.update()
+
+    writes = [s.split()[0:3] for s in counter.statements if not s.startswith('SELECT')]
+    assert ['INSERT', 'INTO', 'cellframes'] in writes
+    assert not any(table == 'cells' or table == 'labels' for _, _, table in writes)
+    assert not any(s.startswith('UPDATE labels') for s in counter.statements)
+    assert project.action.labels_changed
+
+
+@pytest.mark.parametrize('cached', [True, False])
+def test_labels_roundtrip(db_session, cached):
+    labels = np.zeros((3, 2, 2, 1))
+    labels[0, 0, 0, 0] = labels[1, 0, 0, 0] = 1
+    labels[2, 1, 1, 0] = 2
+    project = models.Project.create(DummyLoader(labels=labels, path='test.trk'))
+    tracks = project.labels.tracks
+    tracks[1]['daughters'] = [2]
+    tracks[1]['frame_div'] = 2
+    tracks[2]['parent'] = 1
+    project.create_memento('divide')
+    project.update()
+    expected_ids = {k: v.copy() for k, v in project.labels.cell_ids.items()}
+    expected_info = {k: dict(v) for k, v in project.labels.cell_info.items()}
+    if not cached:
+        models.project_cache.clear()
+
+    db_session.expire_all()
+    project = models.Project.get(project.token)
+
+    assert project.labels.cell_info == expected_info
+    for feature, cell_ids in expected_ids.items():
+        np.testing.assert_array_equal(project.labels.cell_ids[feature], cell_ids)
+
+
+def test_labels_read_when_used(db_session, query_counter):
+    """Labels read only the labels in each feature until the frames of a cell are used."""
+    labels = np.zeros((3, 2, 2, 1))
+    labels[0, 0, 0, 0] = labels[1, 0, 0, 0] = 1
+    labels[2, 1, 1, 0] = 2
+    project = models.Project.create(DummyLoader(labels=labels))
+    models.project_cache.clear()
+    db_session.expire_all()
+    project = models.Project.get(project.token)
+    # Mock a new request, which loads the labels again
+    project.labels.init_on_load()
+
+    with query_counter() as counter:
+        assert project.get_max_label() == 2
+    # Only the labels in the cells table
+    assert len(counter.selects) == 1
+    assert not any('cellframes' in select for select in counter.selects)
+
+    with query_counter() as counter:
+        assert project.labels.cell_info[0][1]['frames'] == [0, 1]
+        assert project.labels.cell_info[0][1]['frames'] == [0, 1]
+    # The cell joined with its frames, once
+    assert len(counter.selects) == 1
+    assert 'cells.label IN' in counter.selects[0]
+    assert set(project.labels.cell_info[0].loaded) == {1}
+
+
+def test_labels_cached_for_project_version(db_session, query_counter):
+    labels = np.zeros((3, 2, 2, 1))
+    labels[0, 0, 0, 0] = labels[1, 0, 0, 0] = 1
+    labels[2, 1, 1, 0] = 2
+    project = models.Project.create(DummyLoader(labels=labels))
+    project_id, token = project.id, project.token
+    db_session.expire_all()
+    project = models.Project.get(token)
+    project.labels.init_on_load()
+
+    with query_counter() as counter:
+        assert project.get_max_label() == 2
+        assert project.labels.cell_info[0][1]['frames'] == [0, 1]
+    # The cells saved by Project.create are cached
+    assert not counter.selects
+
+    # Mock another worker deleting label 2
+    for table in (models.CellFrame.__table__, models.Cell.__table__):
+        models.db.session.execute(table.delete().where(table.c.label == 2))
+    models.db.session.query(models.Project).filter_by(id=project_id).update(
+        {'version': models.Project.version + 1})
+    db_session.expire_all()
+    project = models.Project.get(token)
+    project.labels.init_on_load()
+
+    assert project.get_max_label() == 1
+    assert 2 not in project.labels.cell_info[0]
+
+
+def test_labels_cache_writes_through_edits(db_session, query_counter):
+    labels = np.zeros((2, 2, 2, 1))
+    labels[:, 0, 0, 0] = 1
+    labels[0, 1, 1, 0] = 3
+    project = models.Project.create(DummyLoader(labels=labels))
+    token = project.token
+
+    project.labels.cell_info[0][1]['frames'] = [0]
+    project.labels.cell_info[0][2] = {'label': '2', 'frames': [1], 'slices': ''}
+    del project.labels.cell_info[0][3]
+    project.labels.cell_ids[0] = np.array([1, 2])
+    project.create_memento('replace')
+    project.update()
+    expected_info = dict(project.labels.cell_info[0])
+    db_session.expire_all()
+
+    project = models.Project.get(token)
+    project.labels.init_on_load()
+    with query_counter() as counter:
+        assert project.labels.cell_info[0] == expected_info
+        np.testing.assert_array_equal(project.labels.cell_ids[0], [1, 2])
+    assert not counter.selects
+    # The cached cells match the saved cells
+    models.project_cache.clear()
+    db_session.expire_all()
+    project = models.Project.get(token)
+    project.labels.init_on_load()
+    assert project.labels.cell_info[0] == expected_info
+
+
+def test_undo_redo_labels(db_session):
+    labels = np.zeros((2, 2, 2, 1))
+    labels[:, 0, 0, 0] = 1
+    project = models.Project.create(DummyLoader(labels=labels))
+    before = {k: dict(v) for k, v in project.labels.cell_info[0].items()}
+
+    # Mock replacing label 1 with label 2 in frame 1
+    project.labels.cell_info[0][1]['frames'] = [0]
+    project.labels.cell_info[0][2] = {'label': '2', 'frames': [1], 'slices': ''}
+    project.labels.cell_ids[0] = np.array([1, 2])
+    project.create_memento('replace')
+    project.update()
+    after = {k: dict(v) for k, v in project.labels.cell_info[0].items()}
+
+    project.undo()
+    db_session.expire_all()
+    project = models.Project.get(project.token)
+    assert project.labels.cell_info[0] == before
+    np.testing.assert_array_equal(project.labels.cell_ids[0], [1])
+
+    project.redo()
+    db_session.expire_all()
+    project = models.Project.get(project.token)
+    assert project.labels.cell_info[0] == after
+    np.testing.assert_array_equal(project.labels.cell_ids[0], [1, 2])
+
+
+def test_make_payload_track_changes(db_session):
+    labels = np.zeros((2, 2, 2, 1))
+    labels[:, 0, 0, 0] = 1
+    labels[0, 1, 1, 0] = 3
+    project = models.Project.create(DummyLoader(labels=labels))
+    version = project.version
+
+    # Mock replacing label 1 with label 2 in frame 1 and deleting label 3
+    project.labels.cell_info[0][1]['frames'] = [0]
+    project.labels.cell_info[0][2] = {'label': '2', 'frames': [1], 'slices': ''}
+    del project.labels.cell_info[0][3]
+    project.labels.cell_ids[0] = np.array([1, 2])
+
+    payload = project.make_payload(labels=True, known_version=version)
+    assert payload['tracks'] is False
+    assert payload['trackChanges'] == {0: {
+        1: {'label': '1', 'frames': [0], 'slices': '[0]'},
+        2: {'label': '2', 'frames': [1], 'slices': '[1]'},
+        3: None,
+    }}
+    # Front-ends that missed a change get all the tracks
+    payload = project.make_payload(known_version=version - 1)
+    assert payload['tracks'] == project.labels.readable_tracks
+    assert 'trackChanges' not in payload
+
+    project.create_memento('replace')
+    project.update()
+    assert project.version == version + 1
+    payload = project.undo(known_version=version + 1)
+    assert payload['version'] == version + 2
+    assert payload['trackChanges'][0][3] == {'label': '3', 'frames': [0], 'slices': '[0]'}
+    assert set(payload['trackChanges'][0]) == {1, 2, 3}
+
+
+def test_format_slices():
+    assert models.format_slices([]) == '[]'
+    assert models.format_slices([4]) == '[4]'
+    assert models.format_slices([0, 1, 2, 5, 7, 8]) == '[0-2, 5, 7-8]'
+
+
+def test_legacy_labels_migrated(db_session):
+    labels = np.zeros((2, 2, 2, 1))
+    labels[:, 0, 0, 0] = 1
+    project = models.Project.create(DummyLoader(labels=labels))
+    cell_ids = {0: np.array([1])}
+    cell_info = {0: {1: {'label': '1', 'frames': [0, 1], 'slices': ''}}}
+    # Mock labels saved before the cells tables existed
+    for table in (models.CellFrame.__table__, models.Cell.__table__):
+        models.db.session.execute(table.delete())
+    models.db.session.query(models.Labels).update(
+        {'legacy_cell_ids': cell_ids, 'legacy_cell_info': cell_info})
+    db_session.expire_all()
+
+    project = models.Project.get(project.token)
+    assert project.labels.cell_info == cell_info
+    project.create_memento('no_change')
+    project.update()
+    db_session.expire_all()
+
+    project = models.Project.get(project.token)
+    assert project.labels.legacy_cell_info is None
+    assert project.labels.cell_info == cell_info
+    assert models.Cell.query.filter_by(project_id=project.id).count() == 1
+
+
+def test_label_frame_version(db_session):
+    project = models.Project.create(DummyLoader(raw=np.zeros((2, 2, 2, 1))))
+    label_frame = project.get_label_frame(0)
+    assert label_frame.version == 0
+
+    label_frame.frame[0, 0] = 1
+    # Increased before the edit is committed, once for each commit
+    assert label_frame.version == 1
+    label_frame.frame[1, 1] = 1
+    assert label_frame.version == 1
+    project.create_memento('edit')
+    project.update()
+    project.undo()
+
+    assert project.get_label_frame(0).version == 2
+    assert project.get_label_frame(1).version == 0
+
+
+def test_render_cache(db_session):
+    labels = np.zeros((1, 4, 4, 1))
+    labels[0, :2] = 1
+    project = models.Project.create(DummyLoader(labels=labels))
+    models.render_cache.hits = models.render_cache.misses = 0
+
+    raw_png = project.get_raw_image(0, 0).getvalue()
+    label_png = project.get_label_image(0, 0).getvalue()
+    label_arr = project._get_label_arr()
+    assert project.get_raw_image(0, 0).getvalue() == raw_png
+    assert project.get_label_image(0, 0).getvalue() == label_png
+    assert project._get_label_arr() == label_arr
+    assert models.render_cache.hits == 3
+
+    # Edits render the labels again
+    project.label_frames[0].frame[:] = 0
+    project.create_memento('edit')
+    project.update()
+
+    assert project.get_label_image(0, 0).getvalue() != label_png
+    assert project._get_label_arr() != label_arr
+    assert models.render_cache.hits == 3
+
+
 def test_get_label_array():
     """
     Test outlined label arrays to send to the front-end.
@@ -296,7 +900,7 @@ def test_get_label_array():
     expected_frame = project.label_frames[project.frame].frame[..., project.channel]
 
     label_arr = project._get_label_arr()
-    label_frame = np.array(label_arr)
+    label_frame = decode_array(label_arr)
 
     assert label_frame.shape == (project.height, project.width)
     np.testing.assert_array_equal(label_frame[label_frame >= 0],
@@ -305,6 +909,139 @@ def test_get_label_array():
                                   -expected_frame[label_frame < 0])
 
 
+def test_outlines_updated_in_edited_region(db_session, mocker):
+    labels = np.zeros((1, 8, 8, 1))
+    labels[0, 1:4, 1:4] = 1
+    project = models.Project.create(DummyLoader(labels=labels))
+    project._get_label_arr()
+    outline_frame = mocker.spy(models, 'add_outlines')
+    outline_region = mocker.spy(imgutils, 'add_outlines')
+
+    project.label_frames[0].frame[5:7, 5:7] = 2
+    outlined = project.get_outlined_frame(0, 0)
+
+    # Only the changed region and the pixels around it are outlined again
+    outline_frame.assert_not_called()
+    assert outline_region.call_count == 1
+    assert outline_region.call_args[0][0].shape == (5, 5)
+    np.testing.assert_array_equal(
+        outlined, imgutils.add_outlines(project.label_frames[0].frame[..., 0]))
+
+    # The outlines of the committed frame are kept for the next edit
+    project.create_memento('edit')
+    project.update()
+    project.label_frames[0].frame[1:4, 1:4] = 0
+    outlined = project.get_outlined_frame(0, 0)
+    outline_frame.assert_not_called()
+    np.testing.assert_array_equal(
+        outlined, imgutils.add_outlines(project.label_frames[0].frame[..., 0]))
+    project.create_memento('edit')
+    project.update()
+
+
+def test_make_payload_label_tiles(db_session, mocker):
+    mocker.patch('models.LABEL_TILE_SIZE', 4)
+    labels = np.zeros((1, 16, 16, 1))
+    labels[0, 1:4, 1:4] = 1
+    labels[0, 9:12, 9:12] = 2
+    project = models.Project.create(DummyLoader(labels=labels))
+
+    project.label_frames[0].frame[5:6, 5:8] = 1
+    payload = project.make_payload(y=True, max_label=2)
+
+    assert 'seg_arr' not in payload['imgs']
+    tiles = payload['imgs']['tiles']
+    assert tiles['size'] == 4
+    assert tiles['segmented'] == project._get_label_url()
+    # The changed pixels and the outlines around them are in two tiles
+    assert [(tile['y'], tile['x']) for tile in tiles['tiles']] == [(4, 4), (4, 8)]
+    outlined = imgutils.add_outlines(project.label_frames[0].frame[..., 0])
+    for tile in tiles['tiles']:
+        y, x = tile['y'], tile['x']
+        np.testing.assert_array_equal(decode_array(tile['arr']), outlined[y:y + 4, x:x + 4])
+        png = base64.b64decode(tile['png'])
+        expected = pngify(np.ma.masked_equal(project.label_frames[0].frame[y:y + 4, x:x + 4, 0], 0),
+                          vmin=0, vmax=2, cmap='viridis')
+        assert png == expected.getvalue()
+
+    # Labels are colored again when the highest label changes
+    payload = project.make_payload(y=True, max_label=1)
+    assert 'tiles' not in payload['imgs']
+    assert 'seg_arr' in payload['imgs']
+
+
+def test_get_tile_grid(mocker):
+    mocker.patch('models.PYRAMID_TILE_SIZE', 4)
+    project = models.Project.create(DummyLoader(raw=np.zeros((1, 9, 17, 1))))
+
+    assert project.count_pyramid_levels() == 4
+    assert project.get_tile_grid(0) == (3, 5)
+    assert project.get_tile_grid(1) == (2, 3)
+    assert project.get_tile_grid(3) == (1, 1)
+    assert project.get_tile_grid(4) is None
+
+
+def test_get_tile_image(mocker):
+    mocker.patch('models.PYRAMID_TILE_SIZE', 4)
+    raw = np.arange(64, dtype='uint16').reshape((1, 8, 8, 1))
+    labels = np.zeros((1, 8, 8, 1))
+    labels[0, 4:, 4:] = 3
+    project = models.Project.create(DummyLoader(raw=raw, labels=labels))
+
+    # Raw tiles are colored on the scale of the whole frame
+    tile = project.get_tile_image('raw', 0, 0, 0, 1, 0)
+    assert tile.getvalue() == pngify(raw[0, 4:, :4, 0], vmin=0, vmax=63,
+                                     cmap='cubehelix').getvalue()
+    tile = project.get_tile_image('raw', 0, 0, 1, 0, 0)
+    downsampled = imgutils.downsample(raw[0, ..., 0])
+    assert tile.getvalue() == pngify(downsampled, vmin=0, vmax=63,
+                                     cmap='cubehelix').getvalue()
+
+    tile = project.get_tile_image('labels', 0, 0, 1, 0, 0)
+    expected = pngify(np.ma.masked_equal(labels[0, ::2, ::2, 0], 0), vmin=0, vmax=3,
+                      cmap='viridis')
+    assert tile.getvalue() == expected.getvalue()
+
+
+def test_label_tiles_follow_edits(db_session, mocker):
+    mocker.patch('models.PYRAMID_TILE_SIZE', 4)
+    labels = np.zeros((1, 8, 8, 1))
+    labels[0, :2, :2] = 1
+    project = models.Project.create(DummyLoader(labels=labels))
+    before = project.get_tile_image('labels', 0, 0, 1, 0, 0).getvalue()
+
+    project.create_memento('test')
+    project.label_frames[0].frame[4:6, 4:6] = 1
+    project.update()
+
+    level = project.get_pyramid_level('labels', 0, 0, 1)
+    np.testing.assert_array_equal(level, project.label_frames[0].frame[::2, ::2, 0])
+    assert project.get_tile_image('labels', 0, 0, 1, 0, 0).getvalue() != before
+
+
+def test_get_viewport_tiles(mocker):
+    mocker.patch('models.PYRAMID_TILE_SIZE', 4)
+    project = models.Project.create(DummyLoader(raw=np.zeros((1, 16, 16, 1))))
+    token = project.token
+
+    viewport = project.get_viewport_tiles(0, x=5, y=0, width=4, height=3, scale=1)
+    assert viewport['level'] == 0
+    assert viewport['size'] == 4
+    assert [(tile['row'], tile['col']) for tile in viewport['tiles']] == [(0, 1), (0, 2)]
+    assert viewport['tiles'][1]['x'] == 8
+    assert viewport['tiles'][1]['raw'] == f'/api/tiles/{token}/raw/0/0/0/0/2.png'
+    assert viewport['tiles'][1]['segmented'].startswith(f'/api/tiles/{token}/labels/0/0/0/0/2.png')
+
+    # Zooming out uses a coarser level, up to the level with a single tile
+    viewport = project.get_viewport_tiles(0, x=0, y=0, width=16, height=16, scale=0.3)
+    assert viewport['level'] == 1
+    assert viewport['size'] == 8
+    assert len(viewport['tiles']) == 4
+    viewport = project.get_viewport_tiles(0, x=0, y=0, width=16, height=16, scale=0.01)
+    assert viewport['level'] == 2
+    assert len(viewport['tiles']) == 1
+
+
 def test_get_label_png():
     """
     Test label frame PNGs to send to the front-end.
@@ -316,7 +1053,7 @@ def test_get_label_png():
     expected_png = pngify(expected_frame,
                           vmin=0,
                           vmax=project.get_max_label(),
-                          cmap=project.colormap)
+                          cmap='viridis')
 
     label_png = project._get_label_png()
 
@@ -344,7 +1081,8 @@ def test_get_raw_png_rgb():
     project.rgb = True
     project.update()
 
-    expected_frame = project.rgb_frames[project.frame].frame
+    raw_frame = project.raw_frames[project.frame].frame
+    expected_frame = models.RGBFrame(project.frame, raw_frame).frame
     expected_png = pngify(expected_frame, vmin=None, vmax=None, cmap=None)
 
     raw_png = project._get_raw_png()
@@ -352,6 +1090,36 @@ def test_get_raw_png_rgb():
     assert raw_png.getvalue() == expected_png.getvalue()
 
 
+def test_rgb_frames_created_on_demand(db_session):
+    project = models.Project.create(DummyLoader(raw=np.ones((3, 4, 4, 2))))
+    assert project.rgb_frames == []
+    version = project.version
+
+    rgb_frame = project.get_rgb_frame(1)
+    project.update()
+
+    assert rgb_frame.frame.shape == (4, 4, 3)
+    db_session.expire_all()
+    assert [frame.frame_id for frame in project.rgb_frames] == [1]
+    assert project.get_rgb_frame(1) is rgb_frame
+    # Creating RGB frames does not change the project
+    assert project.version == version
+
+
+def test_commit_rgb_frames_saved_by_another_request(db_session):
+    project = models.Project.create(DummyLoader(raw=np.ones((2, 4, 4, 2))))
+    project_id = project.id
+    rgb_frame = project.get_rgb_frame(1)
+    # Mock another request saving the same RGB frame first
+    models.db.session.execute(models.RGBFrame.__table__.insert().values(
+        project_id=project_id, frame_id=1,
+        frame=models.NdarrayType().process_bind_param(rgb_frame.frame, None)))
+
+    project.commit_rgb_frames()
+
+    assert models.Project.query.get(project_id) is not None
+
+
 def test_get_max_label_all_zeroes():
     labels = np.zeros((1, 1, 1, 1))
     project = models.Project.create(DummyLoader(labels=labels))
@@ -419,13 +1187,41 @@ def test_rgb_frame_init():
     """Test constructing the RGB frames for a project."""
     project = models.Project.create(DummyLoader())
 
-    rgb_frames = project.rgb_frames
+    rgb_frames = [project.get_rgb_frame(i) for i in range(project.num_frames)]
     for frame in rgb_frames:
         assert frame.frame.ndim == 3  # Height, width, features
         assert frame.frame_id is not None
         assert frame.frame.shape[2] == 3  # RGB channels
 
 
+def test_reduce_to_rgb_mixes_channels():
+    raw = np.arange(100, dtype='uint16').reshape((10, 10, 1)) * np.ones(6, dtype='uint16')
+    rgb_frame = models.RGBFrame(0, raw)
+
+    rescaled = rgb_frame.rescale_raw(raw)[..., 0].astype('uint16')
+    # Each RGB channel adds its own channel and two of the CMY channels
+    expected = np.minimum(3 * rescaled, 255)
+    for channel in range(3):
+        np.testing.assert_array_equal(rgb_frame.frame[..., channel], expected)
+
+
+def test_rgb_frames_stack_percentiles(mocker):
+    frame = np.random.RandomState(0).randint(1, 100, size=(8, 8, 3)).astype('uint16')
+    # The second frame is twice as bright as the first
+    raw = np.stack([frame, 2 * frame])
+
+    project = models.Project.create(DummyLoader(raw=raw))
+    assert project.rgb_percentiles is None
+    rgb_frames = [project.get_rgb_frame(i).frame for i in range(2)]
+    np.testing.assert_array_equal(rgb_frames[0], rgb_frames[1])
+
+    mocker.patch('models.RGB_PERCENTILES', 'stack')
+    project = models.Project.create(DummyLoader(raw=raw))
+    assert project.rgb_percentiles.shape == (3, 2)
+    rgb_frames = [project.get_rgb_frame(i).frame for i in range(2)]
+    assert rgb_frames[0].mean() < rgb_frames[1].mean()
+
+
 def test_label_frame_init():
     """Test constructing the label frames for a project."""
     project = models.Project.create(DummyLoader())
@@ -442,7 +1238,7 @@ def test_frames_init():
 
     raw_frames = project.raw_frames
     label_frames = project.label_frames
-    rgb_frames = project.rgb_frames
+    rgb_frames = [project.get_rgb_frame(i) for i in range(project.num_frames)]
     assert len(raw_frames) == len(label_frames)
     assert len(raw_frames) == len(rgb_frames)
     for raw_frame, label_frame, rgb_frame in zip(raw_frames, label_frames, rgb_frames):
@@ -0,0 +1,159 @@
+"""Maps per-frame work over stacks of frames with an optional pool of threads or processes."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import os
+import tempfile
+import timeit
+
+import numpy as np
+
+from config import FRAME_WORKERS, FRAME_POOL, FRAME_POOL_MIN_SIZE
+
+
+POOLS = ('thread', 'process')
+
+# Directory for the memory-mapped stacks read by processes; a RAM-backed filesystem when available
+SHARED_MEMORY_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+def get_chunks(num_frames, workers, max_frames=None):
+    """
+    Splits the frames into a few contiguous chunks for each worker,
+    so each task is large enough to outweigh handing it to a worker.
+
+    Args:
+        num_frames (int): number of frames to split
+        workers (int): number of workers in the pool
+        max_frames (int): most frames in each chunk; defaults to no limit
+
+    Returns:
+        list: (start, stop) of each chunk
+    """
+    num_chunks = min(num_frames, 4 * workers)
+    if max_frames is not None:
+        num_chunks = max(num_chunks, -(-num_frames // max_frames))
+    bounds = np.linspace(0, num_frames, num_chunks + 1).astype(int)
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+def map_chunk(func, stack, start, stop):
+    """
+    Args:
+        func (callable): function of a single frame
+        stack (np.array): frames along the first axis, or the path of a .npy file with them
+        start (int): index of the first frame of the chunk
+        stop (int): index after the last frame of the chunk
+
+    Returns:
+        list: results of func for each frame in the chunk
+    """
+    if isinstance(stack, str):
+        # Memory-mapped, so each process reads only its own frames
+        stack = np.load(stack, mmap_mode='r')
+    return [func(np.asarray(stack[i])) for i in range(start, stop)]
+
+
+def timed(func, frame):
+    """
+    Calls func on a frame and measures how long it took,
+    as the time spent waiting for results from a pool does not show the work of each worker.
+
+    Args:
+        func (callable): function of a single frame
+        frame (np.array): frame to call func on
+
+    Returns:
+        tuple: result of func and the seconds it took
+    """
+    start = timeit.default_timer()
+    return func(frame), timeit.default_timer() - start
+
+
+def map_chunks(executor, func, stack, chunks, max_pending=None):
+    """
+    Submits the chunks to a pool, at most max_pending frames ahead of the results yielded.
+
+    Args:
+        executor (Executor): pool of workers
+        func (callable): function of a single frame
+        stack (np.array): frames along the first axis, or the path of a .npy file with them
+        chunks (list): (start, stop) of each chunk
+        max_pending (int): most frames submitted before their results are yielded;
+                           defaults to no limit
+
+    Yields:
+        result of func for each frame, in order
+    """
+    pending = collections.deque()
+    pending_frames = 0
+    for start, stop in chunks:
+        # Wait for the earliest chunks until the next chunk fits
+        while pending and max_pending is not None and pending_frames + stop - start > max_pending:
+            future, size = pending.popleft()
+            pending_frames -= size
+            yield from future.result()
+        pending.append((executor.submit(map_chunk, func, stack, start, stop), stop - start))
+        pending_frames += stop - start
+    while pending:
+        future, _ = pending.popleft()
+        yield from future.result()
+
+
+def map_frames(func, stack, workers=None, pool=None, min_size=None, max_pending=None):
+    """
+    Calls func on each frame of a stack, with a pool of workers for large stacks.
+    Processes read the frames from a memory-mapped copy of the stack
+    instead of receiving them with each task.
+    Set max_pending to bound the results held in memory when they are consumed
+    more slowly than they are made, like frames inserted into the database in batches.
+
+    Args:
+        func (callable): function of a single frame;
+                         must be picklable (e.g. a module function) for process pools
+        stack (np.array): frames along the first axis
+        workers (int): number of threads or processes; defaults to FRAME_WORKERS
+        pool (str): 'thread' or 'process'; defaults to FRAME_POOL
+        min_size (int): stacks smaller than this many MB are processed serially,
+                        as starting the pool would take longer; defaults to FRAME_POOL_MIN_SIZE
+        max_pending (int): most frames handed to the pool before their results are yielded;
+                           defaults to no limit
+
+    Yields:
+        result of func for each frame, in order
+
+    Raises:
+        ValueError: if pool is not 'thread' or 'process'
+    """
+    workers = FRAME_WORKERS if workers is None else workers
+    pool = FRAME_POOL if pool is None else pool
+    min_size = FRAME_POOL_MIN_SIZE if min_size is None else min_size
+    if pool not in POOLS:
+        raise ValueError('Invalid pool "{}", choose from {}'.format(pool, POOLS))
+
+    if workers <= 1 or len(stack) <= 1 or stack.nbytes < min_size * 1024 ** 2:
+        for frame in stack:
+            yield func(frame)
+        return
+
+    # Keep a chunk for each worker within the pending frames
+    max_frames = None if max_pending is None else max(max_pending // workers, 1)
+    chunks = get_chunks(len(stack), workers, max_frames)
+    if pool == 'thread':
+        # Threads share the stack, and numpy and zlib release the GIL for most of the work
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            yield from map_chunks(executor, func, stack, chunks, max_pending)
+        return
+
+    with tempfile.TemporaryDirectory(dir=SHARED_MEMORY_DIR) as directory:
+        path = os.path.join(directory, 'stack.npy')
+        # Copy into the mapped file directly, as np.save writes strided views slowly
+        shared = np.lib.format.open_memmap(path, mode='w+', dtype=stack.dtype, shape=stack.shape)
+        shared[...] = stack
+        shared.flush()
+        del shared
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield from map_chunks(executor, func, path, chunks, max_pending)
@@ -0,0 +1,115 @@
+"""Tests for parallel.py"""
+
+import numpy as np
+import pytest
+
+import labelmaker
+import models
+import parallel
+from conftest import DummyLoader
+
+
+@pytest.mark.parametrize('num_frames,workers,max_frames,expected', [
+    (10, 1, None, [(0, 2), (2, 5), (5, 7), (7, 10)]),
+    (3, 4, None, [(0, 1), (1, 2), (2, 3)]),
+    (10, 1, 2, [(0, 2), (2, 4), (4, 6), (6, 8), (8, 10)]),
+])
+def test_get_chunks(num_frames, workers, max_frames, expected):
+    assert parallel.get_chunks(num_frames, workers, max_frames) == expected
+
+
+@pytest.mark.parametrize('pool', ['thread', 'process'])
+def test_map_frames(pool):
+    stack = np.arange(5 * 3 * 2).reshape((5, 3, 2))
+    expected = [np.count_nonzero(frame) for frame in stack]
+
+    results = parallel.map_frames(np.count_nonzero, stack, workers=2, pool=pool, min_size=0)
+
+    assert list(results) == expected
+
+
+@pytest.mark.parametrize('pool', ['thread', 'process'])
+def test_map_frames_max_pending(pool):
+    stack = np.arange(20 * 2).reshape((20, 2))
+
+    results = parallel.map_frames(np.sum, stack, workers=2, pool=pool, min_size=0, max_pending=4)
+
+    assert list(results) == [frame.sum() for frame in stack]
+
+
+def test_map_frames_bounds_pending_frames():
+    stack = np.arange(20 * 2).reshape((20, 2))
+    calls = []
+
+    def record(frame):
+        calls.append(frame)
+        return frame.sum()
+
+    results = parallel.map_frames(record, stack, workers=2, pool='thread', min_size=0,
+                                  max_pending=4)
+
+    for i, result in enumerate(results):
+        assert result == stack[i].sum()
+        # Frames are not handed to the pool far ahead of the frames consumed
+        assert len(calls) <= i + 4
+
+
+def test_timed():
+    result, seconds = parallel.timed(np.sum, np.ones((2, 2)))
+
+    assert result == 4
+    assert seconds >= 0
+
+
+def test_map_frames_small_stack_is_serial(mocker):
+    executor = mocker.patch('parallel.ThreadPoolExecutor')
+    stack = np.ones((4, 2, 2))
+
+    results = parallel.map_frames(np.sum, stack, workers=4, pool='thread', min_size=1)
+
+    assert list(results) == [4, 4, 4, 4]
+    executor.assert_not_called()
+
+
+def test_map_frames_invalid_pool():
+    with pytest.raises(ValueError):
+        list(parallel.map_frames(np.sum, np.ones((4, 2, 2)), workers=2, pool='gpu', min_size=0))
+
+
+@pytest.mark.parametrize('pool', ['thread', 'process'])
+def test_parallel_label_info(mocker, pool):
+    mocker.patch('parallel.FRAME_WORKERS', 2)
+    mocker.patch('parallel.FRAME_POOL', pool)
+    mocker.patch('parallel.FRAME_POOL_MIN_SIZE', 0)
+    labels = np.zeros((4, 3, 3, 1), dtype='int32')
+    labels[0, 0, 0] = 2
+    labels[[1, 3], 1, 1] = 5
+    labels[3, 2, 2] = 2
+
+    labeler = labelmaker.LabelInfoMaker(labels, tracking=True)
+
+    np.testing.assert_array_equal(labeler.cell_ids[0], [2, 5])
+    assert labeler.cell_info[0][2]['frames'] == [0, 3]
+    assert labeler.cell_info[0][5]['frames'] == [1, 3]
+
+
+def test_parallel_create_project(mocker, db_session):
+    db_session.autoflush = False
+    mocker.patch('parallel.FRAME_WORKERS', 2)
+    mocker.patch('parallel.FRAME_POOL_MIN_SIZE', 0)
+    raw = np.random.randint(0, 100, size=(5, 4, 4, 1))
+    labels = np.random.randint(0, 3, size=(5, 4, 4, 1))
+
+    project = models.Project.create(DummyLoader(raw=raw, labels=labels))
+
+    np.testing.assert_array_equal(project.raw_array, raw)
+    np.testing.assert_array_equal(project.label_array, labels)
+
+
+def test_parallel_percentiles(mocker):
+    mocker.patch('parallel.FRAME_WORKERS', 2)
+    mocker.patch('parallel.FRAME_POOL_MIN_SIZE', 0)
+    raw = np.random.randint(0, 100, size=(5, 4, 4, 3))
+    expected = [np.percentile(raw[..., c][raw[..., c] > 0], [5, 95]) for c in range(3)]
+
+    np.testing.assert_allclose(models.RGBFrame.get_percentiles(raw), expected)
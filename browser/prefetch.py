@@ -0,0 +1,95 @@
+"""Renders the frames near the displayed frame in the background."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import timeit
+
+from flask import current_app
+
+from config import PREFETCH_WORKERS
+from imgutils import BROWSER_FORMATS
+from models import Project
+
+
+logger = logging.getLogger('prefetch')  # pylint: disable=C0103
+
+executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)  # pylint: disable=C0103
+
+# Renderings queued or in progress, so scrubbing back and forth does not queue them again
+_pending = set()  # pylint: disable=C0103
+_pending_lock = threading.Lock()  # pylint: disable=C0103
+
+
+def get_prefetch_frames(frame, num_frames, distance):
+    """
+    Args:
+        frame (int): index of the displayed frame
+        num_frames (int): number of frames in the project
+        distance (int): number of frames to prefetch before and after the displayed frame
+
+    Returns:
+        list: indices of the frames to prefetch, nearest frames first
+    """
+    frames = [f for offset in range(1, distance + 1)
+              for f in (frame + offset, frame - offset)]
+    return [f for f in frames if 0 <= f < num_frames]
+
+
+def prefetch_frames(project):
+    """
+    Queues rendering the frames near the displayed frame of a project
+    into the render cache, so changing to them is served from memory.
+    Uses the displayed channel, feature, and RGB setting,
+    and the first format in IMAGE_FORMATS that browsers can show.
+
+    Args:
+        project (Project): project whose frames to prefetch; its changes must be committed
+    """
+    distance = current_app.config['PREFETCH_FRAMES']
+    if distance <= 0:
+        return
+    frame_ids = get_prefetch_frames(project.frame, project.num_frames, distance)
+    image_format = next((image_format for image_format in current_app.config['IMAGE_FORMATS']
+                         if image_format in BROWSER_FORMATS), 'png')
+    display = (project.channel, project.feature, project.rgb, image_format)
+    with _pending_lock:
+        keys = [(project.token, frame_id) + display for frame_id in frame_ids]
+        keys = [key for key in keys if key not in _pending]
+        _pending.update(keys)
+    if keys:
+        app = current_app._get_current_object()  # pylint: disable=W0212
+        executor.submit(render_frames, app, keys)
+
+
+def render_frames(app, keys):
+    """
+    Renders frames into the render cache in a new session.
+    Nothing is saved to the database, including RGB frames created to render them.
+
+    Args:
+        app (Flask): application to get a database session from
+        keys (list): (token, frame, channel, feature, rgb, image_format) of each frame to render
+    """
+    start = timeit.default_timer()
+    with app.app_context():
+        try:
+            project = Project.get(keys[0][0])
+            for _, frame_id, channel, feature, rgb, image_format in keys:
+                if project is None:
+                    break
+                if rgb:
+                    project.get_rgb_image(frame_id, image_format)
+                else:
+                    project.get_raw_image(frame_id, channel, image_format)
+                project.get_label_image(frame_id, feature, image_format)
+                project.get_label_arr(frame_id, feature)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Failed to prefetch frames %s.', keys)
+        finally:
+            with _pending_lock:
+                _pending.difference_update(keys)
+    logger.debug('Prefetched %s frames in %ss.', len(keys), timeit.default_timer() - start)
@@ -0,0 +1,53 @@
+"""Tests for prefetch.py"""
+
+import numpy as np
+import pytest
+
+import models
+import prefetch
+from conftest import DummyLoader
+
+
+@pytest.fixture(autouse=True)
+def enable_transactional_tests(db_session):
+    db_session.autoflush = False
+
+
+@pytest.mark.parametrize('frame,num_frames,distance,expected', [
+    (5, 10, 2, [6, 4, 7, 3]),
+    (0, 10, 2, [1, 2]),
+    (9, 10, 1, [8]),
+    (0, 1, 3, []),
+])
+def test_get_prefetch_frames(frame, num_frames, distance, expected):
+    assert prefetch.get_prefetch_frames(frame, num_frames, distance) == expected
+
+
+def test_prefetch_frames(app, mocker):
+    project = models.Project.create(DummyLoader(raw=np.zeros((3, 2, 2, 1))))
+    submit = mocker.patch('prefetch.executor.submit')
+    mocker.patch.dict(app.config, {'PREFETCH_FRAMES': 1})
+
+    prefetch.prefetch_frames(project)
+    # Frames already queued are not queued again
+    prefetch.prefetch_frames(project)
+
+    submit.assert_called_once_with(prefetch.render_frames, app,
+                                   [(project.token, 1, 0, 0, False, 'png')])
+    prefetch._pending.clear()
+
+
+def test_render_frames(app):
+    project = models.Project.create(DummyLoader(raw=np.zeros((3, 2, 2, 1))))
+    keys = [(project.token, frame_id, 0, 0, False, 'png') for frame_id in (1, 2)]
+    prefetch._pending.update(keys)
+
+    prefetch.render_frames(app, keys)
+
+    assert ('raw', project.id, 2, 0, 'png') in models.render_cache
+    assert ('outlines', project.id, 2, 0, 0) in models.render_cache
+    hits = models.render_cache.hits
+    project.get_raw_image(1, 0)
+    project.get_label_image(1, 0)
+    assert models.render_cache.hits == hits + 2
+    assert not prefetch._pending
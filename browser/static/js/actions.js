@@ -165,7 +165,7 @@ class BackendAction extends Action {
     $.ajax({
       type: 'POST',
       url: `${document.location.origin}/api/edit/${project_id}/${this.action}`,
-      data: this.info,
+      data: Object.assign({ version: projectVersion }, this.info),
       async: false
     }).done(handlePayload);
   }
@@ -174,6 +174,7 @@ class BackendAction extends Action {
     $.ajax({
       type: 'POST',
       url: `${document.location.origin}/api/undo/${project_id}`,
+      data: { version: projectVersion },
       async: false
     }).done(handlePayload);
   }
@@ -182,6 +183,7 @@ class BackendAction extends Action {
     $.ajax({
       type: 'POST',
       url: `${document.location.origin}/api/redo/${project_id}`,
+      data: { version: projectVersion },
       async: false
     }).done(handlePayload);
   }
@@ -274,3 +274,195 @@ class Zoom extends Action {
     this.canvas.sWidth = newWidth;
   }
 }
+
+/**
+ * Decodes a label array run-length encoded by the server.
+ * Returns one typed array for each row so labels are indexed with segArray[y][x].
+ */
+function decodeSegArray(encoded) {
+  const toBuffer = (base64) => {
+    const bytes = atob(base64);
+    const buffer = new Uint8Array(bytes.length);
+    for (let i = 0; i < bytes.length; i += 1) {
+      buffer[i] = bytes.charCodeAt(i);
+    }
+    return buffer.buffer;
+  };
+  const ValueArray = encoded.dtype === 'int16' ? Int16Array : Int32Array;
+  const values = new ValueArray(toBuffer(encoded.values));
+  const lengths = new Uint32Array(toBuffer(encoded.lengths));
+  const [height, width] = encoded.shape;
+
+  const flat = new Int32Array(height * width);
+  let start = 0;
+  for (let i = 0; i < values.length; i += 1) {
+    flat.fill(values[i], start, start + lengths[i]);
+    start += lengths[i];
+  }
+  const rows = [];
+  for (let y = 0; y < height; y += 1) {
+    rows.push(flat.subarray(y * width, (y + 1) * width));
+  }
+  return rows;
+}
+
+/**
+ * Updates the label image and label array with the tiles changed by an edit.
+ * Patches segArray in place, then draws the tile images over the label image
+ * and replaces it, so the onload handler of the label image renders the changes.
+ * Returns whether the label image will load again.
+ */
+function applyLabelTiles(segImage, segArray, tiles) {
+  if (tiles.tiles.length === 0) {
+    return false;
+  }
+  for (const tile of tiles.tiles) {
+    const rows = decodeSegArray(tile.arr);
+    for (let y = 0; y < rows.length; y += 1) {
+      segArray[tile.y + y].set(rows[y], tile.x);
+    }
+  }
+  // Load the whole label image if there is no image to draw the tiles on
+  if (!segImage.complete || segImage.naturalWidth === 0) {
+    segImage.src = tiles.segmented;
+    return true;
+  }
+  const tileCanvas = document.createElement('canvas');
+  tileCanvas.width = segImage.naturalWidth;
+  tileCanvas.height = segImage.naturalHeight;
+  const ctx = tileCanvas.getContext('2d');
+  ctx.drawImage(segImage, 0, 0);
+  let remaining = tiles.tiles.length;
+  for (const tile of tiles.tiles) {
+    const tileImage = new Image();
+    tileImage.onload = () => {
+      ctx.clearRect(tile.x, tile.y, tileImage.width, tileImage.height);
+      ctx.drawImage(tileImage, tile.x, tile.y);
+      remaining -= 1;
+      if (remaining === 0) {
+        segImage.src = tileCanvas.toDataURL();
+      }
+    };
+    tileImage.src = `data:image/png;base64,${tile.png}`;
+  }
+  return true;
+}
+
+/**
+ * Loads the raw and label images of a frame from the tiles of the image pyramid
+ * that cover the viewport, so frames larger than the canvas are not loaded whole.
+ * Tiles come from the coarsest pyramid level with a pixel for each screen pixel,
+ * and are drawn at their full resolution position and size onto copies of the images,
+ * so the images are rendered as if they were loaded whole.
+ */
+class TileLoader {
+  constructor(width, height, onImage) {
+    this.width = width;
+    this.height = height;
+    // called before the source of an image changes
+    this.onImage = onImage;
+    // URLs of the tiles drawn on each image
+    this.drawn = new Map();
+    // increases with each viewport, so tiles of older viewports are not shown
+    this.request = 0;
+  }
+
+  /**
+   * Forgets the tiles drawn on an image, so it is drawn again from blank
+   * with the tiles of the next viewport, like after changing the frame.
+   */
+  reset(image) {
+    this.drawn.set(image, new Set());
+  }
+
+  /**
+   * Lists the tiles of a viewport and draws the tiles not drawn yet onto the images.
+   * The viewport is in full resolution pixels, and the scale is the number of
+   * screen pixels for each full resolution pixel.
+   */
+  load(url, x, y, width, height, scale, rawImage, segImage) {
+    this.request += 1;
+    const request = this.request;
+    const params = $.param({
+      x: Math.floor(x),
+      y: Math.floor(y),
+      width: Math.ceil(width),
+      height: Math.ceil(height),
+      scale: scale,
+    });
+    $.getJSON(`${document.location.origin}${url}?${params}`).done((viewport) => {
+      if (request !== this.request) {
+        return;
+      }
+      // full resolution pixels for each pixel of the tiles
+      const span = 2 ** viewport.level;
+      const rawTiles = viewport.tiles.map((tile) => ({ x: tile.x, y: tile.y, url: tile.raw }));
+      const segTiles = viewport.tiles.map((tile) => ({ x: tile.x, y: tile.y, url: tile.segmented }));
+      this.drawTiles(rawImage, rawTiles, span, request);
+      this.drawTiles(segImage, segTiles, span, request);
+    });
+  }
+
+  drawTiles(image, tiles, span, request) {
+    if (!this.drawn.has(image)) {
+      this.reset(image);
+    }
+    const drawn = this.drawn.get(image);
+    const newTiles = tiles.filter((tile) => !drawn.has(tile.url));
+    if (newTiles.length === 0) {
+      return;
+    }
+    const tileCanvas = document.createElement('canvas');
+    tileCanvas.width = this.width;
+    tileCanvas.height = this.height;
+    const ctx = tileCanvas.getContext('2d');
+    // keep label colors exact when drawing tiles of coarser levels
+    ctx.imageSmoothingEnabled = false;
+    if (drawn.size > 0 && image.complete && image.naturalWidth > 0) {
+      ctx.drawImage(image, 0, 0);
+    }
+    let remaining = newTiles.length;
+    const loaded = [];
+    const finish = () => {
+      remaining -= 1;
+      // a newer viewport draws its tiles over the image instead
+      if (remaining > 0 || request !== this.request || this.drawn.get(image) !== drawn) {
+        return;
+      }
+      for (const url of loaded) {
+        drawn.add(url);
+      }
+      this.onImage(image);
+      image.src = tileCanvas.toDataURL();
+    };
+    for (const tile of newTiles) {
+      const tileImage = new Image();
+      tileImage.onload = () => {
+        const width = tileImage.width * span;
+        const height = tileImage.height * span;
+        ctx.clearRect(tile.x, tile.y, width, height);
+        ctx.drawImage(tileImage, tile.x, tile.y, width, height);
+        loaded.push(tile.url);
+        finish();
+      };
+      tileImage.onerror = finish;
+      tileImage.src = tile.url;
+    }
+  }
+}
+
+/**
+ * Updates the tracks of each feature with the tracks changed by an action.
+ * Deleted labels have a null track.
+ */
+function applyTrackChanges(tracks, changes) {
+  for (const [feature, featureChanges] of Object.entries(changes)) {
+    for (const [label, track] of Object.entries(featureChanges)) {
+      if (track === null) {
+        delete tracks[feature][label];
+      } else {
+        tracks[feature][label] = track;
+      }
+    }
+  }
+}
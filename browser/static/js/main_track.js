@@ -444,12 +444,16 @@ var current_highlight = true;
 var numFrames = undefined;
 var dimensions = undefined;
 var tracks = undefined;
+// project version of the tracks, sent with each action to receive only the changed tracks
+var projectVersion;
 var maxTrack;
 var mode = new Mode(Modes.none, {});
 var raw_image = new Image();
 var seg_image = new Image();
 var seg_array;
 var scale;
+// loads the images from the tiles of the frame when it is larger than the canvas
+var tileLoader = null;
 var mouse_x = 0;
 var mouse_y = 0;
 const padding = 5;
@@ -687,18 +691,45 @@ function render_image_display() {
   render_info_display();
 }
 
+/**
+ * Loads the raw and label images of a payload,
+ * from the tiles of the pyramid level shown on the canvas when the frame is larger than it.
+ */
+function load_images(imgs) {
+  const has_raw = imgs.hasOwnProperty('raw');
+  const has_seg = imgs.hasOwnProperty('segmented');
+  if (tileLoader !== null) {
+    if (has_raw) {
+      tileLoader.reset(raw_image);
+    }
+    if (has_seg) {
+      tileLoader.reset(seg_image);
+    }
+    if (has_raw || has_seg) {
+      tileLoader.load(imgs.viewport, 0, 0, tileLoader.width, tileLoader.height, scale,
+                      raw_image, seg_image);
+    }
+    return;
+  }
+  if (has_seg) {
+    seg_image.src = imgs.segmented;
+  }
+  if (has_raw) {
+    raw_image.src = imgs.raw;
+  }
+}
+
 function fetch_and_render_frame() {
   $.ajax({
     type: 'POST',
     url: `${document.location.origin}/api/changedisplay/${project_id}/frame/${current_frame}`,
     success: function(payload) {
       // load new value of seg_array
-      // array of arrays, contains annotation data for frame
-      seg_array = payload.imgs.seg_arr;
-      seg_image.src = payload.imgs.segmented;
+      // run-length encoded annotation data for frame, decoded to an array of rows
+      seg_array = decodeSegArray(payload.imgs.seg_arr);
       seg_image.onload = render_image_display;
-      raw_image.src = payload.imgs.raw;
       raw_image.onload = render_image_display;
+      load_images(payload.imgs);
 
       // actions must start and end on the same frame
       if (mode.action !== '') { mode.clear() };
@@ -721,6 +752,7 @@ function handlePayload(payload) {
   scale = payload.screen_scale;
   dimensions = [scale * payload.dimensions[0], scale * payload.dimensions[1]];
   tracks = payload.tracks[0];
+  projectVersion = payload.version;
 
   maxTrack = Math.max(... Object.keys(tracks).map(Number));
 
@@ -728,11 +760,14 @@ function handlePayload(payload) {
   document.getElementById('canvas').width = dimensions[0] + 2*padding;
   document.getElementById('canvas').height = dimensions[1] + 2*padding;
 
-  seg_array = payload.imgs.seg_arr;
-  seg_image.src = payload.imgs.segmented;
+  if (scale < 1) {
+    tileLoader = new TileLoader(payload.dimensions[0], payload.dimensions[1], () => {});
+  }
+
+  seg_array = decodeSegArray(payload.imgs.seg_arr);
   seg_image.onload = render_image_display;
-  raw_image.src = payload.imgs.raw;
   raw_image.onload = render_image_display;
+  load_images(payload.imgs);
 }
 
 // adjust current_contrast upon mouse scroll
@@ -838,31 +873,37 @@ function action(action, info) {
   $.ajax({
     type:'POST',
     url:`${document.location.origin}/api/edit/${project_id}/${action}`,
-    data: info,
+    data: Object.assign({ version: projectVersion }, info),
     success: function (payload) {
       if (payload.error) {
         alert(payload.error);
       }
       if (payload.imgs) {
         // load new value of seg_array
-        // array of arrays, contains annotation data for frame
+        // run-length encoded annotation data for frame, decoded to an array of rows
         if (payload.imgs.hasOwnProperty('seg_arr')) {
-          seg_array = payload.imgs.seg_arr;
+          seg_array = decodeSegArray(payload.imgs.seg_arr);
         }
 
-        if (payload.imgs.hasOwnProperty('segmented')) {
-          seg_image.src = payload.imgs.segmented;
+        // tiles of the label image and array changed by an edit
+        if (payload.imgs.hasOwnProperty('tiles')) {
+          applyLabelTiles(seg_image, seg_array, payload.imgs.tiles);
         }
 
-        if (payload.imgs.hasOwnProperty('raw')) {
-          raw_image.src = payload.imgs.raw;
-        }
+        load_images(payload.imgs);
       }
       if (payload.tracks) {
         tracks = payload.tracks[0];
         maxTrack = Math.max(... Object.keys(tracks).map(Number));
       }
-      if (payload.tracks || payload.imgs) {
+      if (payload.trackChanges) {
+        applyTrackChanges({ 0: tracks }, payload.trackChanges);
+        maxTrack = Math.max(... Object.keys(tracks).map(Number));
+      }
+      if (Object.prototype.hasOwnProperty.call(payload, 'version')) {
+        projectVersion = payload.version;
+      }
+      if (payload.tracks || payload.trackChanges || payload.imgs) {
         render_image_display();
       }
     },
@@ -193,6 +193,16 @@ class Mode {
       this.action = 'predict';
       this.prompt = 'Predict cell ids for zstack? / S=PREDICT THIS FRAME / SPACE=PREDICT ALL FRAMES / ESC=CANCEL PREDICTION';
       render_info_display();
+    } else if (evt.key === 'r') {
+      // relabel cells from 1 without skipping values
+      this.kind = Modes.question;
+      this.action = 'relabel';
+      if (numFrames > 1) {
+        this.prompt = 'Relabel cells? / S=RELABEL THIS FRAME / P=RELABEL ALL FRAMES, PRESERVING LABELS ACROSS FRAMES / SPACE=RELABEL EACH FRAME / ESC=CANCEL';
+      } else {
+        this.prompt = 'Relabel cells? / SPACE=RELABEL / ESC=CANCEL';
+      }
+      render_info_display();
     } else if (evt.key === '[' && this.highlighted_cell_one !== -1) {
       // cycle highlight to prev label, skipping 0
       let numLabels = maxLabelsMap.get(this.feature);
@@ -323,6 +333,8 @@ class Mode {
         action(this.action, this.info);
       } else if (this.action === 'predict') {
         action('predict_zstack', this.info);
+      } else if (this.action === 'relabel') {
+        action('relabel_all_frames', {});
       } else if (this.action === 'replace') {
         if (this.info.label_1 !== this.info.label_2) {
           action(this.action, {
@@ -355,6 +367,8 @@ class Mode {
         action('new_single_cell', this.info);
       } else if (this.action === 'predict') {
         action('predict_single', { frame: current_frame });
+      } else if (this.action === 'relabel') {
+        action('relabel_frame', { frame: current_frame });
       } else if (this.action === 'replace') {
         if (this.info.label_1 !== this.info.label_2) {
           action('replace_single', {
@@ -373,6 +387,9 @@ class Mode {
         }
       }
       this.clear();
+    } else if (evt.key === 'p' && this.action === 'relabel') {
+      action('relabel_preserve', {});
+      this.clear();
     }
   }
 
@@ -625,9 +642,15 @@ var answer = '(SPACE=YES / ESC=NO)';
 var project_id;
 
 var tracks;
+// project version of the tracks, sent with each action to receive only the changed tracks
+var projectVersion;
 
 var brush;
 var adjuster;
+// loads the images from the tiles of the viewport when the frame is larger than the canvas
+var tileLoader = null;
+// URL listing the tiles of the displayed frame
+var viewportUrl;
 var cursor;
 var canvas;
 var actions;
@@ -722,6 +745,53 @@ function changeZoom(dzoom) {
   updateMousePos(canvas.rawX, canvas.rawY);
   actions.addAction(zoom);
   render_image_display();
+  waitForFinalEvent(loadViewportTiles, 200, 'viewportTiles');
+}
+
+/**
+ * Loads the raw and label images of a payload,
+ * from the tiles of the viewport when the frame is larger than the canvas.
+ */
+function loadImages(imgs) {
+  if (Object.prototype.hasOwnProperty.call(imgs, 'viewport')) {
+    viewportUrl = imgs.viewport;
+  }
+  const hasRaw = Object.prototype.hasOwnProperty.call(imgs, 'raw');
+  const hasSeg = Object.prototype.hasOwnProperty.call(imgs, 'segmented');
+  if (tileLoader !== null) {
+    if (hasRaw) {
+      tileLoader.reset(adjuster.rawImage);
+    }
+    if (hasSeg) {
+      tileLoader.reset(adjuster.segImage);
+    }
+    if (hasRaw || hasSeg) {
+      loadViewportTiles();
+    }
+    return;
+  }
+  if (hasSeg) {
+    adjuster.segLoaded = false;
+    adjuster.segImage.src = imgs.segmented;
+  }
+  if (hasRaw) {
+    adjuster.rawLoaded = false;
+    adjuster.rawImage.src = imgs.raw;
+  }
+}
+
+// load the tiles of the images that cover the viewport at the current zoom
+function loadViewportTiles() {
+  if (tileLoader === null) {
+    return;
+  }
+  tileLoader.load(
+    viewportUrl,
+    canvas.sx, canvas.sy,
+    canvas.sWidth, canvas.sHeight,
+    canvas.scale * canvas.zoom / 100,
+    adjuster.rawImage, adjuster.segImage
+  );
 }
 
 function render_highlight_info() {
@@ -959,6 +1029,7 @@ function handleMousemove(evt) {
     actions.addAction(pan);
     if (canvas.sx !== oldX || canvas.sy !== oldY) {
       render_image_display();
+      waitForFinalEvent(loadViewportTiles, 200, 'viewportTiles');
     }
   }
   updateMousePos(evt.offsetX, evt.offsetY);
@@ -987,40 +1058,53 @@ function handlePayload(payload) {
   }
   if (payload.imgs) {
     // load new value of seg_array
-    // array of arrays, contains annotation data for frame
+    // run-length encoded annotation data for frame, decoded to an array of rows
     if (Object.prototype.hasOwnProperty.call(payload.imgs, 'seg_arr')) {
-      canvas.segArray = payload.imgs.seg_arr;
+      canvas.segArray = decodeSegArray(payload.imgs.seg_arr);
     }
 
-    if (Object.prototype.hasOwnProperty.call(payload.imgs, 'segmented')) {
-      adjuster.segLoaded = false;
-      adjuster.segImage.src = payload.imgs.segmented;
+    // tiles of the label image and array changed by an edit
+    if (Object.prototype.hasOwnProperty.call(payload.imgs, 'tiles')) {
+      if (applyLabelTiles(adjuster.segImage, canvas.segArray, payload.imgs.tiles)) {
+        adjuster.segLoaded = false;
+      }
     }
 
-    if (Object.prototype.hasOwnProperty.call(payload.imgs, 'raw')) {
-      adjuster.rawLoaded = false;
-      adjuster.rawImage.src = payload.imgs.raw;
-    }
+    loadImages(payload.imgs);
   }
   if (payload.tracks) {
     tracks = payload.tracks;
-    // update maxLabelsMap when we get new track info
-    for (let i = 0; i < Object.keys(tracks).length; i++) {
-      const key = Object.keys(tracks)[i]; // the keys are strings
-      if (Object.keys(tracks[key]).length > 0) {
-        // use i as key in this map because it is an int, mode.feature is also int
-        maxLabelsMap.set(i, Math.max(...Object.keys(tracks[key]).map(Number)));
-      } else {
-        // if no labels in feature, explicitly set max label to 0
-        maxLabelsMap.set(i, 0);
-      }
-    }
+    updateMaxLabels();
+  }
+  if (payload.trackChanges) {
+    applyTrackChanges(tracks, payload.trackChanges);
+    updateMaxLabels();
+  }
+  if (Object.prototype.hasOwnProperty.call(payload, 'version')) {
+    projectVersion = payload.version;
   }
-  if (payload.tracks || payload.imgs) {
+  if (payload.tracks || payload.trackChanges || payload.imgs) {
     render_image_display();
   }
 }
 
+// update maxLabelsMap when we get new track info
+function updateMaxLabels() {
+  // for each feature, get list of cell labels that are in that feature
+  // (each is a key in that dict), cast to numbers, then get the maximum
+  // value from each array and store it in a map
+  for (let i = 0; i < Object.keys(tracks).length; i++) {
+    const key = Object.keys(tracks)[i]; // the keys are strings
+    if (Object.keys(tracks[key]).length > 0) {
+      // use i as key in this map because it is an int, mode.feature is also int
+      maxLabelsMap.set(i, Math.max(...Object.keys(tracks[key]).map(Number)));
+    } else {
+      // if no labels in feature, explicitly set max label to 0
+      maxLabelsMap.set(i, 0);
+    }
+  }
+}
+
 function action(action, info) {
   backendAction = new BackendAction(action, info);
   actions.addFencedAction(backendAction);
@@ -1031,6 +1115,8 @@ function undo() {
   mode.clear();
   updateMousePos(canvas.rawX, canvas.rawY);
   render_image_display();
+  // undoing a zoom or pan shows another viewport
+  loadViewportTiles();
 }
 
 function redo() {
@@ -1038,6 +1124,7 @@ function redo() {
   mode.clear();
   updateMousePos(canvas.rawX, canvas.rawY);
   render_image_display();
+  loadViewportTiles();
 }
 
 function displayUndoRedo() {
@@ -1085,20 +1172,8 @@ function handleFirstPayload(payload) {
   }, false);
 
   tracks = payload.tracks; // tracks payload is dict
-
-  // for each feature, get list of cell labels that are in that feature
-  // (each is a key in that dict), cast to numbers, then get the maximum
-  // value from each array and store it in a map
-  for (let i = 0; i < Object.keys(tracks).length; i++) {
-    const key = Object.keys(tracks)[i]; // the keys are strings
-    if (Object.keys(tracks[key]).length > 0) {
-      // use i as key in this map because it is an int, mode.feature is also int
-      maxLabelsMap.set(i, Math.max(...Object.keys(tracks[key]).map(Number)));
-    } else {
-      // if no labels in feature, explicitly set max label to 0
-      maxLabelsMap.set(i, 0);
-    }
-  }
+  projectVersion = payload.version;
+  updateMaxLabels();
 
   brush = new Brush(rawHeight, rawWidth, padding);
 
@@ -1123,6 +1198,16 @@ function handleFirstPayload(payload) {
 
   setCanvasDimensions(payload.dimensions);
 
+  if (canvas.scale < 1) {
+    tileLoader = new TileLoader(rawWidth, rawHeight, (image) => {
+      if (image === adjuster.rawImage) {
+        adjuster.rawLoaded = false;
+      } else {
+        adjuster.segLoaded = false;
+      }
+    });
+  }
+
   // resize the canvas every time the window is resized
   window.addEventListener('resize', function() {
     waitForFinalEvent(() => {
@@ -1130,6 +1215,7 @@ function handleFirstPayload(payload) {
       setCanvasDimensions(payload.dimensions);
       brush.refreshView();
       displayUndoRedo();
+      loadViewportTiles();
     }, 500, 'canvasResize');
   });
 
@@ -1163,11 +1249,8 @@ function handleFirstPayload(payload) {
   }
 
   // Load images and seg_array from payload
-  canvas.segArray = payload.imgs.seg_arr;
-  adjuster.rawLoaded = false;
-  adjuster.segLoaded = false;
-  adjuster.segImage.src = payload.imgs.segmented;
-  adjuster.rawImage.src = payload.imgs.raw;
+  canvas.segArray = decodeSegArray(payload.imgs.seg_arr);
+  loadImages(payload.imgs);
 
   displayUndoRedo();
 }
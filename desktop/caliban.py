@@ -42,6 +42,7 @@ import tarfile
 import tempfile
 
 from io import BytesIO
+from scipy.optimize import linear_sum_assignment
 from skimage.morphology import watershed, flood_fill, flood, dilation, disk
 from skimage.draw import circle
 from skimage.measure import regionprops
@@ -4841,6 +4842,15 @@ class ZStackReview(CalibanWindow):
         # self.cell_ids[feature] is a list of the unique, nonzero values in annotation
         self.cell_ids[feature] = np.unique(annotated)[np.nonzero(np.unique(annotated))]
 
+        # find the labels in each frame once, instead of searching each frame for each label
+        cell_frames = {}
+        for frame in range(self.annotated.shape[0]):
+            frame_cells = np.unique(annotated[frame,:,:])
+            for cell in frame_cells[np.nonzero(frame_cells)]:
+                # frame gets added to label entry's list of frames
+                # this is ordered and unique because of for loop
+                cell_frames.setdefault(cell, []).append(frame)
+
         # reset self.cell_info value for key feature
         self.cell_info[feature] = {}
         # each label in the feature needs a key value pair in this dict
@@ -4850,16 +4860,7 @@ class ZStackReview(CalibanWindow):
             # label is one of the info entries for the label (for display reasons)
             self.cell_info[feature][cell]['label'] = str(cell)
             # frames entry is a list of each frame the label appears in
-            self.cell_info[feature][cell]['frames'] = []
-
-            # check each frame of annotation stack for presence of the label
-            for frame in range(self.annotated.shape[0]):
-                # TODO: would this be faster with numpy functions?
-                # if np.any(np.isin(annotated[frame], cell)):
-                if cell in annotated[frame,:,:]:
-                    # frame gets added to label entry's list of frames
-                    # this is ordered and unique because of for loop
-                    self.cell_info[feature][cell]['frames'].append(frame)
+            self.cell_info[feature][cell]['frames'] = cell_frames[cell]
 
             # label info also needs 'slices' string for display reasons
             frames = self.cell_info[feature][cell]['frames']
@@ -4995,151 +4996,66 @@ def get_dirty_rectangle(input_array):
 def predict_zstack_cell_ids(img, next_img, threshold = 0.1):
     '''
     Predict labels for next_img based on intersection over union (iou)
-    with img. If cells don't meet threshold for iou, they don't count as
+    with img. Cells are matched one to one to maximize their total iou.
+    If cells don't meet threshold for iou, they don't count as
     matching enough to share label with "matching" cell in img. Cells
     that don't have a match in img (new cells) get a new label so that
     output relabeled_next does not skip label values (unless label values
     present in prior image need to be skipped to avoid conflating labels).
     '''
-
-    # relabel to remove skipped values, keeps subsequent predictions cleaner
-    next_img = relabel_frame(next_img)
-
-    #create np array that can hold all pairings between cells in one
-    #image and cells in next image
-    iou = np.zeros((np.max(img)+1, np.max(next_img)+1))
-
-    vals = np.unique(img)
-    cells = vals[np.nonzero(vals)]
-
-    #nothing to predict off of
-    if len(cells) == 0:
-        return next_img
-
-    next_vals = np.unique(next_img)
-    next_cells = next_vals[np.nonzero(next_vals)]
-
-    #no values to reassign
-    if len(next_cells) == 0:
-        return next_img
-
-    #calculate IOUs
-    for i in cells:
-        for j in next_cells:
-            intersection = np.logical_and(img==i,next_img==j)
-            union = np.logical_or(img==i,next_img==j)
-            iou[i,j] = intersection.sum(axis=(0,1)) / union.sum(axis=(0,1))
-
-    #relabel cells appropriately
-
-    #relabeled_next holds cells as they get relabeled appropriately
-    relabeled_next = np.zeros(next_img.shape, dtype = np.uint16)
-
-    #max_indices[cell_from_next_img] -> cell from first image that matches it best
-    max_indices = np.argmax(iou, axis = 0)
-
-    #put cells that into new image if they've been matched with another cell
-
-    #keep track of which (next_img)cells don't have matches
-    #this can be if (next_img)cell matched background, or if (next_img)cell matched
-    #a cell already used
-    unmatched_cells = []
-    #don't reuse cells (if multiple cells in next_img match one particular cell)
-    used_cells_src = []
-
-    #next_cell ranges between 0 and max(next_img)
-    #matched_cell is which cell in img matched next_cell the best
-
-    # this for loop does the matching between cells
-    for next_cell, matched_cell in enumerate(max_indices):
-        #if more than one match, look for best match
-        #otherwise the first match gets linked together, not necessarily reproducible
-
-        # matched_cell != 0 prevents adding the background to used_cells_src
-        if matched_cell != 0 and matched_cell not in used_cells_src:
-            bool_matches = np.where(max_indices == matched_cell)
-            count_matches = np.count_nonzero(bool_matches)
-            if count_matches > 1:
-                #for a given cell in img, which next_cell has highest iou
-                matching_next_options = np.argmax(iou, axis =1)
-                best_matched_next = matching_next_options[matched_cell]
-
-                #ignore if best_matched_next is the background
-                if best_matched_next != 0:
-                    if next_cell != best_matched_next:
-                        unmatched_cells = np.append(unmatched_cells, next_cell)
-                        continue
-                    else:
-                        # don't add if bad match
-                        if iou[matched_cell][best_matched_next] > threshold:
-                            relabeled_next = np.where(next_img == best_matched_next, matched_cell, relabeled_next)
-
-                        # if it's a bad match, we still need to add next_cell back into relabeled next later
-                        elif iou[matched_cell][best_matched_next] <= threshold:
-                            unmatched_cells = np.append(unmatched_cells, best_matched_next)
-
-                        # in either case, we want to be done with the "matched_cell" from img
-                        used_cells_src = np.append(used_cells_src, matched_cell)
-
-            # matched_cell != 0 is still true
-            elif count_matches == 1:
-                #add the matched cell to the relabeled image
-                if iou[matched_cell][next_cell] > threshold:
-                    relabeled_next = np.where(next_img == next_cell, matched_cell, relabeled_next)
-                else:
-                    unmatched_cells = np.append(unmatched_cells, next_cell)
-
-                used_cells_src = np.append(used_cells_src, matched_cell)
-
-        elif matched_cell in used_cells_src and next_cell != 0:
-            #skip that pairing, add next_cell to unmatched_cells
-            unmatched_cells = np.append(unmatched_cells, next_cell)
-
-        #if the cell in next_img didn't match anything (and is not the background):
-        if matched_cell == 0 and next_cell !=0:
-            unmatched_cells = np.append(unmatched_cells, next_cell)
-            #note: this also puts skipped (nonexistent) labels into unmatched cells, main reason to relabel first
-
-    #figure out which labels we should use to label remaining, unmatched cells
-
-    #these are the values that have already been used in relabeled_next
-    relabeled_values = np.unique(relabeled_next)[np.nonzero(np.unique(relabeled_next))]
-
-    #to account for any new cells that appear, create labels by adding to the max number of cells
-    #assumes that these are new cells and that all prev labels have been assigned
-    #only make as many new labels as needed
-
-    current_max = max(np.max(cells), np.max(relabeled_values)) + 1
-
-    stringent_allowed = []
-    for additional_needed in range(len(unmatched_cells)):
-        stringent_allowed.append(current_max)
-        current_max += 1
-
-    #replace each unmatched cell with a value from the stringent_allowed list,
-    #add that relabeled cell to relabeled_next
-    if len(unmatched_cells) > 0:
-        for reassigned_cell in range(len(unmatched_cells)):
-            relabeled_next = np.where(next_img == unmatched_cells[reassigned_cell],
-                                 stringent_allowed[reassigned_cell], relabeled_next)
-
-    return relabeled_next
+    #number the cells in each image from 1 without skipping values, keeping 0 as background
+    cells, cell_ids = np.unique(img, return_inverse = True)
+    next_cells, next_ids = np.unique(next_img, return_inverse = True)
+    if cells[0] != 0:
+        cells = np.insert(cells, 0, 0)
+        cell_ids += 1
+    if next_cells[0] != 0:
+        next_cells = np.insert(next_cells, 0, 0)
+        next_ids += 1
+    num_cells, num_next_cells = len(cells), len(next_cells)
+
+    #nothing to predict off of, or no values to reassign
+    if num_cells == 1 or num_next_cells == 1:
+        return next_ids.reshape(next_img.shape).astype(np.uint16)
+
+    #count the pixels of each pairing between cells in one image
+    #and cells in next image in a single pass
+    overlap = np.bincount(cell_ids * num_next_cells + next_ids,
+                          minlength = num_cells * num_next_cells)
+    overlap = overlap.reshape(num_cells, num_next_cells)
+    areas = overlap.sum(axis = 1)
+    next_areas = overlap.sum(axis = 0)
+    intersection = overlap[1:, 1:]
+    iou = intersection / (areas[1:, np.newaxis] + next_areas[np.newaxis, 1:] - intersection)
+
+    #match cells to maximize the total iou, and don't keep bad matches
+    matched, next_matched = linear_sum_assignment(-iou)
+    good = iou[matched, next_matched] > threshold
+
+    #relabel cells with a lookup from next cell to its new label
+    new_labels = np.zeros(num_next_cells, dtype = np.int64)
+    new_labels[next_matched[good] + 1] = cells[matched[good] + 1]
+    #new cells get labels after the highest label in img
+    unmatched = np.flatnonzero(new_labels[1:] == 0) + 1
+    new_labels[unmatched] = cells[-1] + 1 + np.arange(len(unmatched))
+
+    dtype = np.promote_types(np.uint16, np.min_scalar_type(new_labels.max()))
+    return new_labels.astype(dtype)[next_ids].reshape(next_img.shape)
 
 def relabel_frame(img, start_val = 1):
-    '''relabel cells in frame starting from 1 without skipping values'''
-
-    #cells in image to be relabeled
-    cell_list = np.unique(img)
-    cell_list = cell_list[np.nonzero(cell_list)]
+    '''relabel cells in frame starting from start_val without skipping values'''
 
-    relabeled_cell_list = range(start_val, len(cell_list)+start_val)
+    #cells in image to be relabeled, with their index in cells at each pixel
+    cells, cell_ids = np.unique(img, return_inverse = True)
+    is_cell = cells != 0
+    num_cells = np.count_nonzero(is_cell)
 
-    relabeled_img = np.zeros(img.shape, dtype = np.uint16)
-    for i, cell in enumerate(cell_list):
-        #print(i, cell, cell_list[i], relabeled_cell_list[i])
-        relabeled_img = np.where(img == cell, relabeled_cell_list[i], relabeled_img)
+    #lookup table from each cell to its new label, keeping 0 as background
+    dtype = np.promote_types(np.uint16, np.min_scalar_type(start_val + num_cells))
+    relabeled_cell_list = np.zeros(len(cells), dtype = dtype)
+    relabeled_cell_list[is_cell] = np.arange(start_val, start_val + num_cells)
 
-    return relabeled_img
+    return relabeled_cell_list[cell_ids].reshape(img.shape)
 
 
 def load_trk(filename):